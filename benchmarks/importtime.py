@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Import time benchmark for databaker.framework.
+
+Usage:
+  importtime.py [options]
+
+Options:
+  --repeat=N        Number of timed imports [default: 5]
+  --max-seconds=S   Fail if the median import time is longer than this
+
+Times `from databaker.framework import *` in fresh interpreters and fails
+(exit status 1) if any of the deferred heavy modules got imported with it
+or if the median time exceeds --max-seconds.
+"""
+
+import sys, subprocess, statistics
+from docopt import docopt
+
+DEFERRED_MODULES = [ "pandas", "IPython" ]
+
+PROBE = """
+import sys, time, json
+stime = time.perf_counter()
+from databaker.framework import *
+seconds = time.perf_counter() - stime
+print(json.dumps([seconds, [m  for m in %r  if m in sys.modules]]))
+""" % DEFERRED_MODULES
+
+
+def probe():
+    import json
+    out = subprocess.check_output([sys.executable, "-W", "ignore", "-c", PROBE])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def main(argv=sys.argv[1:]):
+    args = docopt(__doc__, argv=argv)
+    repeat = int(args["--repeat"])
+    probe()   # warm the filesystem and bytecode caches
+    results = [ probe()  for i in range(repeat) ]
+    seconds = statistics.median(r[0]  for r in results)
+    loaded = sorted(set(m  for r in results  for m in r[1]))
+    print("import databaker.framework: median %.3fs over %d runs" % (seconds, repeat))
+
+    failed = False
+    if loaded:
+        print("FAIL: deferred modules imported eagerly: %s" % ", ".join(loaded))
+        failed = True
+    if args["--max-seconds"] and seconds > float(args["--max-seconds"]):
+        print("FAIL: import took longer than %s seconds" % args["--max-seconds"])
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
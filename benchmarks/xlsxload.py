@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Load time and peak memory of the loadxlstabs backends on a big xlsx file.
+
+Usage:
+  xlsxload.py [options] [<xlsxfile>]
+
+Options:
+  --megabytes=M      Size of the workbook to generate when no <xlsxfile> is given [default: 50]
+  --backends=LIST    Comma separated loadxlstabs backends to compare [default: xlsx,messytables]
+  --keep=FILE        Save the generated workbook as FILE instead of deleting it
+
+Each backend loads the file in a fresh interpreter so that the peak resident
+memory (ru_maxrss) belongs to that load alone.  The generated workbook has a
+header row, a text label column, numbers, dates and some merged cells, and is
+written straight out as xlsx XML so nothing beyond databaker is needed.
+"""
+
+import os, sys, json, random, tempfile, zipfile, subprocess
+from docopt import docopt
+
+PROBE = """
+import sys, time, json, resource
+from databaker.framework import loadxlstabs
+stime = time.perf_counter()
+tabs = loadxlstabs(%r, verbose=False, backend=%r)
+seconds = time.perf_counter() - stime
+ncells = sum(len(tab)  for tab in tabs)
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+print(json.dumps([seconds, ncells, maxrss]))
+"""
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"><Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/><Default Extension="xml" ContentType="application/xml"/><Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/><Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/><Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/><Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/></Types>"""
+ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>"""
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets><sheet name="Big" sheetId="1" r:id="rId1"/></sheets></workbook>"""
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"><Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/><Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/><Relationship Id="rId3" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/></Relationships>"""
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><numFmts count="1"><numFmt numFmtId="164" formatCode="mmm\\ yyyy"/></numFmts><fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts><fills count="1"><fill><patternFill patternType="none"/></fill></fills><borders count="1"><border/></borders><cellStyleXfs count="1"><xf/></cellStyleXfs><cellXfs count="3"><xf numFmtId="0" fontId="0"/><xf numFmtId="0" fontId="1" applyFont="1"/><xf numFmtId="164" fontId="0" applyNumberFormat="1"/></cellXfs></styleSheet>"""
+
+NCOLS = 20
+LABELS = [ "Region %d" % i  for i in range(500) ]
+
+
+def colname(col):
+    res = ""
+    col += 1
+    while col:
+        col, rem = divmod(col - 1, 26)
+        res = chr(65 + rem) + res
+    return res
+
+
+def generateworkbook(filename, megabytes):
+    "Write a one sheet workbook of roughly the given size, returning its number of rows"
+    rnd = random.Random(1)
+    cols = [ colname(col)  for col in range(NCOLS) ]
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as zfile:
+        zfile.writestr("[Content_Types].xml", CONTENT_TYPES)
+        zfile.writestr("_rels/.rels", ROOT_RELS)
+        zfile.writestr("xl/workbook.xml", WORKBOOK)
+        zfile.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS)
+        zfile.writestr("xl/styles.xml", STYLES)
+        zfile.writestr("xl/sharedStrings.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">%s</sst>' % "".join("<si><t>%s</t></si>" % label  for label in LABELS))
+        with zfile.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as fout:
+            fout.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            fout.write(('<row r="1">%s</row>' % "".join('<c r="%s1" t="s" s="1"><v>%d</v></c>' % (col, i % len(LABELS))  for i, col in enumerate(cols))).encode())
+            row = 1
+            while zfile.fp.tell() < megabytes*1024*1024:
+                for i in range(1000):
+                    row += 1
+                    cells = [ '<c r="A%d" t="s"><v>%d</v></c>' % (row, rnd.randrange(len(LABELS))), '<c r="B%d" s="2"><v>%d</v></c>' % (row, 40000 + row % 3000) ]
+                    cells.extend('<c r="%s%d"><v>%.4f</v></c>' % (col, row, rnd.random()*10000)  for col in cols[2:]  if rnd.random() < 0.9)
+                    fout.write(('<row r="%d">%s</row>' % (row, "".join(cells))).encode())
+            fout.write(('</sheetData><mergeCells count="1"><mergeCell ref="A1:B1"/></mergeCells></worksheet>').encode())
+    return row
+
+
+def probe(xlsxfile, backend):
+    out = subprocess.run([sys.executable, "-W", "ignore", "-c", PROBE % (xlsxfile, backend)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode:
+        return None, out.stderr.decode().strip().splitlines()[-1]
+    return json.loads(out.stdout.decode().strip().splitlines()[-1]), None
+
+
+def main(argv=sys.argv[1:]):
+    args = docopt(__doc__, argv=argv)
+    xlsxfile = args["<xlsxfile>"]
+    if not xlsxfile:
+        xlsxfile = args["--keep"] or tempfile.mktemp(suffix=".xlsx")
+        nrows = generateworkbook(xlsxfile, float(args["--megabytes"]))
+        print("generated %s with %d rows" % (xlsxfile, nrows))
+    try:
+        print("%s is %.1fMB" % (xlsxfile, os.path.getsize(xlsxfile)/1024/1024))
+        for backend in args["--backends"].split(","):
+            result, error = probe(xlsxfile, backend)
+            if result is None:
+                print("%-12s failed: %s" % (backend, error))
+            else:
+                seconds, ncells, maxrss = result
+                print("%-12s %8.2fs  %10d cells  peak %7.1fMB  (%.0f bytes/cell)" % (backend, seconds, ncells, maxrss/1024/1024, maxrss/max(ncells, 1)))
+    finally:
+        if not args["<xlsxfile>"] and not args["--keep"]:
+            os.remove(xlsxfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Loading many workbooks concurrently from asyncio code, for release runners
+that would otherwise load hundreds of workbooks one after another.
+
+    async for inputfile, tabs in load_many(inputfiles, concurrency=4):
+        ...
+
+Up to concurrency workbooks are read and parsed at once in an executor and
+each is given to the loop as soon as it is ready, whatever order that is.
+Another workbook only starts loading when the caller asks for the next one,
+so no more than concurrency loaded workbooks (plus the one the caller has)
+are held in memory however slowly the caller gets through them.
+
+executor="thread" overlaps the file reads and whatever of the parsing
+releases the GIL.  executor="process" parses in worker processes, which
+copy the tables they load into a databaker.sharedtabs.SharedTables for
+this process to attach to (the xypath tables themselves can't be pickled),
+so the parsing runs on several cores.
+"""
+
+import asyncio, concurrent.futures
+from databaker.framework import readxlstabs
+from databaker.sharedtabs import SharedTables, attachtables, attachshm
+
+EXECUTORS = [ "thread", "process" ]
+
+
+def publishxlstabs(inputfile, sheetids, backend):
+    "In a worker process: load a workbook into shared memory, returning the name of the block"
+    shared = SharedTables(readxlstabs(inputfile, sheetids, backend))
+    shared.close()   # left for the parent to unlink once it has attached
+    return shared.name
+
+
+def sharingtracker():
+    "Start the shared memory resource tracker here so the worker processes share it rather than each starting their own"
+    try:
+        from multiprocessing import resource_tracker
+    except ImportError:
+        return
+    resource_tracker.ensure_running()
+
+
+async def load_many(inputfiles, sheetids="*", concurrency=4, backend="messytables", executor="thread", return_exceptions=False):
+    """Async generator of (inputfile, tabs) for each of the inputfiles, in the order they finish loading,
+       with at most concurrency of them loading or waiting to be taken at once.
+       A workbook that fails to load raises its exception here (after which the others are abandoned),
+       or with return_exceptions=True comes out as (inputfile, exception)"""
+    assert executor in EXECUTORS, "executor should be one of %s" % ", ".join(EXECUTORS)
+    if executor == "process":
+        sharingtracker()
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=concurrency)
+        loadfunction = publishxlstabs
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load_many")
+        loadfunction = readxlstabs
+
+    inputfiles = iter(inputfiles)
+    loading = { }   # asyncio future -> (inputfile, executor future)
+    def startnext():
+        for inputfile in inputfiles:
+            cfuture = pool.submit(loadfunction, inputfile, sheetids, backend)
+            loading[asyncio.wrap_future(cfuture)] = (inputfile, cfuture)
+            return
+    try:
+        for i in range(concurrency):
+            startnext()
+        while loading:
+            done, pending = await asyncio.wait(loading, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                inputfile, cfuture = loading.pop(future)
+                try:
+                    tabs = future.result()
+                    if executor == "process":
+                        tabs = attachtables(tabs, unlink=True)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    tabs = e
+                yield inputfile, tabs
+                startnext()   # only once the caller has come back for more
+    finally:
+        for future, (inputfile, cfuture) in loading.items():
+            future.cancel()
+            if not cfuture.cancel() and executor == "process":   # blocks published by abandoned loads are freed as they come in
+                cfuture.add_done_callback(discardpublished)
+        pool.shutdown(wait=False)
+
+
+def discardpublished(future):
+    "Unlink the shared memory of a load in a worker process that nobody is going to attach to"
+    if future.cancelled() or future.exception() is not None:
+        return
+    shm = attachshm(future.result(), track=True)
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,55 @@
+"""
+Run-scoped settings for a bake, so that bakes with different output templates
+can run concurrently in one process (threads or a long-running service)
+instead of sharing the module-global databaker.constants.template.
+"""
+
+import collections, threading
+import databaker.constants
+from databaker.valuepool import ValuePool
+
+# the template settings that a BakeContext can override
+TEMPLATE_SETTINGS = [ "headermeasurements", "headeradditionals", "conversionsegmentnumbercolumn", "SH_Create_ONS_time", "SH_Split_OBS" ]
+
+
+class BakeContext:
+    """Template and options for one bake.  Settings not given are read from the
+       template module (databaker.constants.template by default) when used.
+       The context also owns the ValuePool that its segments intern their dimension values into, 
+       optionally a databaker.segmentcache.SegmentCache that their processed output is kept in, 
+       and optionally a databaker.memtrack.MemoryTracker that measures (and budgets) their memory"""
+    def __init__(self, template=None, valuepool=None, segmentcache=None, memorytracker=None, **settings):
+        for name in settings:
+            if name not in TEMPLATE_SETTINGS:
+                raise TypeError("Unknown BakeContext setting %r (should be one of %s)" % (name, ", ".join(TEMPLATE_SETTINGS)))
+        self.template = template if template is not None else databaker.constants.template
+        self.settings = settings
+        self.valuepool = valuepool if valuepool is not None else ValuePool()
+        self.segmentcache = segmentcache
+        self.memorytracker = memorytracker
+        if "headermeasurements" in settings:  # rederive the names from the new layout
+            headermeasurementnames = list(collections.OrderedDict.fromkeys(k[1]  for k in settings["headermeasurements"]  if isinstance(k, tuple)))
+            settings["headermeasurementnames"] = headermeasurementnames
+            settings["headermeasurementnamesSet"] = set(headermeasurementnames)
+
+    def __getattr__(self, name):
+        settings = self.__dict__.get("settings", { })
+        if name in settings:
+            return settings[name]
+        if name in settings.get("headermeasurementnamesSet", ()):
+            return name   # the variables named after themselves, eg OBS = "OBS"
+        return getattr(self.__dict__["template"], name)
+
+    def __repr__(self):
+        return "<BakeContext %s %r>" % (getattr(self.template, "__name__", self.template), self.settings)
+
+
+# used wherever no context is passed in, and tracks any changes made to the template module
+# (segments made without a context intern into a pool of their table's rather than into its valuepool, 
+# so that values don't pile up from bake to bake in a long-running process)
+defaultcontext = BakeContext()
+
+# state of the bake running in this thread, set by databaker.bakeservice: its workbookcache 
+# (which loadxlstabs reads through), its inputfile (which getinputfilename returns) 
+# and its context (which segments made without one take)
+bakelocal = threading.local()
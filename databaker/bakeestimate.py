@@ -0,0 +1,136 @@
+"""
+Dry run estimates of what a list of ConversionSegments will bake to, worked
+out from the sizes of their bags without doing the lookups.
+
+    estimate = estimatebake(conversionsegments)
+    print(estimate.report())
+    for worker, isegments in enumerate(schedulesegments(estimate.segments, 4)): ...
+
+For each segment this gives the number of observations (the rows it will
+write), its header-additional column groups, the approximate bytes of its
+rows in the WDA CSV and a lookup cost of observations times header cells
+summed over its dimensions.  The CSV bytes come from the lengths of a sample
+of the observation values and of the (overridden) values of the header
+cells, taken as equally likely to be looked up to, so they are rough; the
+lookup cost is only for comparing segments with each other.
+"""
+
+from databaker.jupybakeutils import svalue
+from databaker.jupybakecsv import HLDUPgenerate_header_row
+
+SAMPLESIZE = 1000      # observation cells whose values are measured in each segment
+TIMEUNITLENGTH = 5     # typical guessed TIMEUNIT, eg "Month" or "Year"
+LINEENDLENGTH = 2      # csv.writer ends rows with \r\n
+
+
+def textlength(value):
+    "Bytes that a value takes in the CSV"
+    if value is None:
+        return 0
+    if isinstance(value, float):
+        value = repr(value)
+    return len(str(value).encode("utf-8"))
+
+
+def meanvaluelength(dimension):
+    "Average CSV length of the values a dimension's header cells (or its single value) give"
+    if dimension.hbagset is None:
+        return textlength(dimension.headcellval(None))
+    lengths = [ ]
+    for hcell in dimension.hbagset.unordered_cells:
+        try:
+            lengths.append(textlength(dimension.headcellval(hcell)))
+        except Exception:   # a type override that fails here would fail in the bake too; leave it to that
+            lengths.append(textlength(svalue(hcell)))
+    return sum(lengths)/len(lengths)  if lengths  else 0
+
+
+def meanobslength(obslist, samplesize=SAMPLESIZE):
+    "Average CSV length of the values of a sample of observation cells spread through the list"
+    if not obslist:
+        return 0
+    step = max(1, len(obslist)//samplesize)
+    sample = obslist[::step]
+    return sum(textlength(ob.value  if isinstance(ob.value, float)  else svalue(ob))  for ob in sample)/len(sample)
+
+
+class SegmentEstimate:
+    "Predicted output and cost of one ConversionSegment"
+    def __init__(self, conversionsegment, samplesize=SAMPLESIZE):
+        context = conversionsegment.context
+        self.tabname = conversionsegment.tab.name
+        self.nobs = len(conversionsegment.obslist)
+        self.numheaderadditionals = conversionsegment.numheaderadditionals
+        self.ncolumns = len(context.headermeasurements) + self.numheaderadditionals*len(context.headeradditionals)
+        self.lookupcost = sum(self.nobs*len(dimension.hbagset)  for dimension in conversionsegment.dimensions  if dimension.hbagset is not None)
+
+        # the length of the values in each output column, as in Lyield_dimension_values
+        valuelengths = dict((dimension.label, meanvaluelength(dimension))  for dimension in conversionsegment.dimensions)
+        valuelengths[context.OBS] = meanobslength(conversionsegment.obslist, samplesize)
+        if conversionsegment.processtimeunit and context.SH_Create_ONS_time and context.TIME in valuelengths and context.TIMEUNIT not in valuelengths:
+            valuelengths[context.TIMEUNIT] = TIMEUNITLENGTH
+        rowlength = self.ncolumns - 1 + LINEENDLENGTH
+        for k in context.headermeasurements:
+            if isinstance(k, tuple):
+                rowlength += valuelengths.get(k[1], 0)
+        labels = [ dimension.label  for dimension in conversionsegment.dimensions  if dimension.label not in context.headermeasurementnamesSet ]
+        for label in labels:
+            for k in context.headeradditionals:
+                if isinstance(k, tuple):
+                    rowlength += textlength(label)  if k[1] == "NAME"  else valuelengths[label]
+        self.rowbytes = rowlength
+        self.csvbytes = int(round(self.nobs*rowlength))
+
+    def __repr__(self):
+        return "<SegmentEstimate %s: %d observations, %d header additionals, ~%d CSV bytes, lookup cost %d>" % (self.tabname, self.nobs, self.numheaderadditionals, self.csvbytes, self.lookupcost)
+
+
+class BakeEstimate:
+    "Predicted output and cost of a list of ConversionSegments written into one WDA file"
+    def __init__(self, conversionsegments, samplesize=SAMPLESIZE):
+        self.segments = [ SegmentEstimate(conversionsegment, samplesize)  for conversionsegment in conversionsegments ]
+        self.nobs = sum(segment.nobs  for segment in self.segments)
+        self.lookupcost = sum(segment.lookupcost  for segment in self.segments)
+        headerbytes = 0
+        if conversionsegments:   # the writer takes the header from the first segment, and ends with the ********* row count
+            header = HLDUPgenerate_header_row(conversionsegments[0].numheaderadditionals, conversionsegments[0].context)
+            headerbytes = sum(textlength(k)  for k in header) + len(header) - 1 + LINEENDLENGTH
+        self.csvbytes = headerbytes + sum(segment.csvbytes  for segment in self.segments) + len("*********,") + len(str(self.nobs)) + LINEENDLENGTH
+
+    def report(self):
+        "Table of the segment estimates and their totals"
+        lines = [ "%4s %-24s %10s %8s %12s %14s" % ("", "tab", "obs", "headadd", "csvbytes", "lookupcost") ]
+        for i, segment in enumerate(self.segments):
+            lines.append("%4d %-24s %10d %8d %12d %14d" % (i, segment.tabname[:24], segment.nobs, segment.numheaderadditionals, segment.csvbytes, segment.lookupcost))
+        lines.append("%4s %-24s %10d %8s %12d %14d" % ("", "total", self.nobs, "", self.csvbytes, self.lookupcost))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "<BakeEstimate %d segments: %d observations, ~%d CSV bytes, lookup cost %d>" % (len(self.segments), self.nobs, self.csvbytes, self.lookupcost)
+
+
+def estimatesegment(conversionsegment, samplesize=SAMPLESIZE):
+    "SegmentEstimate of one segment, without processing it"
+    return SegmentEstimate(conversionsegment, samplesize)
+
+def estimatebake(conversionsegments, samplesize=SAMPLESIZE):
+    "BakeEstimate of the segments that writetechnicalCSV would be given, without processing them"
+    if not isinstance(conversionsegments, (list, tuple)):
+        conversionsegments = [ conversionsegments ]
+    return BakeEstimate(conversionsegments, samplesize)
+
+
+def segmentcost(segment):
+    "Relative work of a segment for scheduling: its lookups and the rows it writes"
+    return segment.lookupcost + segment.nobs*segment.ncolumns
+
+def schedulesegments(segmentestimates, njobs):
+    """Lists of segment indexes for each of njobs workers, dealt out biggest first
+       to whichever worker has the least work so far, so they finish at about the same time"""
+    loads = [ 0 ]*njobs
+    res = [ [ ]  for i in range(njobs) ]
+    for i in sorted(range(len(segmentestimates)), key=lambda i: -segmentcost(segmentestimates[i])):
+        j = loads.index(min(loads))
+        res[j].append(i)
+        loads[j] += segmentcost(segmentestimates[i])
+    return res
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+"""Long running local bake service that keeps parsed workbooks warm between bakes.
+
+Usage:
+  databaker_serve [options] (--recipe=SPEC | --recipedir=DIR)...
+
+Options:
+  --recipe=SPEC      A recipe that may be run, eg "myrecipes:bakeott" or "recipes/ott.py:bake"
+  --recipedir=DIR    Allow the functions defined in any .py file under DIR as recipes
+  --host=HOST        Address to listen on [default: 127.0.0.1]
+  --port=PORT        Port to listen on [default: 8787]
+  -j N, --jobs=N     Number of bakes run at once [default: 2]
+  --cache-mb=MB      Memory for the packed workbooks kept between bakes [default: 2048]
+
+Recipes are given as for databaker_bake ("module:function" or "file.py:function"),
+and since a recipe is arbitrary code, only the ones allowed when the service
+starts (with --recipe or --recipedir) are run.  Requests must be sent as JSON
+(which a web page can't do without a CORS preflight) and name localhost.
+
+Recipes are called with the input filename (and context=BakeContext() if they
+take a context argument; segments made without one get the job's context
+anyway) and return the ConversionSegments or DataFrames to send back.
+Notebook recipes write their own output and change the working directory and
+environment of the whole process, so they are refused.  Their loadxlstabs
+calls read through a cache of parsed workbooks keyed by path, modification
+time and size, least recently used dropped first.  The cache holds each
+workbook packed as databaker.sharedtabs packs it, and every loadxlstabs call
+gets new tables made from that, so recipes that change cell values (eg to fix
+headings) don't change them for other bakes.
+
+  POST /bake      {"recipe": ..., "inputfile": ..., "format": "csv" or "pandas"}
+                  streams back the WDA CSV, or for "pandas" a line of
+                  DataFrame.to_json(orient="split") per segment
+  GET /metrics    queue depth, workbook cache hit rate and job latencies as json
+  GET /health
+
+requestbake() is the client side of POST /bake.  Everything is on localhost, so
+it can be tested with no network.
+"""
+
+import os, sys, io, json, time, queue, inspect, threading, collections, traceback, concurrent.futures
+import http.server, urllib.request, urllib.error, urllib.parse
+from docopt import docopt
+
+import databaker.framework as framework
+from databaker.bakecontext import BakeContext
+from databaker.jupybakeutils import ConversionSegment
+from databaker.jupybakecsv import TechnicalCSVWriter
+from databaker.databaker_bake import loadrecipe
+from databaker.sharedtabs import packtables, unpacktables
+
+FORMATS = { "csv":"text/csv; charset=utf-8", "pandas":"application/x-ndjson" }
+STREAMCHUNK = 65536    # bytes gathered before each chunk is sent
+NJOBHISTORY = 1000     # jobs kept for the latency figures in the metrics
+
+
+class WorkbookCache:
+    """Parsed workbooks kept between bakes, keyed by path, modification time and size so an edited file is reread.
+       Each is held packed (see databaker.sharedtabs.packtables), and new tables are made from it for every caller.
+       The least recently used are dropped once their packed size passes maxbytes"""
+    def __init__(self, maxbytes=2048*1024*1024):
+        self.maxbytes = maxbytes
+        self.workbooks = collections.OrderedDict()   # key -> (packed block, bytes), most recently used last
+        self.loading = { }    # key -> lock, so a workbook wanted by several bakes at once is read once
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def tables(self, inputfile, backend="messytables"):
+        "New tables of all the sheets of a workbook, read with the loadxlstabs backend if not already held"
+        return unpacktables(self.packed(inputfile, backend))
+
+    def packed(self, inputfile, backend="messytables"):
+        "The packed block of a workbook, read with the loadxlstabs backend if not already held"
+        path = os.path.abspath(inputfile)
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size, backend)
+        with self.lock:
+            if key in self.workbooks:
+                return self.hit(key)
+            keylock = self.loading.setdefault(key, threading.Lock())
+        with keylock:
+            with self.lock:
+                if key in self.workbooks:   # read while we were waiting
+                    return self.hit(key)
+            block = bytes(packtables(framework.readxlstabs(path, "*", backend))[0])
+            with self.lock:
+                self.misses += 1
+                for okey in [ okey  for okey in self.workbooks  if okey[0] == path and okey[3] == backend ]:
+                    del self.workbooks[okey]   # an older version of the file
+                self.workbooks[key] = (block, len(block))
+                self.loading.pop(key, None)
+                self.evict(keep=key)
+        return block
+
+    def hit(self, key):
+        self.hits += 1
+        self.workbooks.move_to_end(key)
+        return self.workbooks[key][0]
+
+    def evict(self, keep):
+        while self.nbytes() > self.maxbytes and len(self.workbooks) > 1:
+            okey = next(iter(self.workbooks))
+            if okey == keep:
+                break
+            del self.workbooks[okey]
+            self.evictions += 1
+
+    def nbytes(self):
+        return sum(nbytes  for block, nbytes in self.workbooks.values())
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return { "hits":self.hits, "misses":self.misses, "hitrate":(self.hits/lookups  if lookups  else 0.0),
+                     "evictions":self.evictions, "workbooks":len(self.workbooks), "bytes":self.nbytes(), "maxbytes":self.maxbytes }
+
+
+class ChunkStream(io.TextIOBase):
+    "Text file that hands its output on in chunks of bytes (to a queue read by the request handler)"
+    def __init__(self, send, chunksize=STREAMCHUNK):
+        self.send = send
+        self.chunksize = chunksize
+        self.buffer = [ ]
+        self.nbuffered = 0
+
+    def write(self, s):
+        b = s.encode("utf-8")
+        self.buffer.append(b)
+        self.nbuffered += len(b)
+        if self.nbuffered >= self.chunksize:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buffer:
+            self.send(b"".join(self.buffer))
+            self.buffer, self.nbuffered = [ ], 0
+
+
+# host names a request may give in its Host and Origin headers
+LOCALHOSTS = { "localhost", "127.0.0.1", "::1" }
+
+
+def recipekey(recipespec):
+    "A recipe specification with its file made absolute and its function filled in, to compare with the allowed ones"
+    recipefile, _, funcname = recipespec.partition(":")
+    if recipefile.endswith((".py", ".ipynb")):
+        recipefile = os.path.realpath(recipefile)
+    return "%s:%s" % (recipefile, funcname or "bake")
+
+
+def acceptscontext(recipe):
+    try:
+        return "context" in inspect.signature(recipe).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+class BakeService:
+    "Runs bake jobs on a pool of threads that share a WorkbookCache, keeping figures for the metrics"
+    def __init__(self, jobs=2, cachebytes=2048*1024*1024, recipes=(), recipedirs=()):
+        self.allowedrecipes = set(recipekey(recipespec)  for recipespec in recipes)
+        self.recipedirs = [ os.path.realpath(recipedir)  for recipedir in recipedirs ]
+        self.workbookcache = WorkbookCache(cachebytes)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.jobs = jobs
+        self.recipes = { }   # (recipe, file modification time) -> loaded recipe
+        self.lock = threading.Lock()
+        self.nqueued = 0
+        self.nrunning = 0
+        self.ncompleted = 0
+        self.nfailed = 0
+        self.history = collections.deque(maxlen=NJOBHISTORY)   # { recipe, inputfile, status, queueseconds, runseconds } of recent jobs
+
+    def isallowed(self, recipespec):
+        "Whether a recipe is one of those the service was started with, or in a .py file under one of its recipe directories"
+        key = recipekey(recipespec)
+        if key in self.allowedrecipes:
+            return True
+        recipefile = key.rpartition(":")[0]
+        return recipefile.endswith(".py") and any(recipefile.startswith(recipedir + os.sep)  for recipedir in self.recipedirs)
+
+    def recipe(self, recipespec):
+        "The recipe function, if it is allowed, loaded once and again if its file changes"
+        if not self.isallowed(recipespec):
+            raise PermissionError("Recipe %s is not one this service was started with (see --recipe and --recipedir)" % recipespec)
+        recipefile = recipekey(recipespec).rpartition(":")[0]
+        if recipefile.endswith(".ipynb"):
+            raise ValueError("Notebook recipe %s can't be run by the bake service (it would change the working directory and environment of every job); use a module:function recipe" % recipefile)
+        mtime = os.path.getmtime(recipefile)  if recipefile.endswith(".py")  else None
+        with self.lock:
+            recipe = self.recipes.get((recipespec, mtime))
+        if recipe is None:
+            recipe = loadrecipe(recipespec)
+            # the function itself must come from the allowed file or module, not be something it imported, eg os.system
+            if recipefile.endswith(".py"):
+                try:
+                    allowed = os.path.realpath(inspect.getsourcefile(recipe) or "") == recipefile
+                except TypeError:
+                    allowed = False
+            else:
+                allowed = getattr(recipe, "__module__", None) == recipefile
+            if not allowed:
+                raise PermissionError("Recipe %s is not a function defined in %s" % (recipespec, recipefile))
+            with self.lock:
+                self.recipes[(recipespec, mtime)] = recipe
+        return recipe
+
+    def submit(self, job, send):
+        """Queue a job, which calls send with each chunk of bytes of its output, then with None when
+           it is done or with the exception if it fails.  Returns the Future of the job"""
+        with self.lock:
+            self.nqueued += 1
+        return self.executor.submit(self.runjob, job, send, time.time())
+
+    def runjob(self, job, send, qtime):
+        stime = time.time()
+        with self.lock:
+            self.nqueued -= 1
+            self.nrunning += 1
+        status = "ok"
+        try:
+            self.bake(job, send)
+            send(None)
+        except Exception as e:
+            traceback.print_exc()
+            status = "error: %s: %s" % (type(e).__name__, e)
+            send(e)
+        finally:
+            with self.lock:
+                self.nrunning -= 1
+                if status == "ok":
+                    self.ncompleted += 1
+                else:
+                    self.nfailed += 1
+                self.history.append({ "recipe":job.get("recipe"), "inputfile":job.get("inputfile"), "status":status,
+                                      "queueseconds":round(stime - qtime, 4), "runseconds":round(time.time() - stime, 4) })
+
+    def bake(self, job, send):
+        "Run the recipe of a job with the workbook cache and stream its segments out through send"
+        fmt = job.get("format", "csv")
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format %r (should be one of %s)" % (fmt, ", ".join(FORMATS)))
+        recipe = self.recipe(job["recipe"])
+        inputfile = job["inputfile"]
+        context = BakeContext()   # of this job only, so its valuepool goes when the job is done
+        framework.bakelocal.workbookcache = self.workbookcache
+        framework.bakelocal.inputfile = inputfile
+        framework.bakelocal.context = context
+        try:
+            if acceptscontext(recipe):
+                conversionsegments = recipe(inputfile, context=context)
+                writercontext = context
+            else:
+                conversionsegments = recipe(inputfile)
+                writercontext = None   # the segments' own, which may be one the recipe made
+            if conversionsegments is None:
+                raise ValueError("Recipe %s returned no segments to send back" % job["recipe"])
+            if isinstance(conversionsegments, ConversionSegment) or hasattr(conversionsegments, "columns"):
+                conversionsegments = [ conversionsegments ]
+            stream = ChunkStream(send)
+            if fmt == "csv":
+                writer = TechnicalCSVWriter(stream, writercontext)
+                for conversionsegment in conversionsegments:   # a generator from the recipe is written as it goes
+                    writer.addsegment(conversionsegment)
+                writer.close()
+            else:
+                for conversionsegment in conversionsegments:
+                    df = conversionsegment.topandas()  if isinstance(conversionsegment, ConversionSegment)  else conversionsegment
+                    stream.write(df.to_json(orient="split", date_format="iso") + "\n")
+            stream.flush()
+        finally:
+            framework.bakelocal.workbookcache = None
+            framework.bakelocal.inputfile = None
+            framework.bakelocal.context = None
+
+    def metrics(self):
+        with self.lock:
+            history = list(self.history)
+            res = { "jobs":self.jobs, "queued":self.nqueued, "running":self.nrunning, "completed":self.ncompleted, "failed":self.nfailed }
+        res["workbookcache"] = self.workbookcache.stats()
+        runseconds = sorted(h["runseconds"]  for h in history)
+        if runseconds:
+            res["runseconds"] = { "count":len(runseconds), "mean":round(sum(runseconds)/len(runseconds), 4), "median":runseconds[len(runseconds)//2],
+                                  "p95":runseconds[min(len(runseconds) - 1, int(len(runseconds)*0.95))], "max":runseconds[-1] }
+        res["recentjobs"] = history[-20:]
+        return res
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class BakeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # for the chunked responses
+
+    def sendjson(self, code, obj):
+        body = json.dumps(obj, indent=1).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def fromlocalhost(self):
+        "Whether the Host (and any Origin) the request names is this machine, so other sites' pages and DNS rebinding are turned away"
+        for header in ("Host", "Origin"):
+            value = self.headers.get(header)
+            if value is None:
+                if header == "Host":
+                    return False
+                continue
+            hostname = urllib.parse.urlsplit(value  if "//" in value  else "//" + value).hostname
+            if hostname not in LOCALHOSTS and hostname != self.server.server_address[0]:
+                return False
+        return True
+
+    def do_GET(self):
+        if not self.fromlocalhost():
+            self.sendjson(403, { "error":"requests must come from localhost" })
+        elif self.path == "/metrics":
+            self.sendjson(200, self.server.service.metrics())
+        elif self.path == "/health":
+            self.sendjson(200, { "status":"ok" })
+        else:
+            self.sendjson(404, { "error":"no such path %s" % self.path })
+
+    def do_POST(self):
+        if self.path != "/bake":
+            self.sendjson(404, { "error":"no such path %s" % self.path })
+            return
+        if not self.fromlocalhost():
+            self.sendjson(403, { "error":"requests must come from localhost" })
+            return
+        if self.headers.get("Content-Type", "").partition(";")[0].strip().lower() != "application/json":
+            self.sendjson(415, { "error":"the job should be sent as application/json" })
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            assert isinstance(job, dict) and "recipe" in job and "inputfile" in job, "job needs a recipe and an inputfile"
+        except (ValueError, AssertionError) as e:
+            self.sendjson(400, { "error":str(e) })
+            return
+        if not self.server.service.isallowed(job["recipe"]):
+            self.sendjson(403, { "error":"recipe %s is not one this service was started with" % job["recipe"] })
+            return
+
+        chunks = queue.Queue()
+        self.server.service.submit(job, chunks.put)
+        chunk = chunks.get()
+        if isinstance(chunk, Exception):   # failed before sending anything, so it can be reported properly
+            self.sendjson(403  if isinstance(chunk, PermissionError)  else 500, { "error":"%s: %s" % (type(chunk).__name__, chunk) })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", FORMATS.get(job.get("format", "csv")))
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        while chunk is not None:
+            if isinstance(chunk, Exception):   # leave off the last chunk so the client sees the output is incomplete
+                self.close_connection = True
+                return
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            chunk = chunks.get()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def makeserver(service, host="127.0.0.1", port=8787, verbose=True):
+    "The HTTP server for a BakeService (port=0 picks a free port, found in server.server_address)"
+    server = http.server.ThreadingHTTPServer((host, port), BakeRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def requestbake(recipe, inputfile, server="http://127.0.0.1:8787", format="csv"):
+    "Bake inputfile with recipe on a running bake service, returning the WDA CSV text or (for format='pandas') a list of DataFrames"
+    recipefile, colon, funcname = recipe.partition(":")
+    if recipefile.endswith(".py"):   # the service may be running in another directory
+        recipe = os.path.abspath(recipefile) + colon + funcname
+    job = { "recipe":recipe, "inputfile":os.path.abspath(inputfile), "format":format }
+    req = urllib.request.Request(server.rstrip("/") + "/bake", data=json.dumps(job).encode(), headers={ "Content-Type":"application/json" })
+    try:
+        with urllib.request.urlopen(req) as response:
+            text = response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        raise RuntimeError("bake of %s failed: %s" % (inputfile, json.loads(e.read().decode("utf-8")).get("error")))
+    if format == "csv":
+        return text
+    import pandas
+    return [ pandas.read_json(io.StringIO(line), orient="split")  for line in text.splitlines()  if line ]
+
+
+def main(argv=sys.argv[1:]):
+    args = docopt(__doc__, argv=argv)
+    service = BakeService(int(args["--jobs"]), int(float(args["--cache-mb"])*1024*1024), args["--recipe"], args["--recipedir"])
+    server = makeserver(service, args["--host"], int(args["--port"]))
+    print("databaker bake service on http://%s:%d with %d jobs" % (server.server_address[0], server.server_address[1], service.jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == '__main__':
+    main()
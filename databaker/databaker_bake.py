@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""Batch runner applying one recipe to many input files without going through nbconvert.
+
+Usage:
+  databaker_bake [options] <recipe> <inputfiles>...
+
+<recipe> is either a module and function, eg "myrecipes:bakeott", or a
+python file and function, eg "recipes/ott.py:bake".  The function defaults
+to "bake".  It is called once per input file with the filename (which is
+also made available to getinputfilename() through DATABAKER_INPUT_FILE)
+and may return a list of ConversionSegments or pandas DataFrames to be
+written out, or None if it writes its own outputs.
+
+<recipe> can also be a databaker notebook, eg "ott.ipynb", whose code cells
+are extracted into a cached module (see databaker.nbrecipe) and run
+without a Jupyter kernel.  The notebook writes its own outputs.  Like
+nbconvert, it runs in the notebook's own directory, so DATABAKER_INPUT_FILE
+is given the absolute path of the input file, and relative output paths
+are relative to the notebook.
+
+<inputfiles> may contain glob patterns.  Each is written to <outputdir>/<name>.csv
+after its filename without the directory or extension, so the bake is refused
+if two input files would be written to the same output file.
+
+Options:
+  -o DIR, --outputdir=DIR   Directory for the output CSV files [default: .]
+  -j N, --jobs=N            Number of worker processes [default: 1]
+  --summary=FILE            Status and timing summary CSV [default: bake_summary.csv]
+"""
+
+import os, sys, glob, time, csv, importlib, importlib.util, traceback, itertools, concurrent.futures
+from docopt import docopt
+
+
+def loadrecipe(recipe):
+    "Resolve a 'module:function' or 'file.py:function' recipe specification to a callable"
+    modname, _, funcname = recipe.partition(":")
+    if modname.endswith(".ipynb"):
+        from databaker.nbrecipe import loadnotebookrecipe
+        return _NotebookRecipe(loadnotebookrecipe(modname))
+    if modname.endswith(".py"):
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(modname))[0], modname)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(modname)
+    return getattr(module, funcname or "bake")
+
+
+class _NotebookRecipe:
+    def __init__(self, module):
+        self.module = module
+    def __call__(self, inputfile):
+        self.module.bake(inputfile)
+        return None
+
+
+def expandinputfiles(patterns):
+    "Expand glob patterns (Windows shells don't do this for us) preserving the given order"
+    res = [ ]
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            matches = [ pattern ]   # let it fail in the recipe with a proper error
+        for inputfile in matches:
+            if inputfile not in res:
+                res.append(inputfile)
+    return res
+
+
+def outputfilename(inputfile, outputdir):
+    "The CSV file that bakeonefile writes the segments of an input file to"
+    return os.path.join(outputdir, os.path.splitext(os.path.basename(inputfile))[0] + ".csv")
+
+def outputclashes(inputfiles, outputdir):
+    "{ output file: [ input files ] } of the output files that more than one of the inputfiles would be written to"
+    inputs = { }
+    for inputfile in inputfiles:
+        inputs.setdefault(os.path.normcase(outputfilename(inputfile, outputdir)), [ ]).append(inputfile)
+    return dict((outputfile, infiles)  for outputfile, infiles in inputs.items()  if len(set(os.path.abspath(f)  for f in infiles)) > 1)
+
+def clashmessage(clashes):
+    return "Input files would overwrite each other's output:\n" + "\n".join("  %s <- %s" % (outputfile, ", ".join(infiles))  for outputfile, infiles in clashes.items())
+
+
+# the worker state is kept between tasks so each interpreter only imports databaker and the recipe once
+_recipe = None
+_recipename = None
+
+def _initworker(recipe):
+    global _recipe, _recipename
+    _recipe = loadrecipe(recipe)
+    _recipename = recipe
+
+
+def bakeonefile(inputfile, outputdir):
+    "Run the loaded recipe on a single input file and return its summary row"
+    from databaker.jupybakecsv import writetechnicalCSV
+    outputfile = outputfilename(inputfile, outputdir)
+    prevenv = os.environ.get('DATABAKER_INPUT_FILE')
+    os.environ['DATABAKER_INPUT_FILE'] = inputfile
+    stime = time.time()
+    try:
+        conversionsegments = _recipe(inputfile)
+        if conversionsegments is not None:
+            writetechnicalCSV(outputfile, conversionsegments)
+        else:
+            outputfile = ""
+        status = "ok"
+    except Exception as e:
+        traceback.print_exc()
+        outputfile = ""
+        status = "error: %s: %s" % (type(e).__name__, e)
+    finally:
+        if prevenv is None:
+            del os.environ['DATABAKER_INPUT_FILE']
+        else:
+            os.environ['DATABAKER_INPUT_FILE'] = prevenv
+    return { "inputfile":inputfile, "outputfile":outputfile, "status":status, "seconds":round(time.time() - stime, 3) }
+
+
+def diedrow(inputfile, outputdir, seconds):
+    "Summary row of a file whose worker process died (eg killed for running out of memory), with any part written output removed"
+    outputfile = outputfilename(inputfile, outputdir)
+    if os.path.exists(outputfile):
+        os.remove(outputfile)
+    return { "inputfile":inputfile, "outputfile":"", "status":"error: worker process died", "seconds":round(seconds, 3) }
+
+
+def runpool(recipe, tasks, indexes, jobs, results):
+    """Bake the tasks at indexes in a pool of jobs worker processes, no more than jobs at a time, filling in their results.
+       Returns the indexes of the tasks in hand when a worker died (and broke the pool), or [ ] once they are all done"""
+    indexes = iter(indexes)
+    running = { }   # future -> index of its task
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initworker, initargs=(recipe,)) as executor:
+        for i in itertools.islice(indexes, jobs):
+            running[executor.submit(bakeonefile, *tasks[i])] = i
+        while running:
+            done, notdone = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = [ ]
+            for future in done:
+                i = running.pop(future)
+                try:
+                    results[i] = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    broken.append(i)
+                except Exception as e:   # eg a result that couldn't be sent back
+                    results[i] = { "inputfile":tasks[i][0], "outputfile":"", "status":"error: %s: %s" % (type(e).__name__, e), "seconds":0 }
+            if broken:   # the tasks not yet submitted are left for the next pool
+                return sorted(broken + list(running.values()))
+            for i in itertools.islice(indexes, len(done)):
+                running[executor.submit(bakeonefile, *tasks[i])] = i
+    return [ ]
+
+
+def bakefiles(recipe, inputfiles, outputdir=".", jobs=1):
+    "Run recipe across the inputfiles with a pool of jobs worker processes, returning the summary rows in input order"
+    outputdir = os.path.abspath(outputdir)   # recipes are allowed to chdir
+    clashes = outputclashes(inputfiles, outputdir)
+    if clashes:
+        raise ValueError(clashmessage(clashes))
+    if not os.path.isdir(outputdir):
+        os.makedirs(outputdir)
+    tasks = [ (inputfile, outputdir)  for inputfile in inputfiles ]
+    _initworker(recipe)   # a recipe that doesn't load fails here, rather than in each worker
+    if jobs <= 1 or len(tasks) <= 1:
+        return [ bakeonefile(*task)  for task in tasks ]
+
+    # worker processes live for the whole run so their imports and recipe are warm after the first file.
+    # When one dies the pool is broken, so the files in hand are each rerun alone to find which one did it
+    # (and fail it) before a new pool carries on with the rest
+    results = [ None ]*len(tasks)
+    pending = list(range(len(tasks)))
+    while pending:
+        suspects = runpool(recipe, tasks, pending, jobs, results)
+        for i in suspects:
+            stime = time.time()
+            runpool(recipe, tasks, [ i ], 1, results)
+            if results[i] is None:
+                results[i] = diedrow(tasks[i][0], outputdir, time.time() - stime)
+        pending = [ i  for i in pending  if results[i] is None ]
+    return results
+
+
+def writesummary(summaryfile, summary):
+    with open(summaryfile, "w", newline='', encoding='utf-8') as fout:
+        csv_writer = csv.DictWriter(fout, ["inputfile", "outputfile", "status", "seconds"])
+        csv_writer.writeheader()
+        csv_writer.writerows(summary)
+
+
+def main(argv=sys.argv[1:]):
+    args = docopt(__doc__, argv=argv)
+    inputfiles = expandinputfiles(args["<inputfiles>"])
+    summaryfile = os.path.abspath(os.path.join(args["--outputdir"], args["--summary"]))
+    clashes = outputclashes(inputfiles, os.path.abspath(args["--outputdir"]))
+    if clashes:
+        sys.exit(clashmessage(clashes))
+    stime = time.time()
+    summary = bakefiles(args["<recipe>"], inputfiles, args["--outputdir"], int(args["--jobs"]))
+
+    writesummary(summaryfile, summary)
+    for row in summary:
+        print("%8.2fs  %s  %s" % (row["seconds"], row["inputfile"], row["status"]))
+    nfailed = sum(1  for row in summary  if row["status"] != "ok")
+    print("%d files baked, %d failed, in %.2fs; summary in %s" % (len(summary), nfailed, time.time() - stime, summaryfile))
+    if nfailed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Fingerprints of loaded sheets, to tell between releases of a workbook which
+sheets are unchanged, which have only gained rows or columns and which
+have changed cells, so that only those need re-baking.
+
+    fingerprints = workbookfingerprint(loadxlstabs(inputfile))
+    savefingerprints(outputfile + FINGERPRINTSUFFIX, fingerprints)
+    ...
+    changes = comparefingerprints(loadfingerprints(oldoutputfile + FINGERPRINTSUFFIX), workbookfingerprint(tabs))
+    rebake = [ name  for name, change in changes.items()  if change.status != "identical" ]
+
+A sheet's fingerprint is a hash of each row and of each column, made from
+the values, value types and styles (format string, date, bold, italic) of
+their cells.  A row's hash leaves out its y and a column's its x, so rows
+or columns inserted or appended leave the hashes of the rest the same, and
+comparing two sheets is a diff of their row hashes and of their column
+hashes.
+"""
+
+import json, hashlib, difflib
+from databaker.sharedtabs import cellstyle, cellstylekey
+
+FINGERPRINTFORMAT = 1
+FINGERPRINTSUFFIX = ".fingerprint.json"
+HASHBYTES = 8
+
+# status of a sheet in comparefingerprints
+STATUSES = [ "identical", "rowsadded", "columnsadded", "changed", "added", "removed" ]
+
+
+def linehash(items):
+    "Hash of the (position, cell text) items of a row or column"
+    return hashlib.blake2b(repr(sorted(items)).encode("utf-8", "surrogatepass"), digest_size=HASHBYTES).hexdigest()
+
+
+class SheetFingerprint:
+    "Row and column hashes of a sheet, indexed by y and x (with the hash of no cells for empty ones)"
+    def __init__(self, name, rows, columns):
+        self.name = name
+        self.rows = rows
+        self.columns = columns
+        self.digest = hashlib.blake2b(repr((name, rows, columns)).encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+    @classmethod
+    def fromtab(cls, tab):
+        rowitems, columnitems = { }, { }
+        styletexts = { }   # cellstylekey -> repr of its style, so each style is read once
+        for cell in tab.unordered_cells:
+            key = cellstylekey(cell)
+            styletext = styletexts.get(key)  if key is not None  else None
+            if styletext is None:
+                styletext = repr(cellstyle(cell))
+                if key is not None:
+                    styletexts[key] = styletext
+            text = "%s|%r|%s" % (type(cell.value).__name__, cell.value, styletext)
+            rowitems.setdefault(cell.y, [ ]).append((cell.x, text))
+            columnitems.setdefault(cell.x, [ ]).append((cell.y, text))
+        emptyhash = linehash([ ])
+        rows = [ (linehash(rowitems[y])  if y in rowitems  else emptyhash)  for y in range(max(rowitems, default=-1) + 1) ]
+        columns = [ (linehash(columnitems[x])  if x in columnitems  else emptyhash)  for x in range(max(columnitems, default=-1) + 1) ]
+        return cls(tab.name, rows, columns)
+
+    def todict(self):
+        return { "rows":self.rows, "columns":self.columns, "digest":self.digest }
+
+    @classmethod
+    def fromdict(cls, name, d):
+        return cls(name, d["rows"], d["columns"])
+
+    def __repr__(self):
+        return "<SheetFingerprint %s %d rows %d columns %s>" % (self.name, len(self.rows), len(self.columns), self.digest[:12])
+
+
+def sheetfingerprint(tab):
+    "SheetFingerprint of a loaded tab"
+    return SheetFingerprint.fromtab(tab)
+
+def workbookfingerprint(tabs):
+    "{ sheet name: SheetFingerprint } of loaded tabs"
+    return dict((tab.name, SheetFingerprint.fromtab(tab))  for tab in tabs)
+
+
+def savefingerprints(filename, fingerprints):
+    "Write the fingerprints of a workbook to a JSON file, eg next to its output as output + FINGERPRINTSUFFIX"
+    with open(filename, "w", encoding="utf-8") as fout:
+        json.dump({ "format":FINGERPRINTFORMAT, "sheets":dict((name, fingerprint.todict())  for name, fingerprint in fingerprints.items()) }, fout)
+
+def loadfingerprints(filename):
+    with open(filename, encoding="utf-8") as fin:
+        d = json.load(fin)
+    if d.get("format") != FINGERPRINTFORMAT:
+        raise ValueError("%s has fingerprints in format %r rather than %d" % (filename, d.get("format"), FINGERPRINTFORMAT))
+    return dict((name, SheetFingerprint.fromdict(name, sd))  for name, sd in d["sheets"].items())
+
+
+def linechanges(old, new):
+    "(positions in new of lines not in old, positions in old of lines not in new, positions in new of lines that replaced others)"
+    added, removed, replaced = [ ], [ ], [ ]
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag == "insert":
+            added.extend(range(j1, j2))
+        elif tag == "delete":
+            removed.extend(range(i1, i2))
+        elif tag == "replace":
+            replaced.extend(range(j1, j2))
+            removed.extend(range(i1, i2))
+    return added, removed, replaced
+
+
+class SheetChange:
+    """How a sheet differs between two fingerprints: its status (one of STATUSES) and the ys and xs
+       of the rows and columns added, removed and changed (changed cells lie where changed rows and columns cross)"""
+    def __init__(self, name, old, new):
+        self.name = name
+        self.addedrows, self.removedrows, self.changedrows = [ ], [ ], [ ]
+        self.addedcolumns, self.removedcolumns, self.changedcolumns = [ ], [ ], [ ]
+        if old is None or new is None:
+            self.status = "added"  if old is None  else "removed"
+        elif old.digest == new.digest:
+            self.status = "identical"
+        else:
+            self.addedrows, self.removedrows, self.changedrows = linechanges(old.rows, new.rows)
+            self.addedcolumns, self.removedcolumns, self.changedcolumns = linechanges(old.columns, new.columns)
+            if not self.removedrows and not self.changedrows and self.addedrows:
+                self.status = "rowsadded"
+            elif not self.removedcolumns and not self.changedcolumns and self.addedcolumns:
+                self.status = "columnsadded"
+            else:
+                self.status = "changed"
+
+    def __repr__(self):
+        if self.status in ("rowsadded", "columnsadded"):
+            added = self.addedrows  if self.status == "rowsadded"  else self.addedcolumns
+            return "<SheetChange %s %s: %d at %s>" % (self.name, self.status, len(added), added[:10])
+        if self.status == "changed":
+            return "<SheetChange %s changed: rows %s columns %s>" % (self.name, (self.changedrows + self.addedrows)[:10], (self.changedcolumns + self.addedcolumns)[:10])
+        return "<SheetChange %s %s>" % (self.name, self.status)
+
+
+def comparefingerprints(old, new):
+    "{ sheet name: SheetChange } between the fingerprints of two versions of a workbook, in the order of the new one"
+    names = list(new) + [ name  for name in old  if name not in new ]
+    return dict((name, SheetChange(name, old.get(name), new.get(name)))  for name in names)
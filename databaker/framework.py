@@ -4,21 +4,63 @@ import xypath.loader
 import databaker.constants
 from databaker.constants import *      # also brings in template
 import databaker.overrides as overrides       # warning: injects additional class functions into xypath and messytables
+import databaker.xlsxloader as xlsxloader
+import databaker.xlsloader as xlsloader
 
 # core classes and functionality
 from databaker.jupybakeutils import HDim, HDimConst, ConversionSegment, Ldatetimeunitloose, Ldatetimeunitforce, pdguessforceTIMEUNIT
-from databaker.jupybakecsv import writetechnicalCSV, readtechnicalCSV
+from databaker.jupybakecsv import writetechnicalCSV, readtechnicalCSV, TechnicalCSVWriter, itertechnicalCSV
 from databaker.jupybakehtml import savepreviewhtml
+from databaker.bakecontext import BakeContext, bakelocal
+from databaker.segmentcache import SegmentCache
+from databaker.sharedtabs import SharedTables, attachtables
+from databaker.memtrack import MemoryTracker, MemoryBudgetExceeded, memorystage
+from databaker.bakeestimate import estimatebake, schedulesegments
+from databaker.parallelbake import processsegments
+from databaker.keycheck import DuplicateKeyChecker, checkduplicatekeys
+from databaker.valuepool import ValuePool
+from databaker.fingerprint import workbookfingerprint, comparefingerprints, savefingerprints, loadfingerprints, FINGERPRINTSUFFIX
 
 # this lot should be deprecated
 from databaker.jupybakecsv import headersfromwdasegment, extraheaderscheck, checktheconstantdimensions, checksegmentobsvalues
 from databaker.jupybakecsv import wdamsgstrings, CompareConversionSegments
 
-def loadxlstabs(inputfile, sheetids="*", verbose=True):
+
+def readxlstabs(inputfile, sheetids="*", backend="messytables"):
+    "The selected sheets of a spreadsheet as xypath tables, read with the given loadxlstabs backend"
+    if backend == "xlsx":
+        return list(xlsxloader.loadxlsxtables(inputfile, sheetids))
+    elif backend == "xlrd":
+        return list(xlsloader.loadxlstables(inputfile, sheetids))
+    elif backend == "messytables":
+        tableset = xypath.loader.table_set(inputfile, extension='xls')
+        return list(xypath.loader.get_sheets(tableset, sheetids))
+    raise ValueError("Unknown loadxlstabs backend %r (should be 'messytables', 'xlrd' or 'xlsx')" % backend)
+
+def selectsheets(tabs, sheetids="*"):
+    "The tables with the given names (in workbook order)"
+    if sheetids == "*":
+        return list(tabs)
+    names = set(sid.strip()  for sid in ([ sheetids ]  if isinstance(sheetids, str)  else sheetids))
+    return [ tab  for tab in tabs  if tab.name.strip() in names ]
+
+def loadxlstabs(inputfile, sheetids="*", verbose=True, backend="messytables", memorytracker=None):
+    """Load the selected sheets of a spreadsheet as xypath tables.
+       backend="xlsx" streams .xlsx files with databaker.xlsxloader instead of
+       going through messytables and xlrd, which is much lighter on big workbooks,
+       and backend="xlrd" reads .xls files with databaker.xlsloader straight from xlrd.
+       A databaker.memtrack.MemoryTracker measures the loading as its "loadxlstabs" stage"""
     if verbose:
         print("Loading %s which has size %d bytes" % (inputfile, os.path.getsize(inputfile)))
-    tableset = xypath.loader.table_set(inputfile, extension='xls')
-    tabs = list(xypath.loader.get_sheets(tableset, sheetids))
+    workbookcache = getattr(bakelocal, "workbookcache", None)
+    with memorystage(memorytracker, "loadxlstabs", os.path.basename(inputfile)):
+        if workbookcache is not None:   # new tables made from the workbook the cache holds, so they are this bake's own
+            tabs = selectsheets(workbookcache.tables(inputfile, backend), sheetids)
+        else:
+            tabs = readxlstabs(inputfile, sheetids, backend)
+            valuepool = ValuePool()   # for the segments made without a context, freed with the tables
+            for tab in tabs:
+                tab.valuepool = valuepool
     tabnames = [ tab.name  for tab in tabs ]
     if verbose:
         print("Table names: %s" % str(tabnames))
@@ -54,6 +96,9 @@ def getinputfilename():
     This way, we can set the filename in the notebook, or at the commmand line
     with environment variables.
     """
+    inputfile = getattr(bakelocal, "inputfile", None)
+    if inputfile is not None:   # baking in databaker.bakeservice
+        return inputfile
     try:
         return os.environ['DATABAKER_INPUT_FILE']
     except KeyError as e:
@@ -4,15 +4,19 @@
 import io, os, collections, re, warnings, csv, datetime
 import databaker.constants
 from databaker.jupybakeutils import ConversionSegment
-template = databaker.constants.template
+from databaker.lazyimport import LazyModule
+from databaker.bakecontext import defaultcontext
+from databaker.valuepool import MISSING
+from databaker.memtrack import memorystage
+template = databaker.constants.template   # kept for old code; use a BakeContext instead
 
-try:   import pandas
-except ImportError:  pandas = None  # no pandas in pypy
+pandas = LazyModule("pandas")  # imported on first use; false if not installed (eg pypy)
 
-def HLDUPgenerate_header_row(numheaderadditionals):
-    res = [ (k[0] if isinstance(k, tuple) else k)  for k in template.headermeasurements ]
+def HLDUPgenerate_header_row(numheaderadditionals, context=None):
+    context = context if context is not None else defaultcontext
+    res = [ (k[0] if isinstance(k, tuple) else k)  for k in context.headermeasurements ]
     for i in range(numheaderadditionals):
-        for k in template.headeradditionals:
+        for k in context.headeradditionals:
             if isinstance(k, tuple):
                 sk = k[0]
             else:
@@ -22,17 +26,18 @@ def HLDUPgenerate_header_row(numheaderadditionals):
 
 
 
-def Lyield_dimension_values(dval, isegmentnumber, Cheaderadditionals):
-    for k in template.headermeasurements:
+def Lyield_dimension_values(dval, isegmentnumber, Cheaderadditionals, context=None):
+    context = context if context is not None else defaultcontext
+    for k in context.headermeasurements:
         if isinstance(k, tuple):
             yield dval.get(k[1], '')
-        elif k == template.conversionsegmentnumbercolumn:
+        elif k == context.conversionsegmentnumbercolumn:
             yield isegmentnumber
         else:
             yield ''
             
     for dlab in Cheaderadditionals:
-        for k in template.headeradditionals:
+        for k in context.headeradditionals:
             if isinstance(k, tuple):
                 if k[1] == "NAME":
                     yield dlab
@@ -43,89 +48,297 @@ def Lyield_dimension_values(dval, isegmentnumber, Cheaderadditionals):
                 yield ''
 
 
-def writetechnicalCSV(outputfile, conversionsegments):
-    "Output the CSV into the bloated WDA format (takes lists of conversionsegments or pandas tables)"
-    if not isinstance(conversionsegments, (list, tuple)):
-        conversionsegments = [ conversionsegments ]
-        
-    if outputfile is not None:
-        print("writing %d conversion segments into %s" % (len(conversionsegments), os.path.abspath(outputfile)))
+def Lyield_segment_rows(conversionsegment, isegmentnumber, Cheaderadditionals, context=None, rowids=None):
+    """Output rows of a processed ConversionSegment read straight from its pooled rowids (or the given rowids, 
+       eg from iterprocess()), as Lyield_dimension_values would give them"""
+    context = context if context is not None else defaultcontext
+    icolumns = dict((col, i)  for i, col in enumerate(conversionsegment.rowcolumns))
+    rawcolumns = conversionsegment.rawcolumns
+    values = conversionsegment.valuepool.values   # rows still being made intern new values as they go
+    
+    # (column index, whether it's pooled) for each output column, or None where it is a constant
+    layout, constants = [ ], [ ]
+    for k in context.headermeasurements:
+        if isinstance(k, tuple) and k[1] in icolumns:
+            layout.append((icolumns[k[1]], icolumns[k[1]] not in rawcolumns))
+        else:
+            layout.append(None)
+        constants.append(isegmentnumber  if k == context.conversionsegmentnumbercolumn  else '')
+    for dlab in Cheaderadditionals:
+        for k in context.headeradditionals:
+            if isinstance(k, tuple) and k[1] != "NAME":
+                assert k[1] == "VALUE"
+                layout.append((icolumns[dlab], icolumns[dlab] not in rawcolumns))
+            else:
+                layout.append(None)
+            constants.append(dlab  if isinstance(k, tuple) and k[1] == "NAME"  else '')
+    
+    for row in (conversionsegment.rowids  if rowids is None  else rowids):
+        yield [ (c  if l is None  else ((values[row[l[0]]]  if row[l[0]] != MISSING  else '')  if l[1]  else row[l[0]]))  for l, c in zip(layout, constants) ]
+
+
+def pdcolumn(col):
+    # to_csv writes plain numpy number, bool and object columns as csv.writer would write their values; dates,
+    # categoricals and other extension types have their own formatting, so go through python objects like a row did
+    if col.dtype.kind in "biufcO" and not pandas.api.types.is_extension_array_dtype(col.dtype):
+        return col
+    return col.astype(object)
+
+def pdsegmentframe(df, isegmentnumber, Cheaderadditionals, context=None):
+    "The WDA columns for a DataFrame of observations, made by whole column operations in the order of HLDUPgenerate_header_row"
+    context = context if context is not None else defaultcontext
+    cols = { }
+    for k in context.headermeasurements:
+        if isinstance(k, tuple):
+            cols[len(cols)] = pdcolumn(df[k[1]])  if k[1] in df.columns  else ''
+        elif k == context.conversionsegmentnumbercolumn:
+            cols[len(cols)] = isegmentnumber
+        else:
+            cols[len(cols)] = ''
+    for dlab in Cheaderadditionals:
+        for k in context.headeradditionals:
+            if isinstance(k, tuple):
+                if k[1] == "NAME":
+                    cols[len(cols)] = dlab
+                else:
+                    assert k[1] == "VALUE"
+                    cols[len(cols)] = pdcolumn(df[dlab])
+            else:
+                cols[len(cols)] = ''
+    return pandas.DataFrame(cols, index=df.index)
+
+
+PDWRITE_CHUNKSIZE = 50000
+
+def pdwritesegment(filehandle, df, isegmentnumber, Cheaderadditionals, context=None, chunksize=PDWRITE_CHUNKSIZE):
+    "Write the WDA rows of a DataFrame in chunks with to_csv, matching what csv.writer makes of each row with its NaNs dropped"
+    rowdtype = df.iloc[:0].values.dtype
+    if rowdtype != object:   # a row of an all numeric frame comes out in one common type (eg a Year of ints as floats)
+        df = df.astype(rowdtype)
+    for i in range(0, len(df), chunksize):
+        frame = pdsegmentframe(df.iloc[i:i+chunksize], isegmentnumber, Cheaderadditionals, context)
         try:
-            filehandle = open(outputfile, "w", newline='\n', encoding='utf-8')
-        except TypeError:  # this happens if you run in pypy2 because the newline parameter is not recognized
-            filehandle = open(outputfile, "w")
-    else:
-        filehandle = io.StringIO()  # to return as string for print preview perhaps
-    csv_writer = csv.writer(filehandle)
-    row_count = 0
-        
-    for isegmentnumber, conversionsegment in enumerate(conversionsegments):
-        if isegmentnumber == 0:   # only first segment gets a CSV header for the whole file (even if it is not consistent for the remaining segments)
+            frame.to_csv(filehandle, header=False, index=False, lineterminator='\r\n')
+        except TypeError:   # pandas before 1.5
+            frame.to_csv(filehandle, header=False, index=False, line_terminator='\r\n')
+
+
+WDA_TAILSTEP = 65536   # bytes read back at a time from the end of a file being appended to
+
+def lastwdarow(fin, start, end, nfields):
+    "The last row of a WDA file between byte offsets start and end, found by parsing forward from successive line starts back from the end"
+    pos = end
+    while pos > start:
+        pos = max(start, pos - WDA_TAILSTEP)
+        fin.seek(pos)
+        chunk = fin.read(end - pos)
+        linestarts = [ j + 1  for j in range(len(chunk) - 2, -1, -1)  if chunk[j:j+1] == b"\n" ]
+        if pos == start:
+            linestarts.append(0)
+        for j in linestarts:   # a line start inside a quoted field won't parse to one row of the right width
+            rows = list(csv.reader(io.StringIO(chunk[j:].decode("utf-8"), newline='')))
+            if len(rows) == 1 and len(rows[0]) == nfields:
+                return rows[0]
+    return None
+
+
+class TechnicalCSVWriter:
+    """WDA file written a segment at a time (eg from a generator of ConversionSegments or DataFrames), 
+       with the header going in with the first segment and the ********* row count in close().  
+       append=True reopens an existing file to carry on after its last segment, rewriting only the ********* row.
+       outputfile is a filename, a file object to write into (eg a socket stream) or None to have close() return the text.  
+       A databaker.keycheck.DuplicateKeyChecker given as keychecker checks the rows of the segments as they are written"""
+    def __init__(self, outputfile, context=None, append=False, keychecker=None):
+        self.outputfile = outputfile
+        self.context = context   # otherwise taken from the first segment, as in writetechnicalCSV
+        self.keychecker = keychecker
+        self.row_count = 0
+        self.isegmentnumber = 0
+        self.bheaderwritten = False
+        self.Cheaderadditionals = None   # the dimension labels of the first segment, used for all of them
+        if outputfile is None:
+            self.filehandle = io.StringIO()  # to return as string for print preview perhaps
+        elif hasattr(outputfile, "write"):
+            assert not append, "can only append to a file given by its name"
+            self.filehandle = outputfile
+        else:
+            mode = "w"
+            if append and os.path.exists(outputfile):
+                self.truncatetrailer()
+                mode = "a"
+            try:
+                self.filehandle = open(outputfile, mode, newline='\n', encoding='utf-8')
+            except TypeError:  # this happens if you run in pypy2 because the newline parameter is not recognized
+                self.filehandle = open(outputfile, mode)
+        self.csv_writer = csv.writer(self.filehandle)
+
+    def truncatetrailer(self):
+        "Pick up the row count, next segment number and dimension labels of an existing file and cut off its ********* row"
+        context = self.context if self.context is not None else defaultcontext
+        with open(self.outputfile, "rb+") as fin:
+            fin.seek(0, os.SEEK_END)
+            pos = fin.tell()
+            tail = b""
+            while True:
+                step = min(pos, WDA_TAILSTEP)
+                pos -= step
+                fin.seek(pos)
+                tail = fin.read(step) + tail
+                i = tail.rfind(b"*********,")
+                if i != -1 and (pos + i == 0 or tail[i-1:i] == b"\n"):
+                    break
+                if pos == 0:
+                    raise ValueError("%s has no ********* row to append after" % self.outputfile)
+            trailerpos = pos + i
+            self.row_count = int(tail[i:].decode("utf-8").split(",")[1])
+            
+            fin.seek(0)
+            headerline = fin.readline()
+            if trailerpos != 0:
+                self.bheaderwritten = True
+                wdaheaders = next(csv.reader([ headerline.decode("utf-8") ]))
+                lastrow = lastwdarow(fin, len(headerline), trailerpos, len(wdaheaders))
+                if lastrow is not None:
+                    numheaderadditionals = (len(wdaheaders) - len(context.headermeasurements))//len(context.headeradditionals)
+                    iname = [ i  for i, k in enumerate(context.headeradditionals)  if isinstance(k, tuple) and k[1] == "NAME" ][0]
+                    self.Cheaderadditionals = [ lastrow[len(context.headermeasurements) + i*len(context.headeradditionals) + iname]  for i in range(numheaderadditionals) ]
+                    isegmentcol = [ i  for i, k in enumerate(context.headermeasurements)  if k == context.conversionsegmentnumbercolumn ]
+                    if isegmentcol and lastrow[isegmentcol[0]]:
+                        self.isegmentnumber = int(lastrow[isegmentcol[0]]) + 1
+            fin.truncate(trailerpos)
+
+    def addsegment(self, conversionsegment):
+        "Write the rows of a ConversionSegment (processing it if it has not been) or a DataFrame"
+        if self.context is None:
+            self.context = conversionsegment.context  if isinstance(conversionsegment, ConversionSegment)  else defaultcontext
+        context = self.context
+        isegmentnumber = self.isegmentnumber
+        if self.Cheaderadditionals is None:   # only first segment gets a CSV header for the whole file (even if it is not consistent for the remaining segments)
             if isinstance(conversionsegment, ConversionSegment):
-                Cheaderadditionals = [ dimension.label  for dimension in conversionsegment.dimensions  if dimension.label not in template.headermeasurementnamesSet ]
+                Cheaderadditionals = [ dimension.label  for dimension in conversionsegment.dimensions  if dimension.label not in context.headermeasurementnamesSet ]
                 assert len(Cheaderadditionals) == conversionsegment.numheaderadditionals
-            elif pandas is not None:
+            elif pandas:
                 assert isinstance(conversionsegment, pandas.DataFrame), "function takes only ConversionSegments of pandas.DataFrames"
                 if not isinstance(conversionsegment.index, pandas.RangeIndex):
                     conversionsegment = conversionsegment.reset_index()  # in case of playing around with indexes
-                Cheaderadditionals = [colname  for colname in conversionsegment.columns  if colname not in template.headermeasurementnamesSet and colname[:2] != "__"]
-            csv_writer.writerow(HLDUPgenerate_header_row(len(Cheaderadditionals)))
+                Cheaderadditionals = [colname  for colname in conversionsegment.columns  if colname not in context.headermeasurementnamesSet and colname[:2] != "__"]
+            self.Cheaderadditionals = Cheaderadditionals
+            if not self.bheaderwritten:
+                self.csv_writer.writerow(HLDUPgenerate_header_row(len(Cheaderadditionals), context))
+                self.bheaderwritten = True
+        Cheaderadditionals = self.Cheaderadditionals
 
+        memorytracker = context.memorytracker
         if isinstance(conversionsegment, ConversionSegment):
+            if not conversionsegment.isprocessed() and memorytracker is not None and memorytracker.streaming():
+                self.streamsegment(conversionsegment)
+                return
+
             timeunitmessage = ""
-            if conversionsegment.processedrows is None: 
+            if not conversionsegment.isprocessed(): 
                 timeunitmessage = conversionsegment.process()  
 
-            if outputfile is not None:
-                print("conversionwrite segment size %d table '%s'; %s" % (len(conversionsegment.processedrows), conversionsegment.tab.name, timeunitmessage))
-            for row in conversionsegment.processedrows:
-                csv_writer.writerow(Lyield_dimension_values(row, isegmentnumber, Cheaderadditionals))
-                row_count += 1
+            if isinstance(self.outputfile, str):
+                print("conversionwrite segment size %d table '%s'; %s" % (conversionsegment.numprocessedrows(), conversionsegment.tab.name, timeunitmessage))
+            with memorystage(memorytracker, "write", conversionsegment.tab.name, conversionsegment.numprocessedrows()):
+                if conversionsegment.rowids is not None:
+                    self.csv_writer.writerows(Lyield_segment_rows(conversionsegment, isegmentnumber, Cheaderadditionals, context))
+                else:
+                    for row in conversionsegment.processedrows:
+                        self.csv_writer.writerow(Lyield_dimension_values(row, isegmentnumber, Cheaderadditionals, context))
+            self.row_count += conversionsegment.numprocessedrows()
+            if self.keychecker is not None:
+                if conversionsegment.rowids is not None:
+                    self.keychecker.addsegment(conversionsegment)
+                else:
+                    warnings.warn("Keys of segment of table '%s' not checked as its rows were made into dicts" % conversionsegment.tab.name)
 
         else:  # pandas.Dataframe case
-            assert pandas is not None
-            if outputfile is not None:
+            assert pandas
+            if isinstance(self.outputfile, str):
                 print("pdconversionwrite segment size %d" % (len(conversionsegment)))
-            for i in range(len(conversionsegment)):  # quick and dirty to use same dict-based function
-                csv_writer.writerow(Lyield_dimension_values(dict(conversionsegment.iloc[i].dropna()), isegmentnumber, Cheaderadditionals))
-                row_count += 1
+            with memorystage(memorytracker, "write", None, len(conversionsegment)):
+                pdwritesegment(self.filehandle, conversionsegment, isegmentnumber, Cheaderadditionals, context)
+            self.row_count += len(conversionsegment)
+            if self.keychecker is not None:
+                warnings.warn("Keys of DataFrame segments are not checked")
+        self.isegmentnumber += 1
 
-    csv_writer.writerow(["*"*9, row_count])
-    if outputfile is not None:
-        filehandle.close()
-    else:
-        return filehandle.getvalue()
+    def streamsegment(self, conversionsegment):
+        "Write an unprocessed ConversionSegment as its rows are looked up, without keeping them (once the bake is far into its memory budget)"
+        context = self.context
+        with memorystage(context.memorytracker, "stream", conversionsegment.tab.name, len(conversionsegment.obslist)):
+            rowids = conversionsegment.iterprocess()
+            if self.keychecker is not None:
+                rowids = self.keychecker.checkrows(conversionsegment, rowids)
+            nrows = 0
+            for row in Lyield_segment_rows(conversionsegment, self.isegmentnumber, self.Cheaderadditionals, context, rowids):
+                self.csv_writer.writerow(row)
+                nrows += 1
+        if isinstance(self.outputfile, str):
+            print("conversionwrite streamed segment size %d table '%s'; %s" % (nrows, conversionsegment.tab.name, conversionsegment.timeunitmessage))
+        self.row_count += nrows
+        self.isegmentnumber += 1
 
+    def close(self):
+        "Finish the file with the ********* row count (returning the text if there is no outputfile)"
+        self.csv_writer.writerow(["*"*9, self.row_count])
+        if isinstance(self.outputfile, str):
+            self.filehandle.close()
+        elif self.outputfile is None:
+            return self.filehandle.getvalue()
 
+    def __enter__(self):
+        return self
 
-def readtechnicalCSV(wdafile, bverbose=False, baspandas=True):
-    if baspandas and pandas is None:
-        baspandas = False
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif isinstance(self.outputfile, str):   # leave it without a count row, so it can't be taken as complete
+            self.filehandle.close()
+
+
+def writetechnicalCSV(outputfile, conversionsegments, context=None, keychecker=None):
+    "Output the CSV into the bloated WDA format (takes lists of conversionsegments or pandas tables), checking the keys with any keychecker"
+    if not isinstance(conversionsegments, (list, tuple)):
+        conversionsegments = [ conversionsegments ]
+    if context is None:   # take the template from the segments themselves if we can
+        context = conversionsegments[0].context  if conversionsegments and isinstance(conversionsegments[0], ConversionSegment)  else defaultcontext
         
-    "Read a WDA CSV back from its file into an lookup table from segment number to (each a list of dicts)"
+    if outputfile is not None:
+        print("writing %d conversion segments into %s" % (len(conversionsegments), os.path.abspath(outputfile)))
+    writer = TechnicalCSVWriter(outputfile, context, keychecker=keychecker)
+    for conversionsegment in conversionsegments:
+        writer.addsegment(conversionsegment)
+    return writer.close()
+
+
+
+def wdafilehandle(wdafile):
+    "A WDA file given as its name, its text or a StringIO"
     if isinstance(wdafile, str):
         if len(wdafile) > 200 and '\n' in wdafile:
-            filehandle = io.StringIO(wdafile)
-        else:
-            filehandle = open(wdafile, "r", encoding='utf-8')
-    else:
-        assert isinstance(wdafile, io.StringIO)
-        filehandle = wdafile
-        
+            return io.StringIO(wdafile)
+        return open(wdafile, "r", encoding='utf-8')
+    assert isinstance(wdafile, io.StringIO)
+    return wdafile
+
+def Lyield_wda_rows(filehandle, context=None):
+    "(segment number, dimension names, dict of values) for each row of a WDA file, checking the ********* row count at the end"
+    context = context if context is not None else defaultcontext
     wdain = csv.reader(filehandle)
     # First check that the headers are what we expect
     wdaheaders = wdain.__next__()
-    numheaderadditionals = (len(wdaheaders) - len(template.headermeasurements))//len(template.headeradditionals)
-    if not (wdaheaders == HLDUPgenerate_header_row(numheaderadditionals)):
+    numheaderadditionals = (len(wdaheaders) - len(context.headermeasurements))//len(context.headeradditionals)
+    if not (wdaheaders == HLDUPgenerate_header_row(numheaderadditionals, context)):
         print("WDA heades don't match.  nothing is likely to work now")
         
-    wdasegments = { }             # { segmentnumber: ( [ data_dicts ], [ordered_header_list] ) }
-    previsegmentnumber = None
+    segmentheaders = { }          # { segmentnumber: [ordered_header_list] }
     segmentheaderssegmentL = [ ]  # [ [ordered_header_list] ]
+    nrows = 0
     
     for row in wdain:
         if row[0] == '*********':
-            nrows = sum(len(wdasegment)  for wdasegment, segmentheaders in wdasegments.values())
             if int(row[1]) != nrows:
                 warnings.warn("row number doesn't match %d should be %d" % (int(row[1]), nrows))
             assert len(list(wdain)) == 0, "***** must be on last row"
@@ -133,7 +346,7 @@ def readtechnicalCSV(wdafile, bverbose=False, baspandas=True):
 
         dval = { }
         isegmentnumber = None
-        for r, k in zip(row, template.headermeasurements):
+        for r, k in zip(row, context.headermeasurements):
             if isinstance(k, tuple):
                 nk = k[1]
                 if r:
@@ -141,20 +354,20 @@ def readtechnicalCSV(wdafile, bverbose=False, baspandas=True):
                     dval[nk] = r
                 else:
                     assert not dval.get(nk)
-            elif k == template.conversionsegmentnumbercolumn and r:
+            elif k == context.conversionsegmentnumbercolumn and r:
                 isegmentnumber = int(r)
             else:
                 assert not r
                 
-        lnumheaderadditionals = (len(row) - len(template.headermeasurements))
-        assert lnumheaderadditionals % len(template.headeradditionals) == 0
-        numheaderadditionals = lnumheaderadditionals//len(template.headeradditionals)
+        lnumheaderadditionals = (len(row) - len(context.headermeasurements))
+        assert lnumheaderadditionals % len(context.headeradditionals) == 0
+        numheaderadditionals = lnumheaderadditionals//len(context.headeradditionals)
         
         segmentheaderssegmentJ = [ ]  
         for i in range(numheaderadditionals):
             rname, rvalue = None, None
-            i0 = len(template.headermeasurements) + i*len(template.headeradditionals)
-            for r, k in zip(row[i0:i0+len(template.headeradditionals)], template.headeradditionals):
+            i0 = len(context.headermeasurements) + i*len(context.headeradditionals)
+            for r, k in zip(row[i0:i0+len(context.headeradditionals)], context.headeradditionals):
                 if isinstance(k, tuple):
                     if k[1] == "NAME":
                         assert rname is None or rname == r, (rname, r)
@@ -173,13 +386,49 @@ def readtechnicalCSV(wdafile, bverbose=False, baspandas=True):
             if not segmentheaderssegmentL or segmentheaderssegmentL[-1] != segmentheaderssegmentJ:
                 segmentheaderssegmentL.append(segmentheaderssegmentJ)
             isegmentnumber = len(segmentheaderssegmentL) - 1
-        elif isegmentnumber in wdasegments:
-            assert wdasegments[isegmentnumber][1] == segmentheaderssegmentJ
-                
+        elif isegmentnumber in segmentheaders:
+            assert segmentheaders[isegmentnumber] == segmentheaderssegmentJ
+        segmentheaders.setdefault(isegmentnumber, segmentheaderssegmentJ)
+        
+        nrows += 1
+        yield isegmentnumber, segmentheaders[isegmentnumber], dval
+
+def wdasegmenttopandas(wdasegment, segmentheaders, context=None):
+    "DataFrame of the list of dicts of a WDA segment, with its columns in order"
+    context = context if context is not None else defaultcontext
+    df = pandas.DataFrame.from_dict(wdasegment)
+    
+    # sort the columns (problem with using from_dict)
+    dfcols = list(df.columns)
+    newdfcols = [ ]
+    for k in context.headermeasurements:
+        if isinstance(k, tuple):
+            if k[1] in dfcols:
+                newdfcols.append(k[1])
+                dfcols.remove(k[1])
+    for segmentheader in segmentheaders:
+        assert segmentheader in dfcols
+        newdfcols.append(segmentheader)
+        dfcols.remove(segmentheader)
+    assert not dfcols, ("unexplained extra columns", dfcols)
+    
+    return df[newdfcols]   # map the new column list in
+
+
+def readtechnicalCSV(wdafile, bverbose=False, baspandas=True, context=None):
+    if baspandas and not pandas:
+        baspandas = False
+    context = context if context is not None else defaultcontext
+        
+    "Read a WDA CSV back from its file into an lookup table from segment number to (each a list of dicts)"
+    filehandle = wdafilehandle(wdafile)
+    wdasegments = { }             # { segmentnumber: ( [ data_dicts ], [ordered_header_list] ) }
+    previsegmentnumber = None
+    for isegmentnumber, segmentheaders, dval in Lyield_wda_rows(filehandle, context):
         if isegmentnumber not in wdasegments:
             if bverbose and previsegmentnumber is not None:
                 print("segment %d loaded with %d rows" % (previsegmentnumber, len(wdasegments[previsegmentnumber][0])))
-            wdasegments[isegmentnumber] = ([ ], segmentheaderssegmentJ)
+            wdasegments[isegmentnumber] = ([ ], segmentheaders)
             
         wdasegments[isegmentnumber][0].append(dval)
         previsegmentnumber = isegmentnumber
@@ -189,27 +438,27 @@ def readtechnicalCSV(wdafile, bverbose=False, baspandas=True):
     
     if not baspandas:
         return [ wdasegment  for wdasegment, segmentheaders in wdasegments.values() ]
-    
-    res = [ ]
-    for wdasegment, segmentheaders in wdasegments.values():
-        df = pandas.DataFrame.from_dict(wdasegment)
-        
-        # sort the columns (problem with using from_dict)
-        dfcols = list(df.columns)
-        newdfcols = [ ]
-        for k in template.headermeasurements:
-            if isinstance(k, tuple):
-                if k[1] in dfcols:
-                    newdfcols.append(k[1])
-                    dfcols.remove(k[1])
-        for segmentheader in segmentheaders:
-            assert segmentheader in dfcols
-            newdfcols.append(segmentheader)
-            dfcols.remove(segmentheader)
-        assert not dfcols, ("unexplained extra columns", dfcols)
-        
-        res.append(df[newdfcols])   # map the new column list in
-    return res
+    return [ wdasegmenttopandas(wdasegment, segmentheaders, context)  for wdasegment, segmentheaders in wdasegments.values() ]
+
+
+def itertechnicalCSV(wdafile, baspandas=True, context=None):
+    """Read a WDA CSV a segment at a time, yielding each (as a DataFrame, or a list of dicts) once its rows are read, 
+       so only one is held in memory.  Segments are taken as runs of rows, so one that is split up comes out in parts"""
+    if baspandas and not pandas:
+        baspandas = False
+    filehandle = wdafilehandle(wdafile)
+    try:
+        wdasegment, previsegmentnumber, prevsegmentheaders = [ ], None, None
+        for isegmentnumber, segmentheaders, dval in Lyield_wda_rows(filehandle, context):
+            if wdasegment and isegmentnumber != previsegmentnumber:
+                yield wdasegmenttopandas(wdasegment, prevsegmentheaders, context)  if baspandas  else wdasegment
+                wdasegment = [ ]
+            wdasegment.append(dval)
+            previsegmentnumber, prevsegmentheaders = isegmentnumber, segmentheaders
+        if wdasegment:
+            yield wdasegmenttopandas(wdasegment, prevsegmentheaders, context)  if baspandas  else wdasegment
+    finally:
+        filehandle.close()
         
 
 
@@ -228,8 +477,9 @@ wdamsgstrings = {
     "EXTRAWDACONVERSIONSEGMENTS": "Extra conversion segments in wda file %s",
 }
 
-def headersfromwdasegment(wdaseg, msglist):
-    derivedheaders = [ databaker.constants.OBS ] + (template.SH_Create_ONS_time and [ databaker.constants.TIMEUNIT ] or []) + (databaker.constants.DATAMARKER and [databaker.constants.DATAMARKER] or [])
+def headersfromwdasegment(wdaseg, msglist, context=None):
+    context = context if context is not None else defaultcontext
+    derivedheaders = [ context.OBS ] + (context.SH_Create_ONS_time and [ context.TIMEUNIT ] or []) + (context.DATAMARKER and [context.DATAMARKER] or [])
     headersunion = None
     headersintersection = None
     for wdarow in wdaseg:
@@ -245,7 +495,7 @@ def headersfromwdasegment(wdaseg, msglist):
     return headersintersection
 
 def extraheaderscheck(conversionsegment, wdaseg, msglist):
-    wdaheaders = headersfromwdasegment(wdaseg, msglist)
+    wdaheaders = headersfromwdasegment(wdaseg, msglist, conversionsegment.context)
     segmentheaders = set([c.label  for c in conversionsegment.dimensions])
     extraheadersinsegment = segmentheaders.difference(wdaheaders)
     extraheadersinwdaseg = wdaheaders.difference(segmentheaders)
@@ -259,7 +509,7 @@ def checktheconstantdimensions(conversionsegment, headers, wdaseg, msglist):
     for dimension in conversionsegment.dimensions:
         if dimension.label in headers:
             if dimension.hbagset is None:
-                constval = dimension.cellvalueoverride.get(None)
+                constval = dimension.headcellval(None)
                 wdaconst = set(row.get(dimension.label)  for row in wdaseg)
                 if len(wdaconst) != 1:
                     msglist.append(("WDACOLUMNNOTCONSTANT", (dimension.label, wdaconst)))
@@ -298,15 +548,15 @@ def CompareConversionSegments(conversionsegments, wdafile, bprintwarnings):
         conversionsegments = [conversionsegments]
     
     msglistperseg = { }
-    wdasegs = readtechnicalCSV(wdafile, bverbose)
+    wdasegs = readtechnicalCSV(wdafile, bverbose, context=conversionsegments[0].context  if conversionsegments  else None)
     extracsegs = [ c  for c in wdasegs.keys()  if not 0<=c<len(conversionsegments) ]
     if extracsegs:
         msglistperseg[-1] = [ ("EXTRAWDACONVERSIONSEGMENTS", extracsegs) ]
     for isegmentnumber, conversionsegment in enumerate(conversionsegments):
         
-        if conversionsegment.processedrows is None: 
+        if not conversionsegment.isprocessed(): 
             timeunitmessage = conversionsegment.process()  
-            print("conversionwrite segment size %d table '%s; %s" % (len(conversionsegment.processedrows), conversionsegment.tab.name, timeunitmessage))
+            print("conversionwrite segment size %d table '%s; %s" % (conversionsegment.numprocessedrows(), conversionsegment.tab.name, timeunitmessage))
         
         msglist = [ ]
         wdaseg = wdasegs[isegmentnumber]
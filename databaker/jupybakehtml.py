@@ -1,17 +1,14 @@
 # encoding: utf-8
 
-import io, os, collections, re, warnings
+import io, os, collections, re, warnings, itertools
 
-try:
-    from IPython.display import display, FileLink
-    from IPython.core.display import HTML
-except ImportError:
-    display, FileLink, HTML = None, None, None
 import databaker.constants
+from databaker.lazyimport import LazyModule
+ipydisplay = LazyModule("IPython.display")  # only needed when actually displaying
 
 OBS = databaker.constants.OBS   # used to evaluate to -9, does to "OBS" now
 
-from databaker.jupybakeutils import HDim, ConversionSegment, svalue
+from databaker.jupybakeutils import HDim, ConversionSegment, svalues
 
 # copied out again
 def create_colourlist():
@@ -30,13 +27,24 @@ def create_colourlist():
     return colourlist
 colourlist = create_colourlist()
 
+def cellbold(c):
+    "Whether a cell is in a bold font, False when the file was read without font information"
+    try:
+        return c.properties.get_bold()
+    except (IndexError, AttributeError):  # overcome bug in messytables caused by https://www.communities-ni.gov.uk/sites/default/files/publications/communities/ni-housing-stats-15-16-tables1.xlsx
+        return False
 
+
+# next() on a count is atomic, so concurrent previews each get their own div id
+dividcounter = itertools.count(1001)
 ndividNUM = 1000
-dividNUM = "kkkk"
+dividNUM = "kkkk"   # the most recent div id, for sidewindowhtmldisplay()
 def incrementdividNUM():
     global ndividNUM, dividNUM
-    ndividNUM += 1
-    dividNUM = "injblock%d" % ndividNUM
+    lndividNUM = next(dividcounter)
+    ldividNUM = "injblock%d" % lndividNUM
+    ndividNUM, dividNUM = lndividNUM, ldividNUM
+    return ldividNUM
 
 def tabletohtml(tab, tsubs, consolidatedcellvalueoverride, blocalstylesheet):
     key = [ ]
@@ -82,32 +90,30 @@ def tabletohtml(tab, tsubs, consolidatedcellvalueoverride, blocalstylesheet):
         htm.append("<tr>")
         assert len(row) == tab._max_x + 1
         rrow = sorted(row, key=lambda X: X.x)
-        for c in rrow:
+        for c, csval in zip(rrow, svalues([ c._cell  for c in rrow ])):
             ih = ixyheaderlookup.get((c.x, c.y))
             if blocalstylesheet:
                 cs = [ ]
                 if ih is not None:             cs.append("xc%s" % ih)
-                if c.properties.cell.sheet.book.font_list:  # overcome bug in messytables caused by https://www.communities-ni.gov.uk/sites/default/files/publications/communities/ni-housing-stats-15-16-tables1.xlsx
-                    if c.properties.get_bold():    cs.append("xb")
+                if cellbold(c):                cs.append("xb")
                 if c.is_number():              cs.append("xn")
                 htm.append('<td class="%s" title="%d %d">' % (" ".join(cs), c.x, c.y))
             else:
                 ls = [ ]
                 if ih is not None:             ls.append("background-color:%s" % colourlist.get(ih,"white"))
-                if c.properties.cell.sheet.book.font_list:
-                    if c.properties.get_bold():    ls.append("font-weight:bold")
+                if cellbold(c):                ls.append("font-weight:bold")
                 lss = ' style="%s"' % ";".join(ls)  if ls  else ''
                 htm.append('<td%s title="%d %d">' % (lss, c.x, c.y))
                 
             if (c.x, c.y) in consolidatedcellvalueoverride:
-                prevcellval = svalue(c) or "*blank*" # want to see empty cells that have been overwritten
+                prevcellval = csval or "*blank*" # want to see empty cells that have been overwritten
                 overridecellval = consolidatedcellvalueoverride[(c.x, c.y)]
                 if blocalstylesheet:
                     htm.append('<span class="xo">%s</span><span class="xn">%s</span>' % (prevcellval, overridecellval))
                 else:
                     htm.append('<strike>%s</strike>%s' % (prevcellval, overridecellval))
             else:
-                htm.append(svalue(c))
+                htm.append(csval)
                 
             if (c.x, c.y) in consolidatedcellvalueoverride:
                 consolidatedcellvalueoverride
@@ -175,10 +181,10 @@ else
     alert("sidewindow didn't work"); 
 </script>
 '''
-    display(HTML(sjs % dividNUM))
+    ipydisplay.display(ipydisplay.HTML(sjs % dividNUM))
     
     
-def savepreviewhtml(conversionsegment, fname=None, verbose=True):
+def savepreviewhtml(conversionsegment, fname=None, verbose=True, context=None):
     "Preview a highlighted table, cellbag, dimension, list of bags or ConversionSegment inline or into a secondary html file"
     # wrap a singleton or list of bags, tables and HDims to a ConversionSegment
     if not isinstance(conversionsegment, ConversionSegment): 
@@ -207,10 +213,10 @@ def savepreviewhtml(conversionsegment, fname=None, verbose=True):
             if lhdim:
                 dimensions.append(lhdim)
                 
-        conversionsegment = ConversionSegment(tab, dimensions, [])
+        conversionsegment = ConversionSegment(tab, dimensions, [], context=context)
     
     # now we have a ConversionSegment
-    incrementdividNUM()
+    ldividNUM = incrementdividNUM()
     if fname is None:
         fout = io.StringIO()
         blocalstylesheet = not (len(conversionsegment.tab) < 1500)
@@ -220,23 +226,23 @@ def savepreviewhtml(conversionsegment, fname=None, verbose=True):
         blocalstylesheet = True
         
     htmtable = tabletohtml(conversionsegment.tab, conversionsegment.dsubsets(), conversionsegment.consolidatedcellvalueoverride(), blocalstylesheet)
-    fout.write('<div id="%s">\n' % (dividNUM))
+    fout.write('<div id="%s">\n' % (ldividNUM))
     fout.write(htmtable)
     fout.write('</div>\n')
 
     if fname is not None and verbose:
-        print("tablepart '%s' written #%s" % (conversionsegment.tab.name, dividNUM))
+        print("tablepart '%s' written #%s" % (conversionsegment.tab.name, ldividNUM))
     if conversionsegment.dimensions and conversionsegment.segment:
         jslookup = calcjslookup(conversionsegment)
         if fname is not None and verbose:
             print("javascript calculated")
-        fout.write(jscode % (jslookup, dividNUM))
+        fout.write(jscode % (jslookup, ldividNUM))
     
     if fname is None:
-        display(HTML(fout.getvalue()))
+        ipydisplay.display(ipydisplay.HTML(fout.getvalue()))
     else:
         fout.write("</body></html>\n")
         fout.close()
-        local_file = FileLink(path=os.path.basename(fname),
-                              result_html_prefix="Written to file: ")
-        display(local_file)
+        local_file = ipydisplay.FileLink(path=os.path.basename(fname),
+                                         result_html_prefix="Written to file: ")
+        ipydisplay.display(local_file)
@@ -1,40 +1,183 @@
 # encoding: utf-8
 # HTML preview of the dimensions and table (will be moved to a function in databakersolo)
 
-import io, os, collections, re, warnings, csv, datetime
+import io, os, collections, re, warnings, csv, datetime, bisect, itertools
 import databaker.constants
 import xypath
 from databaker import richxlrd
-template = databaker.constants.template
+from databaker.lazyimport import LazyModule
+from databaker.bakecontext import defaultcontext, bakelocal
+from databaker.valuepool import MISSING, tabvaluepool
+from databaker.memtrack import memorystage, MEMCHECKROWS
+template = databaker.constants.template   # kept for old code; use a BakeContext instead
 
-try:   import pandas
-except ImportError:  pandas = None  # no pandas in pypy
+pandas = LazyModule("pandas")  # imported on first use; false if not installed (eg pypy)
+
+def svalueformat(xls_format):
+    "Choose the strftime pattern for an excel date formatting string"
+    # the fmt string is some excel generated garbage format, like: '[$-809]dd\\ mmmm\\ yyyy;@'
+    xls_format = xls_format.upper()
+    if   'Q' in xls_format:   return "%Y Q{quarter}"   # may be very rare
+    elif 'D' in xls_format:   return "%Y-%m-%d"
+    elif 'M' in xls_format:   return "%b %Y"
+    elif 'Y' in xls_format:   return "%Y"
+    return "%Y-%m-%d"
+
+_svalueformats = { }  # formatting string -> strftime pattern, for cells that don't come from xlrd
+
+def cellsvalueformat(cell):
+    "The strftime pattern for a date cell, decided once per XF record of its workbook"
+    try:
+        xf_index = cell.properties.cell.xlrd_cell.xf_index
+        book = cell.properties.cell.sheet.book
+    except AttributeError:
+        xls_format = cell.properties['formatting_string']
+        if xls_format not in _svalueformats:
+            _svalueformats[xls_format] = svalueformat(xls_format)
+        return _svalueformats[xls_format]
+    bookformats = getattr(book, "_svalueformats", None)
+    if bookformats is None:
+        bookformats = book._svalueformats = { }
+    if xf_index not in bookformats:
+        bookformats[xf_index] = svalueformat(cell.properties['formatting_string'])
+    return bookformats[xf_index]
+
+def strfvalue(value, py_format):
+    quarter = int((value.month -1 ) // 3) + 1
+    return value.strftime(py_format).format(quarter=quarter)
 
 def svalue(cell):
     if not isinstance(cell.value, datetime.datetime):
         return str(cell.value)
-    # the fmt string is some excel generated garbage format, like: '[$-809]dd\\ mmmm\\ yyyy;@'
     # the xlrd module does its best and creates a date tuple, which messytables constructs into a datetime using xldate_as_tuple()
-    xls_format = cell.properties['formatting_string'].upper()
-    quarter = int((cell.value.month -1 ) // 3) + 1
-    if   'Q' in xls_format:   py_format = "%Y Q{quarter}"   # may be very rare
-    elif 'D' in xls_format:   py_format = "%Y-%m-%d"
-    elif 'M' in xls_format:   py_format = "%b %Y"
-    elif 'Y' in xls_format:   py_format = "%Y"
-    else:                     py_format = "%Y-%m-%d"
-    return cell.value.strftime(py_format).format(quarter=quarter)
+    return strfvalue(cell.value, cellsvalueformat(cell))
+
+def notscriptvalue(cell):
+    "The text of a rich text cell without its superscript and subscript fragments (eg footnote markers)"
+    notscript = getattr(cell.properties, "notscript", None)   # worked out when loading by databaker.xlsxloader
+    if notscript is not None:
+        return notscript
+    return richxlrd.RichCell(cell.properties.cell.sheet, cell.y, cell.x).fragments.not_script.value
+
+def svalues(cells):
+    "svalue() of a list of cells, converting each distinct date and format pair only once"
+    res = [ ]
+    converted = { }
+    for cell in cells:
+        if not isinstance(cell.value, datetime.datetime):
+            res.append(str(cell.value))
+            continue
+        key = (cell.value, cellsvalueformat(cell))
+        if key not in converted:
+            converted[key] = strfvalue(*key)
+        res.append(converted[key])
+    return res
+
+
+# what to do when header cells are equally near an observation: raise LookupConfusionError, take the first
+# or last of them in reading order, or take the one nearest across the lookup direction (raising if that also ties)
+TIEPOLICIES = [ "raise", "first", "last", "nearest" ]
+
+# versions of OverrideDicts, unique across them so that a replaced dict is also seen as changed
+OVERRIDEVERSIONS = itertools.count(1)
+
+class OverrideDict(dict):
+    "The cellvalueoverride of an HDim, with a new version number after every edit so that what is worked out from it can tell when it is stale"
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = next(OVERRIDEVERSIONS)
+
+    def edited(self):
+        self.version = next(OVERRIDEVERSIONS)
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        self.edited()
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self.edited()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.edited()
 
+    def setdefault(self, k, default=None):
+        res = dict.setdefault(self, k, default)
+        self.edited()
+        return res
+
+    def pop(self, *args):
+        res = dict.pop(self, *args)
+        self.edited()
+        return res
+
+    def popitem(self):
+        res = dict.popitem(self)
+        self.edited()
+        return res
+
+    def clear(self):
+        dict.clear(self)
+        self.edited()
+
+
+class OverrideTable:
+    """The cellvalueoverride of an HDim split into its { cell: value }, { raw value: value } and { type: converter } parts,
+       which are applied in that order to give the value of a header cell (or of a missing one from the None key)"""
+    def __init__(self, cellvalueoverride):
+        self.cells, self.values, self.converters = { }, { }, { }
+        for k, v in cellvalueoverride.items():
+            if isinstance(k, xypath.xypath._XYCell):
+                self.cells[k] = v
+            elif isinstance(k, type):
+                self.converters[k] = v
+            else:
+                self.values[k] = v
+        self.version = cellvalueoverride.version
+
+    def headcellval(self, hcell, sval=None):
+        "Value of a header cell (None for no cell) with the overrides applied; sval is its svalue if already known"
+        if hcell is not None:
+            if hcell in self.cells:
+                val = self.cells[hcell]
+                assert isinstance(val, (str, float, int)), "Override from hcell value should go directly to a str,float,int,None-value (%s)" % type(val)
+                return val
+            val = svalue(hcell) if sval is None else sval
+        else:
+            val = None
+
+        # It's allowed to have {None:defaultvalue} to set the NoLookupValue
+        if val in self.values:
+            val = self.values[val]
+            assert val is None or isinstance(val, (str, float, int)), "Override from value should only be str,float,int,None (%s)" % type(val)
+
+        # type call if no other things match
+        elif type(val) in self.converters:
+            val = self.converters[type(val)](val)
+        return val
+
+
+# most observation cells an HDim remembers the lookup of (the oldest are forgotten first)
+LOOKUPMEMOSIZE = 200000
 
 class HDim:
     "Dimension object which defines the lookup between an observation cell and a bag of header cells"
-    def __init__(self, hbagset, label, strict=None, direction=None, cellvalueoverride=None):
+    def __init__(self, hbagset, label, strict=None, direction=None, cellvalueoverride=None, tiepolicy="raise"):
         self.label = label
         self.name = label
+        assert tiepolicy in TIEPOLICIES, "tiepolicy should be one of %s" % ", ".join(TIEPOLICIES)
+        self.tiepolicy = tiepolicy
             
-        self.cellvalueoverride = cellvalueoverride or {} # do not put {} into default value otherwise there is only one static one for everything
+        self.cellvalueoverride = cellvalueoverride or {} # do not put {} into default value otherwise there is only one static one for everything (copied into an OverrideDict)
         assert not isinstance(hbagset, str), "Use empty set and default value for single value dimension"
         self.hbagset = hbagset
         self.bhbagsetCopied = False
+        self.overrides = None   # OverrideTable of cellvalueoverride
         
         if self.hbagset is None:   # single value type
             assert direction is None and strict is None
@@ -48,80 +191,93 @@ class HDim:
 
         self.bxtype = (self.direction[1] == 0)
         self.samerowlookup = None
+        self.lookupmemo = None   # (hbagset, its length, cellvalueoverride version, { obs cell: (hcell, value) }), shared by every segment using this dimension
     
             
+    def lookupindex(self):
+        """{ row or column (None if not strict): (sorted mults, header cells in the same order) } for bisecting,
+           where mult is the distance along the direction.  Built once and rebuilt if hbagset is replaced or changes size"""
+        if self.samerowlookup is None or self.samerowlookup[0] is not self.hbagset or self.samerowlookup[1] != len(self.hbagset):
+            dx, dy = self.direction
+            groups = { }
+            for hcell in self.hbagset.unordered_cells:
+                k = (hcell.y if self.bxtype else hcell.x)  if self.strict  else None
+                groups.setdefault(k, [ ]).append((hcell.x*dx + hcell.y*dy, hcell))
+            index = { }
+            for k, mhcells in groups.items():
+                mhcells.sort(key=lambda mh: (mh[0], mh[1].y, mh[1].x))   # ties in reading order for the tiepolicy
+                index[k] = ([ m  for m, hcell in mhcells ], [ hcell  for m, hcell in mhcells ])
+            self.samerowlookup = (self.hbagset, len(self.hbagset), index)   # caching that can be removed in AddCellValueOverride
+        return self.samerowlookup[2]
+
     def celllookup(self, scell):
         "Lookup function from a given cell to the matching header cell"
-        
-        # caching that can be removed in AddCellValueOverride
-        if self.strict and self.samerowlookup is None:
-            self.samerowlookup = {}
-            for hcell in self.hbagset.unordered_cells:
-                k = hcell.y if self.bxtype else hcell.x
-                if k not in self.samerowlookup:
-                    self.samerowlookup[k] = []
-                self.samerowlookup[k].append(hcell)
-        
-        def mult(cell):
-            return cell.x * self.direction[0] + cell.y * self.direction[1]
-        def dgap(cell, target_cell):
-            if direction[1] == 0:
-                return abs(cell.x - target_cell.x)
-            return abs(cell.y - target_cell.y)
-        
-        def betweencells(scell, target_cell, best_cell):
-            if mult(scell) <= mult(target_cell):
-                if not best_cell or mult(target_cell) <= mult(best_cell):
-                    return True
-            return False
-        
-        def same_row_col(a, b):
-            return  (a.x - b.x  == 0 and self.direction[0] == 0) or (a.y - b.y  == 0 and self.direction[1] == 0)
-    
-        if self.strict:
-            hcells = self.samerowlookup.get(scell.y if self.bxtype else scell.x, [])
-        else:
-            hcells = self.hbagset.unordered_cells
-        hcells = self.hbagset.unordered_cells
-        
-        best_cell = None
-        second_best_cell = None
-
-        #if strict:  print(len(list(hcells)), len(list(hbagset.unordered_cells)))
-        for target_cell in hcells:
-            if betweencells(scell, target_cell, best_cell):
-                if not self.strict or same_row_col(scell, target_cell):
-                    second_best_cell = best_cell
-                    best_cell = target_cell
-        if second_best_cell and mult(best_cell) == mult(second_best_cell):
-            raise xypath.LookupConfusionError("{!r} is as good as {!r} for {!r}".format(best_cell, second_best_cell, scell))
-        if best_cell is None:
-            return None
-        return best_cell
+        return self.celllookups([ scell ])[0]
 
-    def headcellval(self, hcell):
-        "Extract the string value of a member header cell (including any value overrides)"
+    def celllookups(self, scells, confused=None):
+        """Lookup of a list of cells to their matching header cells (None where there is none); 
+           the nearest header at or beyond the cell in the direction (and in its row or column if strict), 
+           with ties settled by the tiepolicy.  Unsettled ties raise LookupConfusionError, 
+           or if a confused list is given are appended to it as (cell, tied header cells) and looked up as None"""
+        dx, dy = self.direction
+        if self.strict and dx != 0 and dy != 0:
+            return [ None ]*len(scells)   # no header can be in the same row or column along a diagonal
+        index = self.lookupindex()
+        bisect_left, bisect_right = bisect.bisect_left, bisect.bisect_right
+        res = [ ]
+        for scell in scells:
+            mults, hcells = index.get((scell.y if self.bxtype else scell.x)  if self.strict  else None, ((), ()))
+            i = bisect_left(mults, scell.x*dx + scell.y*dy)
+            if i == len(mults):
+                res.append(None)
+            elif i + 1 == len(mults) or mults[i + 1] != mults[i]:
+                res.append(hcells[i])
+            else:
+                hcell = self.tiebreak(scell, hcells[i:bisect_right(mults, mults[i], i)], confused)
+                res.append(hcell)
+        return res
+
+    def tiebreak(self, scell, tiedcells, confused=None):
+        "Choose between header cells equally near to scell according to the tiepolicy"
+        if self.tiepolicy == "first":
+            return tiedcells[0]
+        if self.tiepolicy == "last":
+            return tiedcells[-1]
+        if self.tiepolicy == "nearest":
+            def gap(hcell):
+                if self.direction[0] == 0:   return abs(hcell.x - scell.x)
+                if self.direction[1] == 0:   return abs(hcell.y - scell.y)
+                return abs(hcell.x - scell.x) + abs(hcell.y - scell.y)
+            gaps = [ gap(hcell)  for hcell in tiedcells ]
+            mingap = min(gaps)
+            tiedcells = [ hcell  for hcell, g in zip(tiedcells, gaps)  if g == mingap ]
+            if len(tiedcells) == 1:
+                return tiedcells[0]
+        if confused is None:
+            raise xypath.LookupConfusionError("{!r} is as good as {!r} for {!r}".format(tiedcells[-1], tiedcells[0], scell))
+        confused.append((scell, tiedcells))
+        return None
+
+    @property
+    def cellvalueoverride(self):
+        return self._cellvalueoverride
+
+    @cellvalueoverride.setter
+    def cellvalueoverride(self, cellvalueoverride):
+        "Kept as an OverrideDict, so that edits to it directly (as well as by AddCellValueOverride) are seen"
+        self._cellvalueoverride = cellvalueoverride  if isinstance(cellvalueoverride, OverrideDict)  else OverrideDict(cellvalueoverride)
+
+    def overridetable(self):
+        "OverrideTable of cellvalueoverride, compiled on first use and again only after it has been edited"
+        if self.overrides is None or self.overrides.version != self.cellvalueoverride.version:
+            self.overrides = OverrideTable(self.cellvalueoverride)
+        return self.overrides
+
+    def headcellval(self, hcell, sval=None):
+        "Extract the string value of a member header cell (including any value overrides); sval is its svalue if already known"
         if hcell is not None:
             assert isinstance(hcell, xypath.xypath._XYCell), "celllookups should only go to an _XYCell"
-            if hcell in self.cellvalueoverride:
-                val = self.cellvalueoverride[hcell]
-                assert isinstance(val, (str, float, int)), "Override from hcell value should go directly to a str,float,int,None-value (%s)" % type(val)
-                return val
-            val = svalue(hcell)
-            #assert val is None or isinstance(val, (str, float, int)), "cell value should only be str,float,int,None (%s)" % type(val)
-        else:
-            val = None
-         
-        # It's allowed to have {None:defaultvalue} to set the NoLookupValue
-        if val in self.cellvalueoverride:
-            val = self.cellvalueoverride[val]
-            assert val is None or isinstance(val, (str, float, int)), "Override from value should only be str,float,int,None (%s)" % type(val)
-
-        # type call if no other things match
-        elif type(val) in self.cellvalueoverride:
-             val = self.cellvalueoverride[type(val)](val)
-            
-        return val
+        return self.overridetable().headcellval(hcell, sval)
 
 
     def cellvalobs(self, ob):
@@ -133,20 +289,36 @@ class HDim:
         
         # we do two steps through cellvalueoverride in three places on mutually distinct sets (obs, heading, strings)
         # and not recursively as these are wholly different applications.  the celllookup is itself like a cellvalueoverride
-        if ob in self.cellvalueoverride:
-            val = self.cellvalueoverride[ob]  # knock out an individual obs for this cell
+        overrides = self.overridetable()
+        if ob in overrides.cells:
+            val = overrides.cells[ob]  # knock out an individual obs for this cell
             assert isinstance(val, str), "Override from obs should go directly to a string-value"
             return None, val
             
-        if self.hbagset is not None:
+        if self.hbagset is None:
+            return None, self.headcellval(None)
+
+        memo = self.obslookupmemo()
+        res = memo.get(ob)
+        if res is None:
             hcell = self.celllookup(ob)
-        else:
-            hcell = None
-            
-        return hcell, self.headcellval(hcell)
+            res = (hcell, self.headcellval(hcell))
+            if len(memo) >= LOOKUPMEMOSIZE:
+                del memo[next(iter(memo))]
+            memo[ob] = res
+        return res
+
+    def obslookupmemo(self):
+        """{ obs cell: (hcell, value) } of the cellvalobs lookups done so far, so segments over the same cells share them.  
+           Emptied by AddCellValueOverride, by any edit to cellvalueoverride and whenever hbagset is replaced or changes size"""
+        memo = self.lookupmemo
+        if memo is None or memo[0] is not self.hbagset or memo[1] != len(self.hbagset) or memo[2] != self.cellvalueoverride.version:
+            memo = self.lookupmemo = (self.hbagset, len(self.hbagset), self.cellvalueoverride.version, { })
+        return memo[3]
         
     def AddCellValueOverride(self, overridecell, overridevalue):
         "Override the value of a header cell (and insert it if not present in the bag)" 
+        self.lookupmemo = None   # the override can change looked up values
         if isinstance(overridecell, str):
             self.cellvalueoverride[overridecell] = overridevalue
             return
@@ -173,16 +345,37 @@ class HDim:
         assert overridevalue is None or isinstance(overridevalue, (str, float, int)), "Override from value should only be str,float,int,None (%s)" % type(overridevalue)
         self.cellvalueoverride[overridecell] = overridevalue
 
+    def lookupcoverage(self, obs):
+        "LookupCoverage of a bag (or list) of observation cells onto this dimension's header cells, in one batch lookup"
+        obscells = list(obs.unordered_cells)  if isinstance(obs, xypath.xypath.Bag)  else list(obs)
+        coverage = LookupCoverage(self.label, self.hbagset)
+        if self.hbagset is None:
+            return coverage
+        hcells = self.celllookups(obscells, coverage.confused)
+        confusedobs = set(id(ob)  for ob, tiedcells in coverage.confused)
+        for ob, hcell in zip(obscells, hcells):
+            if hcell is not None:
+                coverage.counts[hcell] = coverage.counts.get(hcell, 0) + 1
+            elif id(ob) not in confusedobs:
+                coverage.unmatched.append(ob)
+        return coverage
+
     def discardcellsnotlookedup(self, obs):
-        "Remove header cells to which none of the observation cells looks up to"
+        "Remove header cells to which none of the observation cells looks up to, returning the LookupCoverage"
+        coverage = self.lookupcoverage(obs)
+        if coverage.confused:
+            ob, tiedcells = coverage.confused[0]
+            raise xypath.LookupConfusionError("{!r} is as good as {!r} for {!r}".format(tiedcells[-1], tiedcells[0], ob))
         hbagsetT = xypath.xypath.Bag(self.hbagset.table)
-        for ob in obs.unordered_cells:
-            hbagsetT.add(self.celllookup(ob))
+        for hcell in coverage.counts:
+            hbagsetT.add(hcell)
         self.hbagset = hbagsetT
+        return coverage
 
     def valueslist(self):
         "List of all the header cell values"
-        return [self.headcellval(cell)  for cell in sorted(self.hbagset.unordered_cells, key=lambda cell: (cell.y, cell.x))]
+        scells = sorted(self.hbagset.unordered_cells, key=lambda cell: (cell.y, cell.x))
+        return [self.headcellval(cell, sval)  for cell, sval in zip(scells, svalues(scells))]
 
     def checkvalues(self, vlist):
         "Check that the header cell values match"
@@ -199,6 +392,28 @@ class HDim:
         return True
         
 
+class LookupCoverage:
+    "How the observations of a segment map onto the header cells of one dimension"
+    def __init__(self, label, hbagset):
+        self.label = label
+        self.hbagset = hbagset
+        self.counts = { }       # header cell -> number of observations looking up to it
+        self.unmatched = [ ]    # observation cells with no header cell
+        self.confused = [ ]     # (observation cell, header cells) where the tiepolicy could not choose between them
+
+    def unused(self):
+        "Header cells that no observation looks up to"
+        if self.hbagset is None:
+            return [ ]
+        return sorted((hcell  for hcell in self.hbagset.unordered_cells  if hcell not in self.counts), key=lambda cell: (cell.y, cell.x))
+
+    def __repr__(self):
+        return "<LookupCoverage %s: %d header cells used, %d unused, %d observations unmatched, %d confused>" % (self.label, len(self.counts), len(self.unused()), len(self.unmatched), len(self.confused))
+
+
+LookupProblem = collections.namedtuple("LookupProblem", [ "label", "ob", "kind", "hcells" ])
+
+
 def HDimConst(name, val):
     "Define a constant value dimension across the whole segment"
     return HDim(None, name, cellvalueoverride={None:val})
@@ -252,10 +467,11 @@ def Ldatetimeunitforce(st, timeunit):
     return st
 
 
-def HLDUPgenerate_header_row(numheaderadditionals):
-    res = [ (k[0] if isinstance(k, tuple) else k)  for k in template.headermeasurements ]
+def HLDUPgenerate_header_row(numheaderadditionals, context=None):
+    context = context if context is not None else defaultcontext
+    res = [ (k[0] if isinstance(k, tuple) else k)  for k in context.headermeasurements ]
     for i in range(numheaderadditionals):
-        for k in template.headeradditionals:
+        for k in context.headeradditionals:
             if isinstance(k, tuple):
                 sk = k[0]
             else:
@@ -266,7 +482,7 @@ def HLDUPgenerate_header_row(numheaderadditionals):
 
 class ConversionSegment:
     "Single output table object generated from a bag of observations that look up to a list of dimensions"
-    def __init__(self, observations, dimensions, Lobservations=None, processTIMEUNIT=True, includecellxy=False):
+    def __init__(self, observations, dimensions, Lobservations=None, processTIMEUNIT=True, includecellxy=False, context=None):
         if Lobservations is None:   # new format that drops the unnecessary table element
             tab = observations.table
             Lobservations = observations
@@ -279,12 +495,15 @@ class ConversionSegment:
         
         self.processtimeunit = processTIMEUNIT
         self.includecellxy = includecellxy
+        if context is None:
+            context = getattr(bakelocal, "context", None)   # a bake service job's
+        self.context = context if context is not None else defaultcontext   # the output template and options
 
         for dimension in self.dimensions:
             assert isinstance(dimension, HDim), ("Dimensions must have type HDim()")
             assert dimension.hbagset is None or dimension.hbagset.table is tab, "dimension %s from different tab" % dimension.name
             
-        self.numheaderadditionals = sum(1  for dimension in self.dimensions  if dimension.label not in template.headermeasurementnamesSet)
+        self.numheaderadditionals = sum(1  for dimension in self.dimensions  if dimension.label not in self.context.headermeasurementnamesSet)
 
         # generate the ordered obslist here (so it is fixed here and can be reordered before processing)
         if isinstance(self.segment, xypath.xypath.Bag):
@@ -298,7 +517,43 @@ class ConversionSegment:
         # holding place for output of processing.  
         # technically no reason we shouldn't process at this point either, on this constructor, 
         # but doing it in stages allows for interventions along the way
-        self.processedrows = None  
+        # process() fills in rowids (tuples in rowcolumns order, with every column not in rawcolumns 
+        # as an id in the context's valuepool, or without a context the table's); processedrows turns them into dicts when first used
+        self.valuepool = context.valuepool  if context is not None  else tabvaluepool(tab)
+        self.rowcolumns = None
+        self.rawcolumns = None
+        self.rowids = None
+        self._processedrows = None  
+
+    @property
+    def processedrows(self):
+        "The processed rows as a list of dicts (made from the pooled rowids on first use, after which those are dropped)"
+        if self.rowids is not None:
+            self._processedrows = list(self.rowdicts())
+            self.rowids = None
+        return self._processedrows
+
+    @processedrows.setter
+    def processedrows(self, processedrows):
+        self._processedrows = processedrows
+        self.rowids = None
+
+    def isprocessed(self):
+        return self.rowids is not None or self._processedrows is not None
+
+    def numprocessedrows(self):
+        return len(self.rowids) if self.rowids is not None else len(self._processedrows)
+
+    def rowdicts(self):
+        "Iterate the processed rows as dicts without keeping them (missing values are left out, as in lookupobs)"
+        if self.rowids is None:
+            for dval in self._processedrows:
+                yield dval
+            return
+        values = self.valuepool.values
+        columns = [ (col, i in self.rawcolumns)  for i, col in enumerate(self.rowcolumns) ]
+        for row in self.rowids:
+            yield { col:(v if braw else values[v])  for (col, braw), v in zip(columns, row)  if braw or v != MISSING }
             
 
     # used in tabletohtml for the subsets, and where we would find the mappings for over-ride values
@@ -311,22 +566,38 @@ class ConversionSegment:
                 tsubs.append((i+1, dimension.name, dimension.hbagset))
         return tsubs
         
+    def lookupcoverage(self):
+        "{ dimension label: LookupCoverage } of the observations over each header cell dimension"
+        return collections.OrderedDict((dimension.label, dimension.lookupcoverage(self.obslist))  for dimension in self.dimensions  if dimension.hbagset is not None)
+
+    def validatelookups(self):
+        """Look up every observation in every dimension in one pass and return a LookupProblem for each lookup that is 
+           confused (equally near header cells the tiepolicy can't choose between) or missing (no header cell and no 
+           {None:default} override), rather than stopping at the first one as process() does"""
+        res = [ ]
+        for dimension in self.dimensions:
+            if dimension.hbagset is None:
+                continue
+            overrides = dimension.overridetable()
+            obscells = [ ob  for ob in self.obslist  if ob not in overrides.cells ]   # these are never looked up
+            coverage = dimension.lookupcoverage(obscells)
+            for ob, tiedcells in coverage.confused:
+                res.append(LookupProblem(dimension.label, ob, "confused", tiedcells))
+            if None not in overrides.values:
+                for ob in coverage.unmatched:
+                    res.append(LookupProblem(dimension.label, ob, "missing", [ ]))
+        return res
+
     # used in tabletohtml for the subsets, and where we would find the mappings for over-ride values
     def consolidatedcellvalueoverride(self):
+        "{ (x, y): overridden value } of the header cells whose value the lookups change, as each dimension's OverrideTable gives it"
         res = { }
-        for i, dimension in enumerate(self.dimensions):
+        for dimension in self.dimensions:
             if dimension.hbagset is not None:   # filter out TempValue headers
-                for hcell in dimension.hbagset.unordered_cells:
-                    sval = svalue(hcell)
-                    val = hcell.value
-                    if hcell in dimension.cellvalueoverride:
-                        val = str(dimension.cellvalueoverride[hcell])
-                    elif sval in dimension.cellvalueoverride:
-                        val = str(dimension.cellvalueoverride[val])
-                    elif type(hcell.value) in dimension.cellvalueoverride:
-                        val = str(dimension.cellvalueoverride[type(hcell.value)](hcell.value))
-                    else:
-                        val = sval
+                overrides = dimension.overridetable()
+                hcells = list(dimension.hbagset.unordered_cells)
+                for hcell, sval in zip(hcells, svalues(hcells)):
+                    val = str(overrides.headcellval(hcell, sval))
                     if val != sval:
                         res[(hcell.x, hcell.y)] = val
         return res
@@ -336,99 +607,259 @@ class ConversionSegment:
         if type(ob) is xypath.xypath.Bag:
             assert len(ob) == 1, "Can only lookupobs on a single cell"
             ob = ob._cell
+        dval = self.obsvalues(ob)
+        
+        for hdim in self.dimensions:
+            hcell, val = hdim.cellvalobs(ob)
+            dval[hdim.label] = val
+            
+        if self.includecellxy:
+            dval["__x"] = ob.x
+            dval["__y"] = ob.y
+            dval["__tablename"] = self.tab.name
+        return dval
 
+    def obsvalues(self, ob):
+        "The OBS value of an observation cell, and its DATAMARKER if split off"
+        context = self.context
         # force it to be float and split off anything not float into the datamarker
         if not isinstance(ob.value, float):
             if ob.properties['richtext']:  # should this case be implemented into the svalue() function?
-                sval = richxlrd.RichCell(ob.properties.cell.sheet, ob.y, ob.x).fragments.not_script.value
+                sval = notscriptvalue(ob)
             else:
                 sval = svalue(ob)
                 
-            if template.SH_Split_OBS:
-                assert template.SH_Split_OBS == databaker.constants.DATAMARKER, (template.SH_Split_OBS, databaker.constants.DATAMARKER)
+            if context.SH_Split_OBS:
+                assert context.SH_Split_OBS == context.DATAMARKER, (context.SH_Split_OBS, context.DATAMARKER)
                 ob_value, dm_value = re.match(r"([-+]?[0-9]+\.?[0-9]*)?(.*)", sval).groups()
                 dval = { }
                 if dm_value:
-                    dval[template.SH_Split_OBS] = dm_value
+                    dval[context.SH_Split_OBS] = dm_value
                 if ob_value:
-                    dval[databaker.constants.OBS] = float(ob_value)
+                    dval[context.OBS] = float(ob_value)
                 else:
-                    dval[databaker.constants.OBS] = ""
+                    dval[context.OBS] = ""
             else:
-                dval = { databaker.constants.OBS:sval }
+                dval = { context.OBS:sval }
         else:
-            dval = { databaker.constants.OBS:ob.value }
-        
-        for hdim in self.dimensions:
-            hcell, val = hdim.cellvalobs(ob)
-            dval[hdim.label] = val
-            
-        if self.includecellxy:
-            dval["__x"] = ob.x
-            dval["__y"] = ob.y
-            dval["__tablename"] = self.tab.name
+            dval = { context.OBS:ob.value }
         return dval
 
-    def guesstimeunit(self):
-        for dval in self.processedrows:
-            dval[template.TIMEUNIT] = Ldatetimeunitloose(dval[template.TIME])
-        ctu = collections.Counter(dval[template.TIMEUNIT]  for dval in self.processedrows)
+    def timeunitguesser(self):
+        """(function giving a pooled row its TIMEUNIT guessed from its TIME, Counter of the guessed unit ids), 
+           adding the TIMEUNIT column if there isn't one; each distinct TIME is worked out once"""
+        TIME, TIMEUNIT = self.context.TIME, self.context.TIMEUNIT
+        itime = self.rowcolumns.index(TIME)
+        if TIMEUNIT in self.rowcolumns:
+            iunit = self.rowcolumns.index(TIMEUNIT)
+            setunit = lambda row, unitid: row[:iunit] + (unitid,) + row[iunit+1:]
+        else:
+            self.rowcolumns.append(TIMEUNIT)
+            setunit = lambda row, unitid: row + (unitid,)
+        values, intern = self.valuepool.values, self.valuepool.intern
+        unitids = { }
+        ctu = collections.Counter()
+        def guess(row):
+            timeid = row[itime]
+            unitid = unitids.get(timeid)
+            if unitid is None:
+                unitid = unitids[timeid] = intern(Ldatetimeunitloose(values[timeid]))
+            ctu[unitid] += 1
+            return setunit(row, unitid)
+        return guess, ctu
+
+    def timeunitfixer(self):
+        "Function giving a pooled row its TIME forced to its TIMEUNIT, working out each distinct pair once"
+        itime, iunit = self.rowcolumns.index(self.context.TIME), self.rowcolumns.index(self.context.TIMEUNIT)
+        values, intern = self.valuepool.values, self.valuepool.intern
+        fixedids = { }
+        def fix(row):
+            key = (row[itime], row[iunit])
+            fixedid = fixedids.get(key)
+            if fixedid is None:
+                fixedid = fixedids[key] = intern(Ldatetimeunitforce(values[key[0]], values[key[1]]))
+            return row[:itime] + (fixedid,) + row[itime+1:]
+        return fix
+
+    def timeunitcountsmessage(self, ctu):
+        "The message of guesstimeunit from the Counter of its TIMEUNITs"
         if len(ctu) == 1:
             return "TIMEUNIT='%s'" % list(ctu.keys())[0]
         return "multiple TIMEUNITs: %s" % ", ".join("'%s'(%d)" % (k,v)  for k,v in ctu.items())
+
+    def guesstimeunit(self):
+        TIME, TIMEUNIT = self.context.TIME, self.context.TIMEUNIT
+        if self.rowids is not None:
+            guess, ctu = self.timeunitguesser()
+            self.rowids = [ guess(row)  for row in self.rowids ]
+            values = self.valuepool.values
+            ctu = collections.Counter(dict((values[unitid], n)  for unitid, n in ctu.items()))
+        else:
+            for dval in self.processedrows:
+                dval[TIMEUNIT] = Ldatetimeunitloose(dval[TIME])
+            ctu = collections.Counter(dval[TIMEUNIT]  for dval in self.processedrows)
+        return self.timeunitcountsmessage(ctu)
         
     def fixtimefromtimeunit(self):  # this works individually and not across the whole segment homogeneously
-        for dval in self.processedrows:
-            dval[template.TIME] = Ldatetimeunitforce(dval[template.TIME], dval[template.TIMEUNIT])
+        TIME, TIMEUNIT = self.context.TIME, self.context.TIMEUNIT
+        if self.rowids is not None:
+            fix = self.timeunitfixer()
+            self.rowids = [ fix(row)  for row in self.rowids ]
+        else:
+            for dval in self.processedrows:
+                dval[TIME] = Ldatetimeunitforce(dval[TIME], dval[TIMEUNIT])
 
-    def process(self):
-        assert self.processedrows is None, "Conversion segment already processed"
-        self.processedrows = [ self.lookupobs(ob)  for ob in self.obslist ]
-        
+    def timeunitsteps(self):
+        "Which of guesstimeunit and fixtimefromtimeunit process() applies, as (guess, fix)"
+        context = self.context
         kdim = dict((dimension.label, dimension)  for dimension in self.dimensions)
+        if self.processtimeunit and context.TIME in kdim and context.TIMEUNIT not in kdim:
+            return bool(context.SH_Create_ONS_time), True
+        return False, False
+
+    def setuprowcolumns(self):
+        "Lay out rowcolumns and rawcolumns for processing; returns { column: index } and [ (index, dimension) ]"
+        context = self.context
+        # the columns of the pooled rows; a later dimension with the same label overwrites as it would in the dict
+        self.rowcolumns = [ context.OBS, context.DATAMARKER ]
+        for dimension in self.dimensions:
+            if dimension.label not in self.rowcolumns:
+                self.rowcolumns.append(dimension.label)
+        if self.includecellxy:
+            self.rowcolumns.extend(col  for col in ["__x", "__y", "__tablename"]  if col not in self.rowcolumns)
+        icolumns = dict((col, i)  for i, col in enumerate(self.rowcolumns))
+        self.rawcolumns = set(icolumns[col]  for col in [ context.OBS, "__x", "__y" ]  if col in icolumns)
+        idims = [ (icolumns[dimension.label], dimension)  for dimension in self.dimensions ]
+        return icolumns, idims
+
+    def iterrowids(self, icolumns, idims, obslist=None):
+        "Look up each observation (of obslist, a run of them) into a row of pooled ids, checking the context's memory budget as it goes"
+        intern = self.valuepool.intern
+        ncolumns = len(icolumns)   # rowcolumns may have grown a TIMEUNIT since
+        memorytracker = self.context.memorytracker
+        for n, ob in enumerate(self.obslist  if obslist is None  else obslist):
+            row = [ MISSING ]*ncolumns
+            for col, val in self.obsvalues(ob).items():
+                i = icolumns[col]
+                row[i] = val  if i in self.rawcolumns  else intern(val)
+            for i, hdim in idims:
+                hcell, val = hdim.cellvalobs(ob)
+                row[i] = val  if i in self.rawcolumns  else intern(val)
+            if self.includecellxy:
+                row[icolumns["__x"]] = ob.x
+                row[icolumns["__y"]] = ob.y
+                row[icolumns["__tablename"]] = intern(self.tab.name)
+            yield tuple(row)
+            if memorytracker is not None and n % MEMCHECKROWS == MEMCHECKROWS - 1:
+                memorytracker.check()
+
+    def process(self):
+        assert not self.isprocessed(), "Conversion segment already processed"
+        context = self.context
+        with memorystage(context.memorytracker, "process", self.tab.name, len(self.obslist)):
+            if context.segmentcache is not None:   # reuse the output of an identical segment from an earlier bake
+                cachekey, timeunitmessage = context.segmentcache.lookup(self)
+                if timeunitmessage is not None:
+                    return timeunitmessage
+            
+            icolumns, idims = self.setuprowcolumns()
+            self.rowids = list(self.iterrowids(icolumns, idims))
+            timeunitmessage = self.settletimeunit()
+            if context.segmentcache is not None:
+                context.segmentcache.store(cachekey, self, timeunitmessage)
+        return timeunitmessage
+
+    def settletimeunit(self):
+        "Apply guesstimeunit and fixtimefromtimeunit to the whole of the looked up rowids as process() does, returning the message"
         timeunitmessage = ""
-        if self.processtimeunit:
-            if template.SH_Create_ONS_time and ((template.TIMEUNIT not in kdim) and (template.TIME in kdim)):
-                timeunitmessage = self.guesstimeunit()
-                self.fixtimefromtimeunit()
-            elif template.TIME in kdim and template.TIMEUNIT not in kdim:
-                self.fixtimefromtimeunit()
+        guess, fix = self.timeunitsteps()
+        if guess:
+            timeunitmessage = self.guesstimeunit()
+        if fix:
+            self.fixtimefromtimeunit()
         return timeunitmessage
+
+    def iterprocess(self):
+        """Rows of pooled ids as process() would make them, generated one at a time without keeping them, for segments 
+           too big to hold.  The segment is left unprocessed, with rowcolumns and rawcolumns laid out straight away 
+           and the guesstimeunit message put in self.timeunitmessage once the last row is out"""
+        assert not self.isprocessed(), "Conversion segment already processed"
+        icolumns, idims = self.setuprowcolumns()
+        guess, fix = self.timeunitsteps()
+        guessrow, ctu = self.timeunitguesser()  if guess  else (None, None)
+        fixrow = self.timeunitfixer()  if fix  else None
+        self.timeunitmessage = None
+        def rows():
+            for row in self.iterrowids(icolumns, idims):
+                if guessrow is not None:
+                    row = guessrow(row)
+                if fixrow is not None:
+                    row = fixrow(row)
+                yield row
+            values = self.valuepool.values
+            self.timeunitmessage = self.timeunitcountsmessage(collections.Counter(dict((values[unitid], n)  for unitid, n in ctu.items())))  if guess  else ""
+        return rows()
         
         
-    def topandas(self):
-        if pandas is None:
+    def categoricalcolumns(self):
+        "The pooled rows as pandas columns, with each dimension a Categorical over the pooled values it uses"
+        values = self.valuepool.values
+        res = collections.OrderedDict()
+        for i, col in enumerate(self.rowcolumns):
+            ids = [ row[i]  for row in self.rowids ]
+            if i in self.rawcolumns:
+                res[col] = ids
+                continue
+            usedids = sorted(set(ids) - { MISSING })
+            if not usedids:
+                continue   # as the column would be absent from the dicts
+            catids = [ j  for j in usedids  if values[j] is not None and values[j] == values[j] ]   # None (no lookup) and nan are left as NaN
+            categories = [ values[j]  for j in catids ]
+            if len(set(categories)) == len(categories):   # pandas takes eg 2012 and 2012.0 as the same category
+                codemap = dict((j, k)  for k, j in enumerate(catids))
+                res[col] = pandas.Categorical.from_codes([ codemap.get(j, -1)  for j in ids ], categories)
+            else:
+                res[col] = [ values[j]  if j != MISSING  else float("nan")  for j in ids ]
+        return res
+
+    def topandas(self, categorical=False):
+        "The processed rows as a DataFrame; categorical=True makes the dimension columns pandas Categoricals straight from the pooled ids"
+        if not pandas:
             warnings.warn("Sorry, you do not have pandas installed in this environment")
             return None
             
         timeunitmessage = ""
-        if self.processedrows is None: 
+        if not self.isprocessed(): 
             timeunitmessage = self.process()  
         print(timeunitmessage)
-        df = pandas.DataFrame.from_dict(self.processedrows)
+        with memorystage(self.context.memorytracker, "topandas", self.tab.name, self.numprocessedrows()):
+            if categorical and self.rowids is not None:
+                df = pandas.DataFrame(self.categoricalcolumns())
+            else:
+                df = pandas.DataFrame.from_dict(list(self.rowdicts()))
         
-        # sort the columns
-        dfcols = list(df.columns)
-        newdfcols = [ ]
-        for k in template.headermeasurements:
-            if isinstance(k, tuple):
-                if k[1] in dfcols:
-                    newdfcols.append(k[1])
-                    dfcols.remove(k[1])
-        for dimension in self.dimensions:
-            if dimension.label not in template.headermeasurementnamesSet:
-                assert dimension.label in dfcols
-                newdfcols.append(dimension.label)
-                dfcols.remove(dimension.label)
+            # sort the columns
+            dfcols = list(df.columns)
+            newdfcols = [ ]
+            for k in self.context.headermeasurements:
+                if isinstance(k, tuple):
+                    if k[1] in dfcols:
+                        newdfcols.append(k[1])
+                        dfcols.remove(k[1])
+            for dimension in self.dimensions:
+                if dimension.label not in self.context.headermeasurementnamesSet:
+                    assert dimension.label in dfcols
+                    newdfcols.append(dimension.label)
+                    dfcols.remove(dimension.label)
                 
-        for excol in ["__x", "__y", "__tablename"]:
-            if excol in dfcols:
-                if self.includecellxy:
-                    newdfcols.append(excol)
-                dfcols.remove(excol)
-        assert not dfcols, ("unexplained extra columns", dfcols)
+            for excol in ["__x", "__y", "__tablename"]:
+                if excol in dfcols:
+                    if self.includecellxy:
+                        newdfcols.append(excol)
+                    dfcols.remove(excol)
+            assert not dfcols, ("unexplained extra columns", dfcols)
         
-        df = df[newdfcols]   # map the new column list in
+            df = df[newdfcols]   # map the new column list in
         return df
 
 def pdguessforceTIMEUNIT(df):
@@ -0,0 +1,162 @@
+"""
+Check that no two observations of a bake have the same full dimension key,
+which the WDA loaders reject, without making a DataFrame.
+
+    checker = DuplicateKeyChecker()
+    writetechnicalCSV(outputfile, conversionsegments, keychecker=checker)
+    print(checker.report())
+
+or checkduplicatekeys(conversionsegments) to process the segments and
+check them on their own.  The key of a row is its dimension labels and
+values (everything but OBS, DATAMARKER and the cell position columns),
+whatever order the dimensions are in.  The rows are checked in one pass as
+they are processed or written, including segments the writer streams.
+
+Only a 64 bit hash of each key and the packed position of its observation
+cell are kept, in a pair of arrays, so a million rows take 32 to 64MB.
+A duplicate is reported with the positions (__x, __y, __tablename) of the
+cell that first had the key and of the cell repeating it.
+"""
+
+import array, collections
+from databaker.valuepool import ValuePool, MISSING
+
+DuplicateKey = collections.namedtuple("DuplicateKey", [ "key", "first", "duplicate" ])
+
+CELLBITS = 20   # bits for each of x and y in a packed cell position (xlsx sheets have at most 2**20 rows)
+
+
+class HashPositions:
+    """Open addressed table of 64 bit key hashes and the positions first seen with them, held in two arrays 
+       (32 to 64 bytes a key rather than over 100 in a dict of ints)"""
+    def __init__(self, capacity=1 << 16):
+        self.hashes = array.array("q", bytes(8*capacity))   # 0 for an empty slot
+        self.positions = array.array("q", bytes(8*capacity))
+        self.mask = capacity - 1
+        self.count = 0
+
+    def add(self, h, position):
+        "The position stored earlier for a hash, or None after storing this one as it is new"
+        h = h or 1   # keep 0 for empty slots
+        hashes = self.hashes
+        j = h & self.mask
+        while True:
+            slot = hashes[j]
+            if slot == h:
+                return self.positions[j]
+            if slot == 0:
+                break
+            j = (j + 1) & self.mask
+        hashes[j] = h
+        self.positions[j] = position
+        self.count += 1
+        if 2*self.count > len(hashes):
+            self.grow()
+        return None
+
+    def grow(self):
+        hashes, positions = self.hashes, self.positions
+        self.__init__(2*len(hashes))
+        for h, position in zip(hashes, positions):
+            if h:
+                self.add(h, position)
+
+    def __len__(self):
+        return self.count
+
+
+class DuplicateKeyChecker:
+    "Hashes of the dimension keys of the rows seen so far, and the duplicates found among them"
+    def __init__(self, maxduplicates=1000):
+        self.keys = HashPositions()   # hash of key -> packed position of its first observation
+        self.labels = ValuePool()   # numbers the labels and values of the keys across every pool they come from
+        self.translations = { }  # id(valuepool) -> (valuepool, [ checker id of each of its ids ])
+        self.tabnames = [ ]
+        self.tabindexes = { }
+        self.nrows = 0
+        self.nduplicates = 0
+        self.maxduplicates = maxduplicates   # most kept in duplicates (all are counted)
+        self.duplicates = [ ]
+
+    def packposition(self, tabname, x, y):
+        tabindex = self.tabindexes.get(tabname)
+        if tabindex is None:
+            tabindex = self.tabindexes[tabname] = len(self.tabnames)
+            self.tabnames.append(tabname)
+        return (((tabindex << CELLBITS) | y) << CELLBITS) | x
+
+    def unpackposition(self, position):
+        "(__x, __y, __tablename) of a packed position"
+        mask = (1 << CELLBITS) - 1
+        return (position & mask, (position >> CELLBITS) & mask, self.tabnames[position >> (2*CELLBITS)])
+
+    def translation(self, valuepool):
+        "List from the ids of a ValuePool to the checker's ids of the same values, brought up to date with the pool"
+        poolvalues = valuepool.values
+        translation = self.translations.setdefault(id(valuepool), (valuepool, [ MISSING ]))[1]
+        intern = self.labels.intern
+        translation.extend(intern(value)  for value in poolvalues[len(translation):])
+        return translation
+
+    def keycolumns(self, conversionsegment):
+        "[ (checker id of label, column index) ] of the dimension columns of a segment, in label order"
+        context = conversionsegment.context
+        excluded = { context.OBS, context.DATAMARKER, "__x", "__y", "__tablename" }
+        res = [ (self.labels.intern(col), i)  for i, col in enumerate(conversionsegment.rowcolumns)  if col not in excluded ]
+        res.sort(key=lambda li: str(self.labels.values[li[0]]))
+        return res
+
+    def checkrows(self, conversionsegment, rowids):
+        """Check the rows of pooled ids of a segment (its rowids, or rows from iterprocess()),
+           which are in the order of its obslist; the rows are passed on so it can sit in a stream"""
+        obslist = conversionsegment.obslist
+        tabbase = self.packposition(conversionsegment.tab.name, 0, 0)
+        keycolumns = self.keycolumns(conversionsegment)
+        valuepool = conversionsegment.valuepool
+        translation = self.translation(valuepool)
+        keys = self.keys
+        for ob, row in zip(obslist, rowids):
+            if len(translation) < len(valuepool.values):   # streamed rows intern new values as they go
+                translation = self.translation(valuepool)
+            key = tuple([ (labelid, translation[row[i]])  for labelid, i in keycolumns ])
+            position = tabbase | (ob.y << CELLBITS) | ob.x
+            first = keys.add(hash(key), position)
+            if first is not None:
+                self.addduplicate(key, first, position)
+            self.nrows += 1
+            yield row
+
+    def addduplicate(self, key, first, position):
+        self.nduplicates += 1
+        if len(self.duplicates) < self.maxduplicates:
+            values = self.labels.values
+            dkey = collections.OrderedDict((values[labelid], values[valueid])  for labelid, valueid in key  if valueid != MISSING)
+            self.duplicates.append(DuplicateKey(dkey, self.unpackposition(first), self.unpackposition(position)))
+
+    def addsegment(self, conversionsegment):
+        "Check the rows of a segment, processing it if it has not been"
+        if not conversionsegment.isprocessed():
+            conversionsegment.process()
+        assert conversionsegment.rowids is not None, "duplicate keys can only be checked from the pooled rows (before processedrows is used)"
+        collections.deque(self.checkrows(conversionsegment, conversionsegment.rowids), maxlen=0)
+
+    def report(self):
+        "The duplicates found, one per line"
+        lines = [ "%d duplicate keys in %d rows" % (self.nduplicates, self.nrows) ]
+        for duplicate in self.duplicates:
+            lines.append("%s at %s repeats %s: %s" % (duplicate.duplicate[2], duplicate.duplicate[:2], duplicate.first[:2]  if duplicate.first[2] == duplicate.duplicate[2]  else duplicate.first,
+                                                  ", ".join("%s=%s" % kv  for kv in duplicate.key.items())))
+        if self.nduplicates > len(self.duplicates):
+            lines.append("... and %d more" % (self.nduplicates - len(self.duplicates)))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "<DuplicateKeyChecker %d rows, %d duplicate keys>" % (self.nrows, self.nduplicates)
+
+
+def checkduplicatekeys(conversionsegments, maxduplicates=1000):
+    "DuplicateKeyChecker of a list of segments (processing those that need it)"
+    checker = DuplicateKeyChecker(maxduplicates)
+    for conversionsegment in conversionsegments:
+        checker.addsegment(conversionsegment)
+    return checker
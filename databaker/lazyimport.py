@@ -0,0 +1,31 @@
+"""
+Deferred imports for the heavy optional dependencies (pandas, IPython) so that
+`from databaker.framework import *` stays quick in batch workers and scripts.
+"""
+
+import importlib
+
+
+class LazyModule:
+    "Stands in for a module that is only imported on first attribute access; is false when the module is not installed"
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __bool__(self):
+        try:
+            self._load()
+        except ImportError:
+            return False
+        return True
+
+    def __repr__(self):
+        return "<LazyModule %r%s>" % (self._name, "" if self._module is None else " (loaded)")
@@ -0,0 +1,196 @@
+"""
+Memory accounting for bakes, to find which stage and tab a bake spends its
+memory in, and optionally to hold it to a budget.
+
+A MemoryTracker measures each stage of a bake: loadxlstabs, every
+ConversionSegment.process() and topandas(), and every segment the writers
+write.  For each it records the peak above the memory in use when the stage
+began and the memory it left behind, and for segments the bytes per
+observation.  The measure is either the resident set size of the process,
+sampled by a background thread ("rss", the default, which is what an OOM
+killer sees) or the Python allocations traced by tracemalloc ("tracemalloc",
+exact per stage but slowing the bake down two or three times).
+
+    tracker = MemoryTracker(budget=4*1024**3)
+    context = BakeContext(memorytracker=tracker)
+    tabs = loadxlstabs(inputfile, memorytracker=tracker)
+    ...
+    writetechnicalCSV(outputfile, conversionsegments, context)
+    print(tracker.report())
+
+With a budget, any stage that finds the bake over it raises
+MemoryBudgetExceeded saying where, rather than the bake being killed
+later with no explanation.  Once the bake is over streamfraction of its
+budget the writers switch to streaming: segments not yet processed are
+looked up and written a row at a time without holding their rows.
+"""
+
+import os, gc, time, threading, contextlib
+import tracemalloc
+
+STREAMFRACTION = 0.5   # of the budget, beyond which the writers stream the segments
+MEMCHECKROWS = 4096    # observations looked up between checks against the budget
+MEASURES = [ "rss", "tracemalloc" ]
+
+
+class MemoryBudgetExceeded(MemoryError):
+    "A bake used more memory than the budget of its MemoryTracker"
+
+
+def rssbytes():
+    "Resident set size of this process in bytes (its peak where the current size can't be read)"
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        raise RuntimeError("Can't read the memory use of this process; use MemoryTracker(measure='tracemalloc')")
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss  if os.uname().sysname == "Darwin"  else maxrss*1024
+
+
+def megabytes(nbytes):
+    return "%.1fMB" % (nbytes/1024/1024)
+
+
+class MemoryStage:
+    "Memory used by one stage of a bake: its peak above and the bytes retained since its start"
+    def __init__(self, name, tab, nobs, start):
+        self.name = name
+        self.tab = tab
+        self.nobs = nobs
+        self.start = start
+        self.peak = 0
+        self.retained = 0
+        self.seconds = 0.0
+        self.runningpeak = start   # highest memory seen so far, including in stages within this one
+
+    @property
+    def bytesperobs(self):
+        return self.peak/self.nobs  if self.nobs  else None
+
+    def __repr__(self):
+        return "<MemoryStage %s %s peak=%s retained=%s>" % (self.name, self.tab, megabytes(self.peak), megabytes(self.retained))
+
+
+class MemoryTracker:
+    """Per stage peak and retained memory of a bake, with an optional budget in bytes of the measure
+       ("rss" or "tracemalloc") that the stages check against"""
+    def __init__(self, budget=None, measure="rss", streamfraction=STREAMFRACTION, interval=0.01):
+        assert measure in MEASURES, "measure should be one of %s" % ", ".join(MEASURES)
+        self.budget = budget
+        self.measure = measure
+        self.streamfraction = streamfraction
+        self.interval = interval
+        self.stages = [ ]
+        self.openstages = [ ]
+        self.lock = threading.Lock()
+        self.startedtracemalloc = False
+        self.sampler = None
+        self.sampledpeak = 0
+        if measure == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.startedtracemalloc = True
+        self.basebytes = self.current()
+
+    def current(self):
+        "Memory in use now by the measure"
+        if self.measure == "tracemalloc":
+            return tracemalloc.get_traced_memory()[0]
+        return rssbytes()
+
+    def peak(self):
+        "Highest memory in use since the last resetpeak()"
+        if self.measure == "tracemalloc":
+            return tracemalloc.get_traced_memory()[1]
+        return max(self.sampledpeak, rssbytes())
+
+    def resetpeak(self):
+        if self.measure == "tracemalloc":
+            if hasattr(tracemalloc, "reset_peak"):   # before Python 3.9 the peaks are since the tracking started
+                tracemalloc.reset_peak()
+        else:
+            self.sampledpeak = rssbytes()
+
+    def sample(self):
+        while self.openstages:
+            self.sampledpeak = max(self.sampledpeak, rssbytes())
+            time.sleep(self.interval)
+
+    @contextlib.contextmanager
+    def stage(self, name, tab=None, nobs=None):
+        "Measure the memory used within a with block, checking it against the budget at the end"
+        with self.lock:
+            start = self.current()
+            if self.openstages:   # keep the enclosing stage's peak so far, as the peak is about to be reset
+                self.openstages[-1].runningpeak = max(self.openstages[-1].runningpeak, self.peak())
+            stage = MemoryStage(name, tab, nobs, start)
+            self.resetpeak()
+            self.openstages.append(stage)
+            if self.measure == "rss" and (self.sampler is None or not self.sampler.is_alive()):
+                self.sampler = threading.Thread(target=self.sample, name="memtrack", daemon=True)
+                self.sampler.start()
+        t0 = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            with self.lock:
+                stage.seconds = time.perf_counter() - t0
+                peak = max(stage.runningpeak, self.peak())
+                stage.peak = peak - stage.start
+                stage.retained = self.current() - stage.start
+                self.openstages.remove(stage)
+                if self.openstages:
+                    self.openstages[-1].runningpeak = max(self.openstages[-1].runningpeak, peak)
+                self.stages.append(stage)
+        self.check(stage)
+
+    def where(self, stage=None):
+        stages = self.openstages + ([ stage ]  if stage is not None and stage not in self.openstages  else [ ])
+        return " in ".join(reversed([ ("%s of %s" % (s.name, s.tab)  if s.tab is not None  else s.name)  for s in stages ])) or "the bake"
+
+    def check(self, stage=None):
+        "Raise MemoryBudgetExceeded if the bake is using more than its budget"
+        if self.budget is None:
+            return
+        used = self.current()
+        if used > self.budget:
+            gc.collect()   # only give up on what can't be freed
+            used = self.current()
+        if used > self.budget:
+            raise MemoryBudgetExceeded("Bake using %s (%s) at %s, over its budget of %s\n%s" %
+                                       (megabytes(used), self.measure, self.where(stage), megabytes(self.budget), self.report()))
+
+    def streaming(self):
+        "Whether the bake is far enough into its budget that the writers should stream segments"
+        return self.budget is not None and self.current() > self.budget*self.streamfraction
+
+    def report(self):
+        "Table of the stages measured so far"
+        lines = [ "%-12s %-24s %10s %10s %10s %12s %8s" % ("stage", "tab", "peak", "retained", "obs", "bytes/obs", "seconds") ]
+        for stage in self.stages:
+            bytesperobs = stage.bytesperobs
+            lines.append("%-12s %-24s %10s %10s %10s %12s %8.2f" % (stage.name, ("" if stage.tab is None else stage.tab)[:24], megabytes(stage.peak), megabytes(stage.retained),
+                         ("" if stage.nobs is None else stage.nobs), ("" if bytesperobs is None else "%.0f" % bytesperobs), stage.seconds))
+        lines.append("%s now %s, %s above the start%s" % (self.measure, megabytes(self.current()), megabytes(self.current() - self.basebytes),
+                     ("; budget %s" % megabytes(self.budget)  if self.budget is not None  else "")))
+        return "\n".join(lines)
+
+    def close(self):
+        "Stop tracemalloc if this tracker started it"
+        if self.startedtracemalloc:
+            tracemalloc.stop()
+            self.startedtracemalloc = False
+
+    def __repr__(self):
+        return "<MemoryTracker %s %d stages%s>" % (self.measure, len(self.stages), (" budget=%s" % megabytes(self.budget)  if self.budget is not None  else ""))
+
+
+def memorystage(tracker, name, tab=None, nobs=None):
+    "tracker.stage(...) or nothing when there is no tracker"
+    if tracker is None:
+        return contextlib.nullcontext()
+    return tracker.stage(name, tab, nobs)
@@ -0,0 +1,179 @@
+"""
+Extract the code cells of a databaker notebook into a cached python module so
+that it can be run per input file without a Jupyter kernel.
+
+Usage:
+  python -m databaker.nbrecipe <notebook_file>
+
+prints the filename of the cached module.
+"""
+
+import os, sys, ast, json, hashlib, importlib.util
+
+# bump this if the generated module changes so old cache entries are not reused
+NBRECIPE_VERSION = 2
+
+# calls that only produce output in the notebook and are switched off in batch mode
+DISPLAYCALLS = { "savepreviewhtml", "sidewindowhtmldisplay", "display" }
+
+MODULE_TEMPLATE = '''# Generated by databaker.nbrecipe from %(notebook)s -- do not edit
+import os
+from databaker.nbrecipe import compilerecipe, runrecipe
+
+NOTEBOOK = %(notebook)r
+SOURCE = %(source)r
+
+_code = compilerecipe(SOURCE, NOTEBOOK)
+
+def bake(inputfile=None, chdir=True):
+    "Run the notebook code for inputfile and return its namespace"
+    return runrecipe(_code, inputfile, os.path.dirname(NOTEBOOK) if chdir else None)
+'''
+
+
+def recipecachedir():
+    return os.environ.get('DATABAKER_RECIPE_CACHE') or os.path.join(os.path.expanduser("~"), ".cache", "databaker", "recipes")
+
+
+def linestate(line, state):
+    """(bracket depth, open string quote or None, whether continued by a backslash) after a line of code, 
+       given that before it, so we can tell which lines start a statement"""
+    depth, quote = state[:2]
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if quote is not None:
+            if c == "\\":
+                i += 2   # escaped character, including a quote
+            elif line.startswith(quote, i):
+                i += len(quote)
+                quote = None
+            else:
+                i += 1
+            continue
+        if c == "#":
+            return depth, None, False
+        if c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth = max(0, depth - 1)
+        elif c in "'\"":
+            quote = line[i:i+3]  if line[i:i+3] in ('"""', "'''")  else c
+            i += len(quote)
+            continue
+        i += 1
+    continued = line.rstrip("\r").endswith("\\")
+    if quote is not None and len(quote) == 1 and not continued:
+        quote = None   # an unterminated string, which the compiler will report
+    return depth, quote, continued
+
+
+def notebooksource(nb):
+    "Concatenate the code cells of a notebook, dropping IPython magics and shell escapes (only where a statement starts)"
+    res = [ ]
+    for cell in nb["cells"]:
+        if cell["cell_type"] != "code":
+            continue
+        src = cell["source"] if isinstance(cell["source"], str) else "".join(cell["source"])
+        if src.lstrip().startswith("%%"):
+            continue   # whole cell magic such as %%time or %%html
+        lines = [ ]
+        state = (0, None, False)
+        for line in src.split("\n"):
+            sline = line.lstrip()
+            if state == (0, None, False) and sline.startswith(("%", "!")):
+                line = line[:len(line) - len(sline)] + "pass"   # keep any enclosing block valid
+            else:
+                state = linestate(line, state)
+            lines.append(line)
+        res.append("\n".join(lines))
+    return "\n\n".join(res) + "\n"
+
+
+class _StubDisplayCalls(ast.NodeTransformer):
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        fname = func.id if isinstance(func, ast.Name) else (func.attr if isinstance(func, ast.Attribute) else None)
+        if fname in DISPLAYCALLS:
+            node.func = ast.copy_location(ast.Name(id="_databakernoop", ctx=ast.Load()), func)
+        return node
+
+
+def _databakernoop(*args, **kwargs):
+    return None
+
+
+def compilerecipe(source, filename="<notebook>"):
+    "Compile notebook source with the display-only calls stubbed out"
+    tree = ast.parse(source, filename)
+    tree = ast.fix_missing_locations(_StubDisplayCalls().visit(tree))
+    return compile(tree, filename, "exec")
+
+
+def runrecipe(code, inputfile=None, workingdir=None):
+    "Execute compiled recipe code in a fresh namespace with DATABAKER_INPUT_FILE set to the absolute path of inputfile"
+    prevenv = os.environ.get('DATABAKER_INPUT_FILE')
+    prevdir = os.getcwd()
+    if inputfile is not None:
+        os.environ['DATABAKER_INPUT_FILE'] = os.path.abspath(inputfile)   # before the chdir, which it is relative to
+    try:
+        if workingdir:
+            os.chdir(workingdir)   # as nbconvert runs the notebook from its own directory
+        ns = { "__name__":"__databaker_recipe__", "_databakernoop":_databakernoop }
+        exec(code, ns)
+    finally:
+        os.chdir(prevdir)
+        if inputfile is not None:
+            if prevenv is None:
+                del os.environ['DATABAKER_INPUT_FILE']
+            else:
+                os.environ['DATABAKER_INPUT_FILE'] = prevenv
+    return ns
+
+
+def extractrecipe(notebookfile, cachedir=None):
+    "Return the filename of the cached recipe module for a notebook, generating it if its contents have changed"
+    notebookfile = os.path.abspath(notebookfile)
+    with open(notebookfile, "rb") as fin:
+        nbbytes = fin.read()
+    nbhash = hashlib.sha1(nbbytes + (":%d" % NBRECIPE_VERSION).encode()).hexdigest()
+    cachedir = cachedir or recipecachedir()
+    modulefile = os.path.join(cachedir, "nbrecipe_%s.py" % nbhash)
+    if os.path.exists(modulefile):
+        return modulefile
+
+    source = notebooksource(json.loads(nbbytes.decode("utf-8")))
+    compilerecipe(source, notebookfile)   # fail now on syntax errors rather than at bake time
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    tmpfile = "%s.%d.tmp" % (modulefile, os.getpid())
+    with open(tmpfile, "w", encoding="utf-8") as fout:
+        fout.write(MODULE_TEMPLATE % { "notebook":notebookfile, "source":source })
+    os.replace(tmpfile, modulefile)   # atomic so concurrent workers never import a half written module
+    return modulefile
+
+
+_loadedrecipes = { }
+
+def loadnotebookrecipe(notebookfile, cachedir=None):
+    "Import the cached recipe module for a notebook (once per process) and return it"
+    modulefile = extractrecipe(notebookfile, cachedir)
+    if modulefile not in _loadedrecipes:
+        modname = os.path.splitext(os.path.basename(modulefile))[0]
+        spec = importlib.util.spec_from_file_location(modname, modulefile)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _loadedrecipes[modulefile] = module
+    return _loadedrecipes[modulefile]
+
+
+def main(argv=sys.argv[1:]):
+    if len(argv) != 1:
+        print("Usage: python -m databaker.nbrecipe <notebook_file>")
+        sys.exit(1)
+    print(extractrecipe(argv[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import warnings
 
 import xypath
 import messytables
+import messytables.excel
 
 class MatchNotFound(Exception):
     """failed to find match in bag.group"""
@@ -27,26 +28,97 @@ def tabnames(tableset):
     return set(x.name for x in tableset.tables)
 messytables.TableSet.names = tabnames
 
+# === Merged Cell Overrides ===============================
+
+def sheetspanindex(sheet):
+    """(spans, anchors) for a sheet's merged ranges, built once per sheet:
+       spans maps every (row, col) inside a merged range to its (top, bottom, left, right) box
+       and anchors maps the top-left (row, col) of each merged range to its box"""
+    spanindex = getattr(sheet, "_spanindex", None)
+    if spanindex is None:
+        spans, anchors = { }, { }
+        for rlo, rhi, clo, chi in sheet.merged_cells:
+            box = (rlo, rhi - 1, clo, chi - 1)  # note the high indexes are NOT inclusive in xlrd
+            anchors.setdefault((rlo, clo), box)
+            for row in range(rlo, rhi):
+                for col in range(clo, chi):
+                    spans.setdefault((row, col), box)  # first range wins, as in raw_span
+        spanindex = (spans, anchors)
+        sheet._spanindex = spanindex
+    return spanindex
+
+def raw_span(properties, always=False):
+    """return the bounding box of the cells it's part of."""
+    row, col = properties.cell.xlrd_pos
+    box = sheetspanindex(properties.cell.sheet)[0].get((row, col))
+    if box is None and always:
+        return (row, row, col, col)
+    return box
+messytables.excel.XLSProperties.raw_span = raw_span
+
+def cellspan(cell):
+    """(top, bottom, left, right) of the merged range containing the cell, or of the cell itself"""
+    sheet = cell.table.sheet
+    if sheet is None:   # eg tables made with Table.from_bag
+        return cell.properties.raw_span(always=True)
+    return sheetspanindex(sheet)[0].get((cell.y, cell.x), (cell.y, cell.y, cell.x, cell.x))
+
 # === Table Overrides =====================================
 
+def tablecellgrid(table):
+    """dense [y][x] grid of the table's cells (None where there is no cell).
+       built once per table and rebuilt only if cells have since been added"""
+    cellgrid = table.__dict__.get("_cellgrid")
+    if cellgrid is None or cellgrid[0] != len(table):
+        grid = [ [ None ]*(table._max_x + 1)  for y in range(table._max_y + 1) ]
+        for cell in table.unordered_cells:
+            grid[cell.y][cell.x] = cell
+        cellgrid = (len(table), grid)
+        table._cellgrid = cellgrid
+    return cellgrid[1]
+
+def cellat(table, x, y):
+    """the _XYCell at (x, y) or None"""
+    if x < 0 or y < 0:
+        return None
+    grid = tablecellgrid(table)
+    if y >= len(grid) or x >= len(grid[y]):
+        return None
+    return grid[y][x]
+
+def cellsbag(table, cells):
+    """bag from an iterable of cells (faster than unioning singleton bags)"""
+    bag = xypath.Bag(table=table)
+    for cell in cells:
+        if cell is not None:
+            bag.add(cell)
+    return bag
+
+def get_at(table, x=None, y=None):
+    """Directly get a singleton bag via the cell grid, or the whole row or column if one is None"""
+    assert isinstance(x, int) or x is None, "get_at takes integers (got {!r})".format(x)
+    assert isinstance(y, int) or y is None, "get_at takes integers (got {!r})".format(y)
+    if x is None and y is None:
+        raise TypeError('get_at requires at least one x or y value')
+    if x is None:
+        return table._y_index.get(y, xypath.Bag(table))
+    if y is None:
+        return table._x_index.get(x, xypath.Bag(table))
+    return cellsbag(table, [ cellat(table, x, y) ])
+xypath.Table.get_at = get_at
+
 def excel_ref(table, reference):
     if ':' not in reference:
         (col, row) = xypath.contrib.excel.excel_address_coordinate(reference, partial=True)
         return table.get_at(col, row)
     else:
         ((left, top), (right, bottom)) = xypath.contrib.excel.excel_range(reference)
-        bag = xypath.Bag(table=table)
         if top is None and bottom is None:
-            for col in range(left, right + 1):
-                bag = bag | table.get_at(col, None)
+            return cellsbag(table, (cell  for col in range(left, right + 1)  for cell in table.get_at(col, None).unordered_cells))
         elif left is None and right is None:
-            for row in range(top, bottom + 1):
-                bag = bag | table.get_at(None, row)
+            return cellsbag(table, (cell  for row in range(top, bottom + 1)  for cell in table.get_at(None, row).unordered_cells))
         else:
-            for row in range(top, bottom + 1):
-                for col in range(left, right + 1):
-                    bag = bag | table.get_at(col, row)
-        return bag
+            return cellsbag(table, (cellat(table, col, row)  for row in range(top, bottom + 1)  for col in range(left, right + 1)))
 xypath.Table.excel_ref = excel_ref
 
 # copied in just for one function to enable deletion of utils.py
@@ -110,20 +182,25 @@ xypath.Bag.one_of = one_of
 def parent(bag):
     """for cell, get its top-left cell"""
     output_bag = xypath.Bag(table = bag.table)
-    for cell in bag.unordered:
-        row, _, col, _ = cell.properties.raw_span(always=True)
-        output_bag.add(cell.table.get_at(col, row)._cell)
+    for cell in bag.unordered_cells:
+        row, _, col, _ = cellspan(cell)
+        topleft = cellat(cell.table, col, row)
+        if topleft is None:
+            raise xypath.XYPathError("No top-left cell at ({}, {}) for {!r}".format(col, row, cell))
+        output_bag.add(topleft)
     return output_bag
 xypath.Bag.parent = parent
 
 def children(bag):
     """for top-left cell, get all cells it spans"""
     outputbag = xypath.Bag(table=bag.table)
-    for parent in bag:
-        top, bottom, left, right = parent.properties.raw_span(always=True)
+    for parent in bag.unordered_cells:
+        top, bottom, left, right = cellspan(parent)
         for row in range(top, bottom + 1):
             for col in range(left, right + 1):
-                outputbag = outputbag | bag.table.get_at(col, row)
+                cell = cellat(bag.table, col, row)
+                if cell is not None:
+                    outputbag.add(cell)
     return outputbag
 xypath.Bag.children = children
 
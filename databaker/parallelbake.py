@@ -0,0 +1,150 @@
+"""
+Processing ConversionSegments in several worker processes, with big segments
+split into chunks so that one huge tab doesn't leave the other cores idle.
+
+    timeunitmessages = processsegments(conversionsegments, jobs=8)
+    writetechnicalCSV(outputfile, conversionsegments)
+
+Each segment's obslist is cut into runs of whole rows (at most about
+1/CHUNKSPERJOB of an even share of all the observations, and at least
+MINCHUNKOBS), and the chunks go into the pool's queue largest first, so
+the workers take the next chunk as they become free and the long chunks
+are not left to the end.  The workers look up their chunks into rows of
+ids in a ValuePool of their own and send the rows and the pool back; the
+parent interns the values into the segment's pool, concatenates the chunks
+in the segment's (y, x) order and then guesses and fixes the TIMEUNIT over
+the whole segment, exactly as process() would.
+
+The workers are forked from the parent so that they share its tables,
+segments and dimensions (with their lookup indexes built beforehand)
+without pickling them.  Where processes can't be forked (Windows, and the
+default on macOS) the segments are processed in this process.  So are the
+segments whose chunks were lost when a worker died (killed for running out
+of memory, say), with a warning, once the broken pool has been shut down.
+"""
+
+import gc, warnings, multiprocessing, concurrent.futures
+from databaker.valuepool import ValuePool, MISSING
+from databaker.memtrack import memorystage
+
+CHUNKSPERJOB = 4       # chunks per worker that the observations are cut into, so that the load evens out
+MINCHUNKOBS = 2000     # smallest chunk worth sending to another process
+
+# the segments being processed, set in the parent before the workers fork from it
+PARALLELSEGMENTS = None
+
+
+def rowchunks(obslist, chunkobs):
+    "[ (start, end) ] of runs of about chunkobs observations, cut only where the row changes"
+    res = [ ]
+    start = 0
+    n = len(obslist)
+    while start < n:
+        end = min(n, start + chunkobs)
+        while end < n and obslist[end].y == obslist[end - 1].y:
+            end += 1
+        res.append((start, end))
+        start = end
+    return res
+
+
+def processchunk(task):
+    "In a worker: look up the observations start:end of a segment into rows of ids in a new ValuePool"
+    isegment, start, end = task
+    conversionsegment = PARALLELSEGMENTS[isegment]
+    conversionsegment.valuepool = ValuePool()   # this is the worker's forked copy
+    icolumns, idims = conversionsegment.setuprowcolumns()
+    rowids = list(conversionsegment.iterrowids(icolumns, idims, conversionsegment.obslist[start:end]))
+    return isegment, start, rowids, conversionsegment.valuepool.values
+
+
+def remaprows(conversionsegment, rowids, values):
+    "Rows of ids in a worker's pool turned into ids in the segment's pool"
+    intern = conversionsegment.valuepool.intern
+    poolids = [ MISSING ] + [ intern(value)  for value in values[1:] ]
+    pooled = [ i  for i in range(len(conversionsegment.rowcolumns))  if i not in conversionsegment.rawcolumns ]
+    res = [ ]
+    for row in rowids:
+        row = list(row)
+        for i in pooled:
+            row[i] = poolids[row[i]]
+        res.append(tuple(row))
+    return res
+
+
+def canfork():
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def processsegments(conversionsegments, jobs=None, chunkobs=None):
+    """Process the unprocessed segments of a list in jobs worker processes (default one per core),
+       returning the timeunit message of each (as process() returns it, or None for those already processed)"""
+    global PARALLELSEGMENTS
+    jobs = jobs or multiprocessing.cpu_count()
+    res = [ None ]*len(conversionsegments)
+    unprocessed = [ isegment  for isegment, conversionsegment in enumerate(conversionsegments)  if not conversionsegment.isprocessed() ]
+    nobs = sum(len(conversionsegments[isegment].obslist)  for isegment in unprocessed)
+    if jobs == 1 or nobs < MINCHUNKOBS or not canfork():
+        for isegment in unprocessed:
+            res[isegment] = conversionsegments[isegment].process()
+        return res
+
+    pending = [ ]
+    cachekeys = { }
+    for isegment in unprocessed:
+        conversionsegment = conversionsegments[isegment]
+        segmentcache = conversionsegment.context.segmentcache
+        if segmentcache is not None:   # hits are filled in here, as in process()
+            cachekeys[isegment], timeunitmessage = segmentcache.lookup(conversionsegment)
+            if timeunitmessage is not None:
+                res[isegment] = timeunitmessage
+                continue
+        pending.append(isegment)
+    if not pending:
+        return res
+
+    if chunkobs is None:
+        chunkobs = max(MINCHUNKOBS, sum(len(conversionsegments[isegment].obslist)  for isegment in pending)//(jobs*CHUNKSPERJOB))
+    tasks = [ (isegment, start, end)  for isegment in pending  for start, end in rowchunks(conversionsegments[isegment].obslist, chunkobs) ]
+    tasks.sort(key=lambda task: task[1] - task[2])   # largest first
+    for isegment in pending:   # built once here rather than in every worker
+        for dimension in conversionsegments[isegment].dimensions:
+            if dimension.hbagset is not None:
+                dimension.lookupindex()
+
+    chunks = dict((isegment, { })  for isegment in pending)
+    nchunks = dict((isegment, 0)  for isegment in pending)
+    for isegment, start, end in tasks:
+        nchunks[isegment] += 1
+    PARALLELSEGMENTS = conversionsegments
+    gc.freeze()   # keep the workers' garbage collections off the pages they share with this process
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = [ executor.submit(processchunk, task)  for task in tasks ]
+            for future in concurrent.futures.as_completed(futures):
+                isegment, start, rowids, values = future.result()
+                chunks[isegment][start] = (rowids, values)
+    except concurrent.futures.process.BrokenProcessPool:
+        pass   # the segments with chunks missing are processed below
+    finally:
+        PARALLELSEGMENTS = None
+        gc.unfreeze()
+
+    for isegment in pending:
+        conversionsegment = conversionsegments[isegment]
+        context = conversionsegment.context
+        if len(chunks[isegment]) != nchunks[isegment]:
+            warnings.warn("A worker process died; processing segment %d (%s) in this process" % (isegment, conversionsegment.tab.name))
+            del chunks[isegment]
+            res[isegment] = conversionsegment.process()
+            continue
+        with memorystage(context.memorytracker, "process", conversionsegment.tab.name, len(conversionsegment.obslist)):
+            conversionsegment.setuprowcolumns()
+            rowids = [ ]
+            for start in sorted(chunks[isegment]):
+                rowids.extend(remaprows(conversionsegment, *chunks[isegment].pop(start)))
+            conversionsegment.rowids = rowids
+            res[isegment] = conversionsegment.settletimeunit()
+            if context.segmentcache is not None:
+                context.segmentcache.store(cachekeys[isegment], conversionsegment, res[isegment])
+    return res
@@ -0,0 +1,287 @@
+"""
+Persistent cache of processed ConversionSegments, so that re-baking a workbook
+whose sheets have not changed skips the lookups.
+
+The key of a segment is a hash of everything process() reads: the cells of its
+sheet, the observations, each dimension (header cells, direction, strictness,
+tie policy and overrides) and the template settings of its BakeContext.  The
+stored value is the processed output in columns, with the dimension values
+numbered within the entry so it can be interned into any bake's ValuePool.
+
+Use it by giving a BakeContext a SegmentCache:
+
+    context = BakeContext(segmentcache=SegmentCache("~/.databaker/segments"))
+
+after which ConversionSegment.process() (and so the writers) look up and
+fill the cache.  Entries are files in the cache directory, evicted least
+recently used first when they grow over maxbytes.
+
+Functions in the overrides are keyed by their code, defaults, closure
+values, the globals they use and (for methods) the object they are bound
+to.  A segment with an override that can't be keyed that way (a callable
+object, or a value other than plain data) is processed without the cache.
+"""
+
+import os, pickle, hashlib, tempfile, threading, datetime, types, functools
+import xypath
+from databaker.jupybakeutils import cellsvalueformat, notscriptvalue
+from databaker.valuepool import MISSING
+
+CACHEFORMAT = 1   # bump when the key or the stored columns change meaning
+ENTRYSUFFIX = ".segment"
+
+# the settings of a BakeContext that process() reads
+KEYSETTINGS = [ "OBS", "DATAMARKER", "TIME", "TIMEUNIT", "SH_Split_OBS", "SH_Create_ONS_time", "headermeasurementnames" ]
+
+
+# values keyed by their repr
+PLAINTYPES = (str, int, float, bool, bytes, type(None), datetime.date, datetime.time, datetime.timedelta)
+
+# callables implemented in C, keyed by name and the object they are bound to
+BUILTINTYPES = (types.BuiltinFunctionType, types.MethodDescriptorType, types.WrapperDescriptorType, types.MethodWrapperType, types.ClassMethodDescriptorType)
+
+
+class Uncacheable(Exception):
+    "An override that can't be keyed, so its segment is processed without the cache"
+
+
+def keyitem(value, seen=frozenset()):
+    "A stable text for an override key or value (cells by position, types by name, functions by what they compute with)"
+    if isinstance(value, xypath.xypath._XYCell):
+        return "cell(%d,%d)" % (value.x, value.y)
+    if isinstance(value, type):
+        return "type(%s.%s)" % (value.__module__, value.__qualname__)
+    if isinstance(value, PLAINTYPES):
+        return "%s(%r)" % (type(value).__name__, value)
+    if isinstance(value, (list, tuple)):
+        return "%s[%s]" % (type(value).__name__, ",".join(keyitem(v, seen)  for v in value))
+    if isinstance(value, (set, frozenset)):
+        return "%s{%s}" % (type(value).__name__, ",".join(sorted(keyitem(v, seen)  for v in value)))
+    if isinstance(value, dict):
+        return "%s{%s}" % (type(value).__name__, ",".join(sorted("%s:%s" % (keyitem(k, seen), keyitem(v, seen))  for k, v in value.items())))
+    if isinstance(value, types.ModuleType):
+        return "module(%s)" % value.__name__
+    if callable(value):
+        return functionkey(value, seen)
+    raise Uncacheable("can't key %s in the segment cache" % type(value).__name__)
+
+
+def codekey(code):
+    "Text of a code object's bytecode, constants and the names it uses"
+    consts = [ (codekey(c)  if isinstance(c, types.CodeType)  else keyitem(c))  for c in code.co_consts ]
+    return "code(%s:%s:%s)" % (code.co_code.hex(), ",".join(consts), ",".join(code.co_names))
+
+def codenames(code):
+    "The names a code object and the code nested in it look up"
+    res = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            res |= codenames(c)
+    return res
+
+
+def functionkey(func, seen):
+    "keyitem of a callable, recursing through what it is bound to and closes over"
+    name = "%s.%s" % (getattr(func, "__module__", None) or getattr(getattr(func, "__objclass__", None), "__module__", ""), getattr(func, "__qualname__", ""))
+    if id(func) in seen:   # a function that uses itself
+        return "recursive(%s)" % name
+    seen = seen | { id(func) }
+    if isinstance(func, functools.partial):
+        return "partial(%s:%s:%s)" % (keyitem(func.func, seen), keyitem(func.args, seen), keyitem(func.keywords or { }, seen))
+    if isinstance(func, types.MethodType):
+        return "method(%s:%s)" % (keyitem(func.__self__, seen), keyitem(func.__func__, seen))
+    if isinstance(func, types.FunctionType):
+        try:
+            closure = [ cell.cell_contents  for cell in (func.__closure__ or ()) ]
+        except ValueError:   # a closure variable not yet assigned
+            raise Uncacheable("can't key %s in the segment cache" % name)
+        usedglobals = dict((k, func.__globals__[k])  for k in codenames(func.__code__)  if k in func.__globals__)
+        return "func(%s:%s:%s:%s:%s:%s)" % (name, codekey(func.__code__), keyitem(func.__defaults__ or (), seen), 
+                                            keyitem(func.__kwdefaults__ or { }, seen), keyitem(closure, seen), keyitem(usedglobals, seen))
+    if isinstance(func, BUILTINTYPES):
+        bound = getattr(func, "__self__", None)
+        if bound is None or isinstance(bound, types.ModuleType):
+            return "builtin(%s)" % name
+        return "builtin(%s:%s)" % (name, keyitem(bound, seen))
+    raise Uncacheable("can't key callable %s in the segment cache" % type(func).__name__)
+
+
+def sheetdigest(tab):
+    "Hash of the values of every cell of a table (and the date formats that svalue uses), worked out once per table"
+    digest = getattr(tab, "_sheetdigest", None)
+    if digest is None:
+        cells = sorted((cell.y, cell.x, type(cell.value).__name__, cell.value, (cellsvalueformat(cell)  if isinstance(cell.value, datetime.datetime)  else None))  for cell in tab.unordered_cells)
+        h = hashlib.sha256(repr((tab.name, cells)).encode())
+        digest = tab._sheetdigest = h.hexdigest()
+    return digest
+
+
+def segmentkey(conversionsegment):
+    "The cache key of a ConversionSegment: a hash of its sheet, observations, dimensions and template (None if it can't be keyed)"
+    context = conversionsegment.context
+    h = hashlib.sha256(("databaker segment %d\n" % CACHEFORMAT).encode())
+    h.update(sheetdigest(conversionsegment.tab).encode())
+    h.update(repr([ (k, getattr(context, k))  for k in KEYSETTINGS ]).encode())
+    h.update(repr((conversionsegment.processtimeunit, conversionsegment.includecellxy)).encode())
+    for ob in conversionsegment.obslist:
+        h.update(("%d,%d" % (ob.x, ob.y)).encode())
+        if not isinstance(ob.value, float) and ob.properties['richtext']:   # obsvalues() reads the text without footnote markers
+            h.update(repr(notscriptvalue(ob)).encode())
+        h.update(b";")
+    for dimension in conversionsegment.dimensions:
+        h.update(("\ndimension %r\n" % dimension.label).encode())
+        if dimension.hbagset is not None:
+            h.update(repr((dimension.strict, dimension.direction, dimension.tiepolicy)).encode())
+            h.update(repr(sorted((hcell.x, hcell.y)  for hcell in dimension.hbagset.unordered_cells)).encode())
+        try:
+            h.update(repr(sorted((keyitem(k), keyitem(v))  for k, v in dimension.cellvalueoverride.items())).encode())
+        except Uncacheable:
+            return None
+    return h.hexdigest()
+
+
+def segmentcolumns(conversionsegment):
+    "The processed output of a segment as columns, with pooled ids renumbered within the entry"
+    localids = { MISSING:MISSING }
+    localvalues = [ None ]
+    poolvalues = conversionsegment.valuepool.values
+    columns = [ ]
+    for i in range(len(conversionsegment.rowcolumns)):
+        column = [ row[i]  for row in conversionsegment.rowids ]
+        if i not in conversionsegment.rawcolumns:
+            for v in set(column) - set(localids):
+                localids[v] = len(localvalues)
+                localvalues.append(poolvalues[v])
+            column = [ localids[v]  for v in column ]
+        columns.append(column)
+    return { "rowcolumns":list(conversionsegment.rowcolumns), "rawcolumns":sorted(conversionsegment.rawcolumns),
+             "values":localvalues, "columns":columns, "nrows":len(conversionsegment.rowids) }
+
+
+def restoresegment(conversionsegment, entry):
+    "Fill in the processed rows of a segment from a cache entry, interning its values into the segment's pool"
+    intern = conversionsegment.valuepool.intern
+    poolids = [ MISSING ] + [ intern(value)  for value in entry["values"][1:] ]
+    rawcolumns = set(entry["rawcolumns"])
+    columns = [ (column  if i in rawcolumns  else [ poolids[v]  for v in column ])  for i, column in enumerate(entry["columns"]) ]
+    conversionsegment.rowcolumns = list(entry["rowcolumns"])
+    conversionsegment.rawcolumns = rawcolumns
+    conversionsegment.rowids = list(zip(*columns))  if columns  else [ () ]*entry["nrows"]
+
+
+class SegmentCache:
+    "Size bounded, least recently used, on disk store of processed segments with hit and miss counts"
+    def __init__(self, directory, maxbytes=256*1024*1024):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.uncacheable = 0   # segments processed without the cache as their overrides can't be keyed
+
+    def entrypath(self, key):
+        return os.path.join(self.directory, key + ENTRYSUFFIX)
+
+    def get(self, key):
+        "The stored entry for a key, or None"
+        path = self.entrypath(key)
+        try:
+            with open(path, "rb") as fin:
+                entry = pickle.load(fin)
+            os.utime(path)   # the file times are the recency for eviction
+        except FileNotFoundError:
+            entry = None
+        except (OSError, EOFError, pickle.UnpicklingError):   # a damaged entry is dropped and recomputed
+            self.discard(path)
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        "Store an entry, written to a temporary file and renamed so readers never see half of it"
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                pickle.dump(entry, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, self.entrypath(key))
+        except BaseException:
+            self.discard(tmppath)
+            raise
+        with self.lock:
+            self.stores += 1
+        self.evict()
+
+    def entries(self):
+        "[ (last used time, size, path) ] of the entries, least recently used first"
+        res = [ ]
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRYSUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:   # evicted by another bake
+                    continue
+                res.append((st.st_mtime, st.st_size, path))
+        res.sort()
+        return res
+
+    def evict(self):
+        "Remove least recently used entries until the cache fits in maxbytes"
+        entries = self.entries()
+        total = sum(size  for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxbytes:
+                break
+            self.discard(path)
+            total -= size
+            with self.lock:
+                self.evictions += 1
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            self.discard(path)
+
+    def lookup(self, conversionsegment):
+        "Fill in a segment's processed rows from the cache, returning (key, timeunitmessage) with a message of None on a miss"
+        key = segmentkey(conversionsegment)
+        if key is None:
+            with self.lock:
+                self.uncacheable += 1
+            return None, None
+        entry = self.get(key)
+        if entry is None:
+            return key, None
+        restoresegment(conversionsegment, entry)
+        return key, entry["timeunitmessage"]
+
+    def store(self, key, conversionsegment, timeunitmessage):
+        if key is None:
+            return
+        entry = segmentcolumns(conversionsegment)
+        entry["timeunitmessage"] = timeunitmessage
+        self.put(key, entry)
+
+    def stats(self):
+        "Counts of lookups, stores and evictions in this process, and the size of the cache on disk"
+        entries = self.entries()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return { "hits":self.hits, "misses":self.misses, "hitrate":(self.hits/lookups  if lookups  else 0.0),
+                     "stores":self.stores, "evictions":self.evictions, "uncacheable":self.uncacheable,
+                     "entries":len(entries), "bytes":sum(size  for mtime, size, path in entries), "maxbytes":self.maxbytes }
+
+    def __repr__(self):
+        return "<SegmentCache %s hits=%d misses=%d>" % (self.directory, self.hits, self.misses)
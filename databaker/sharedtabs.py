@@ -0,0 +1,308 @@
+"""
+Loaded sheets in shared memory, for bakes that process the segments of one big
+workbook in several processes.
+
+The parent loads the workbook once (any loadxlstabs backend) and copies its
+tables into a single multiprocessing.shared_memory block: numeric arrays of
+cell positions, value kinds, styles and values, a string table holding each
+distinct text once, and the styles and merged ranges.  Workers attach to the
+block by name and read the arrays in place, rather than re-loading the
+workbook or being sent pickled tables, and rebuild only the tables they ask
+for, with small XLSXProperties like databaker.xlsxloader makes.
+
+    with SharedTables(loadxlstabs(inputfile)) as shared:
+        pool.map(bakeworker, [ (shared.name, tabname)  for tabname in shared.tabnames ])
+
+    def bakeworker(args):
+        tab, = attachtables(args[0], args[1])
+        ...
+
+packtables() and unpacktables() do the same with the block in ordinary memory,
+for keeping a compact copy of a workbook that fresh tables can be made from.
+"""
+
+import gc, json, array, struct, datetime
+import xypath
+from databaker.xlsxloader import XLSXStyle, XLSXProperties, XLSXSheet
+from databaker.jupybakeutils import notscriptvalue
+
+MAGIC = b"DBSHTAB1"
+HEADER = struct.Struct("<8sQ")   # magic, length of the json layout that follows
+
+# the kinds of cell value; numbers are held in the value array and the rest as an index into the string table
+KIND_STR, KIND_FLOAT, KIND_INT, KIND_BOOL, KIND_NONE, KIND_DATETIME, KIND_DATE, KIND_TIME = range(8)
+DATEKINDS = [ (datetime.datetime, KIND_DATETIME, datetime.datetime.fromisoformat),
+              (datetime.date, KIND_DATE, datetime.date.fromisoformat),
+              (datetime.time, KIND_TIME, datetime.time.fromisoformat) ]
+NOSCRIPT = -1   # in the notscript array for cells that are not rich text
+
+# name and array (and memoryview) typecode of the per cell arrays of a table
+CELLARRAYS = [ ("x", "i"), ("y", "i"), ("kind", "B"), ("style", "i"), ("value", "d"), ("notscript", "i") ]
+
+
+def alignedsize(b):
+    "The length (of a bytes-like object or a number) rounded up to a multiple of 8"
+    n = b  if isinstance(b, int)  else len(b)
+    return -(-n // 8)*8
+
+def sharedmemory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("SharedTables needs multiprocessing.shared_memory (Python 3.8 or later)")
+    return shared_memory
+
+
+def cellstylekey(cell):
+    "Something that is the same for cells with the same style, so each style is read only once"
+    properties = cell.properties
+    style = getattr(properties, "style", None)
+    if isinstance(style, XLSXStyle):
+        return id(style)
+    try:
+        return (id(properties.cell.sheet.book), properties.cell.xlrd_cell.xf_index)
+    except AttributeError:
+        return None   # read every time
+
+def cellstyle(cell):
+    "(formatting_string, a_date, bold, italic) of a cell"
+    properties = cell.properties
+    res = [ ]
+    for key, default in [ ("formatting_string", "General"), ("a_date", False), ("bold", False), ("italic", False) ]:
+        try:
+            res.append(properties[key])
+        except (IndexError, AttributeError, KeyError):   # as in cellbold, some files don't have font information
+            res.append(default)
+    return tuple(res)
+
+
+class StringTable:
+    "Distinct strings numbered in the order first seen"
+    def __init__(self):
+        self.ids = { }
+        self.strings = [ ]
+
+    def add(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+
+def packtable(tab, strings, styles, stylekeys):
+    "The per cell arrays and the layout of one table"
+    arrays = dict((name, array.array(typecode))  for name, typecode in CELLARRAYS)
+    x, y, kind, style, value, notscript = [ arrays[name]  for name, typecode in CELLARRAYS ]
+    for cell in tab.unordered_cells:
+        x.append(cell.x)
+        y.append(cell.y)
+        key = cellstylekey(cell)
+        s = stylekeys.get(key)  if key is not None  else None
+        if s is None:
+            s = styles.setdefault(cellstyle(cell), len(styles))
+            if key is not None:
+                stylekeys[key] = s
+        style.append(s)
+
+        v = cell.value
+        tv = type(v)
+        if tv is str:
+            kind.append(KIND_STR)
+            value.append(strings.add(v))
+        elif tv is float:
+            kind.append(KIND_FLOAT)
+            value.append(v)
+        elif tv is int:
+            kind.append(KIND_INT)
+            value.append(v)
+        elif tv is bool:
+            kind.append(KIND_BOOL)
+            value.append(v)
+        elif v is None:
+            kind.append(KIND_NONE)
+            value.append(0)
+        else:
+            for datetype, datekind, fromisoformat in DATEKINDS:
+                if isinstance(v, datetype):
+                    kind.append(datekind)
+                    value.append(strings.add(v.isoformat()))
+                    break
+            else:
+                raise TypeError("Can't share cell (%d,%d) of %s with a value of type %s" % (cell.x, cell.y, tab.name, tv.__name__))
+
+        if tv is str and cell.properties['richtext']:
+            notscript.append(strings.add(notscriptvalue(cell)))
+        else:
+            notscript.append(NOSCRIPT)
+
+    sheet = getattr(tab, "sheet", None)
+    layout = { "name":tab.name, "index":getattr(tab, "index", None), "ncells":len(x),
+               "merged_cells":[ list(m)  for m in getattr(sheet, "merged_cells", [ ]) ],
+               "nrows":getattr(sheet, "nrows", tab._max_y + 1), "ncols":getattr(sheet, "ncols", tab._max_x + 1) }
+    return layout, arrays
+
+
+def packtables(tabs):
+    "(bytearray, table names) of xypath tables packed into one block, as SharedTables puts it in shared memory"
+    strings = StringTable()
+    styles = { }      # style tuple -> number
+    stylekeys = { }   # cellstylekey -> number
+    packed = [ packtable(tab, strings, styles, stylekeys)  for tab in tabs ]
+
+    encoded = [ s.encode("utf-8", "surrogatepass")  for s in strings.strings ]
+    stringoffsets = array.array("q", [ 0 ])
+    for b in encoded:
+        stringoffsets.append(stringoffsets[-1] + len(b))
+    sections = [ ]   # (offset, bytes) with each placed at a multiple of 8
+    def addsection(data):
+        b = memoryview(data).cast("B")
+        offset = sections[-1][0] + alignedsize(sections[-1][1])  if sections  else 0
+        sections.append((offset, b))
+        return offset
+
+    layout = { "styles":[ list(style)  for style in sorted(styles, key=styles.get) ], "tables":[ ] }
+    layout["stringoffsets"] = [ addsection(stringoffsets), len(stringoffsets) ]
+    layout["stringbytes"] = addsection(b"".join(encoded))
+    for tablelayout, arrays in packed:
+        for arrayname, typecode in CELLARRAYS:
+            tablelayout[arrayname] = addsection(arrays[arrayname])
+        layout["tables"].append(tablelayout)
+    jlayout = json.dumps(layout).encode()
+    datastart = alignedsize(HEADER.size + len(jlayout))
+    size = datastart + sum(alignedsize(b)  for offset, b in sections)
+
+    buf = bytearray(size)
+    HEADER.pack_into(buf, 0, MAGIC, len(jlayout))
+    buf[HEADER.size:HEADER.size + len(jlayout)] = jlayout
+    for offset, b in sections:
+        buf[datastart + offset:datastart + offset + len(b)] = b
+    return buf, [ tablelayout["name"]  for tablelayout, arrays in packed ]
+
+
+class SharedTables:
+    "Copies of xypath tables in one block of shared memory that other processes attach to by its name"
+    def __init__(self, tabs, name=None):
+        block, self.tabnames = packtables(tabs)
+        self.nbytes = len(block)
+        self.shm = sharedmemory().SharedMemory(name=name, create=True, size=max(self.nbytes, 1))
+        self.shm.buf[:self.nbytes] = block
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        "Free the shared memory (once the workers are done with it)"
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        self.unlink()
+
+    def __repr__(self):
+        return "<SharedTables %s of %d tables in %d bytes>" % (self.name, len(self.tabnames), self.nbytes)
+
+
+def attachshm(name, track=False):
+    shared_memory = sharedmemory()
+    if not track:
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)   # the creator looks after unlinking it
+        except TypeError:   # before Python 3.13
+            pass
+    return shared_memory.SharedMemory(name=name)
+
+
+def attachtables(name, sheetids="*", unlink=False):
+    """The tables published in the SharedTables of the given name (or those with names in sheetids),
+       rebuilt from the shared arrays without copying them out first.  unlink=True frees the block 
+       afterwards, for when this is the only process that will attach to it"""
+    shm = attachshm(name, track=unlink)
+    try:
+        return unpacktables(shm.buf, sheetids)
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def unpacktables(buf, sheetids="*"):
+    "New xypath tables (those with names in sheetids) from a block made by packtables or in a SharedTables"
+    if isinstance(sheetids, str) and sheetids != "*":
+        sheetids = [ sheetids ]
+    buf = memoryview(buf)
+    views = [ buf ]   # every view of the block has to be released before shared memory can be closed
+    try:
+        magic, jlength = HEADER.unpack_from(buf, 0)
+        assert magic == MAGIC, "not a block of packed tables"
+        layout = json.loads(bytes(buf[HEADER.size:HEADER.size + jlength]).decode())
+        datastart = alignedsize(HEADER.size + jlength)
+        data = buf[datastart:]
+        views.append(data)
+        styles = [ XLSXStyle(*style)  for style in layout["styles"] ]
+        offsetsstart, noffsets = layout["stringoffsets"]
+        stringoffsets = data[offsetsstart:offsetsstart + 8*noffsets].cast("q")
+        stringbytes = data[layout["stringbytes"]:]
+        views.extend([ stringoffsets, stringbytes ])
+        strings = [ None ]*(noffsets - 1)   # decoded when first used
+        def string(i):
+            s = strings[i]
+            if s is None:
+                s = strings[i] = bytes(stringbytes[stringoffsets[i]:stringoffsets[i+1]]).decode("utf-8", "surrogatepass")
+            return s
+
+        res = [ ]
+        gcenabled = gc.isenabled()
+        gc.disable()   # as in xlsxloader.readsheet
+        try:
+            for tablelayout in layout["tables"]:
+                if sheetids == "*" or tablelayout["name"] in sheetids:
+                    res.append(buildtable(tablelayout, data, styles, string))
+        finally:
+            if gcenabled:
+                gc.enable()
+    finally:
+        for view in reversed(views):
+            view.release()
+    return res
+
+
+def buildtable(tablelayout, data, styles, string):
+    "An xypath Table from the shared arrays of one table"
+    ncells = tablelayout["ncells"]
+    views = { }
+    for name, typecode in CELLARRAYS:
+        offset = tablelayout[name]
+        views[name] = data[offset:offset + ncells*array.array(typecode).itemsize].cast(typecode)
+    sheet = XLSXSheet(None, tablelayout["name"], tablelayout["index"])
+    sheet.merged_cells = [ tuple(m)  for m in tablelayout["merged_cells"] ]
+    sheet.nrows, sheet.ncols = tablelayout["nrows"], tablelayout["ncols"]
+    table = xypath.Table(name=tablelayout["name"])
+    table.sheet = sheet
+    table.index = tablelayout["index"]
+    XYCell = xypath.xypath._XYCell
+    fromisoformat = dict((datekind, fromisoformat)  for datetype, datekind, fromisoformat in DATEKINDS)
+    try:
+        for x, y, kind, style, value, notscript in zip(*[ views[name]  for name, typecode in CELLARRAYS ]):
+            if kind == KIND_STR:
+                value = string(int(value))
+            elif kind == KIND_INT:
+                value = int(value)
+            elif kind == KIND_BOOL:
+                value = bool(value)
+            elif kind == KIND_NONE:
+                value = None
+            elif kind != KIND_FLOAT:
+                value = fromisoformat[kind](string(int(value)))
+            table.add(XYCell(value, x, y, table, XLSXProperties(sheet, y, x, styles[style], value, (string(notscript)  if notscript != NOSCRIPT  else None))))
+    finally:
+        for view in views.values():
+            view.release()
+    return table
@@ -41,10 +41,9 @@ SH_Split_OBS = "DATAMARKER"  # see value set to int value below
 headermeasurementnames = list(collections.OrderedDict.fromkeys(k[1]  for k in headermeasurements  if isinstance(k, tuple)))
 headermeasurementnamesSet = set(headermeasurementnames) 
 
-# Create variables (This is terrible!)
-# TODO: Do this more cleanly e.g. as in https://stackoverflow.com/q/4859217/
-exec("%s = '%s'" % (", ".join(headermeasurementnames), "', '".join(map(str, headermeasurementnames))))
-exec("SH_Split_OBS = %s" % SH_Split_OBS)
+# Create variables named after themselves, eg OBS = "OBS", for use in recipes
+globals().update((headermeasurementname, headermeasurementname)  for headermeasurementname in headermeasurementnames)
+SH_Split_OBS = globals().get(SH_Split_OBS, SH_Split_OBS)
 
 __all__ = list(headermeasurementnames) # don't expose unnecessary items when using `from foo import *`
 
@@ -0,0 +1,51 @@
+"""
+Bake-wide interning of dimension values.
+
+Every distinct dimension value (header text, time label, data marker, ...) is
+stored once in a ValuePool and processed rows hold its integer id instead, so
+repeated values across the segments and tabs of a bake cost one pointer each
+and compare and hash as small ints.
+"""
+
+import threading
+
+MISSING = 0   # the id for "no value in this row", as opposed to a value of None
+
+
+class ValuePool:
+    "Interns values to integer ids (ids start at 1; values[MISSING] is a placeholder)"
+    def __init__(self):
+        self.values = [ None ]
+        self.ids = { }
+        self.lock = threading.Lock()
+
+    def intern(self, value):
+        # str is by far the commonest; anything else is keyed with its type so 2012 and 2012.0 stay apart
+        key = value  if type(value) is str  else (type(value), value)
+        i = self.ids.get(key)
+        if i is None:
+            with self.lock:
+                i = self.ids.get(key)
+                if i is None:
+                    i = len(self.values)
+                    self.values.append(value)
+                    self.ids[key] = i
+        return i
+
+    def value(self, i):
+        return self.values[i]
+
+    def __len__(self):
+        return len(self.values) - 1
+
+    def __repr__(self):
+        return "<ValuePool of %d values>" % len(self)
+
+
+def tabvaluepool(tab):
+    """The ValuePool of a table, for segments made without a BakeContext: loadxlstabs gives the tables of 
+       a workbook one between them, so the pool lasts as long as the workbook rather than the process"""
+    valuepool = getattr(tab, "valuepool", None)
+    if valuepool is None:
+        valuepool = tab.valuepool = ValuePool()
+    return valuepool
@@ -0,0 +1,110 @@
+"""
+Direct loader for .xls workbooks, used by loadxlstabs(..., backend="xlrd").
+
+Each sheet is read with xlrd's own sheet API in one pass: the values, the
+XF record styles (format string, date flag, bold and italic), the merged
+ranges and the rich text runs (turned straight into the text without its
+superscript and subscript parts).  The xypath table is built from that with
+small XLSXProperties as databaker.xlsxloader makes, instead of a messytables
+cell and properties object per cell that reach back into xlrd.  Sheets are
+opened on demand, so unselected ones are never parsed, and each is unloaded
+from xlrd once its table is built.  The values come out as through messytables.
+"""
+
+import gc
+import xlrd
+import xypath
+from databaker.xlsxloader import XLSXStyle, XLSXProperties, XLSXSheet, xldatevalue
+
+GENERALSTYLE = XLSXStyle("General", False, False, False)   # for workbooks read without formatting information
+
+
+def bookstyles(book):
+    "XLSXStyle of each XF record of a book, from its format and font"
+    res = [ ]
+    for xf in book.xf_list:
+        fmt = book.format_map.get(xf.format_key)
+        font = book.font_list[xf.font_index]
+        res.append(XLSXStyle(fmt.format_str  if fmt  else "General", (fmt is not None and fmt.type == xlrd.formatting.FDT),
+                             font.weight > 500, bool(font.italic)))
+    return res
+
+
+def notscripttext(book, text, firstfont, runlist):
+    "The text of a rich text cell without its superscript and subscript runs, as richxlrd's fragments.not_script.value"
+    fonts = [ (0, firstfont) ] + list(runlist)
+    res = [ ]
+    for i, (start, fontindex) in enumerate(fonts):
+        end = fonts[i+1][0]  if i + 1 < len(fonts)  else None
+        if not book.font_list[fontindex].escapement:
+            res.append(text[start:end])
+    return "".join(res)
+
+
+def readsheet(book, sheetindex, styles):
+    "Read one sheet of an xlrd book into a new xypath Table"
+    gcenabled = gc.isenabled()
+    gc.disable()   # as in xlsxloader.readsheet
+    try:
+        return _readsheet(book, sheetindex, styles)
+    finally:
+        if gcenabled:
+            gc.enable()
+
+def _readsheet(book, sheetindex, styles):
+    xsheet = book.sheet_by_index(sheetindex)
+    name = xsheet.name
+    sheet = XLSXSheet(None, name, sheetindex)
+    sheet.merged_cells = list(xsheet.merged_cells)
+    sheet.nrows, sheet.ncols = xsheet.nrows, xsheet.ncols
+    table = xypath.Table(name=name)
+    table.sheet = sheet
+    table.index = sheetindex
+    XYCell = xypath.xypath._XYCell
+    runlists = xsheet.rich_text_runlist_map  if styles  else { }
+    XL_CELL_TEXT, XL_CELL_DATE = xlrd.XL_CELL_TEXT, xlrd.XL_CELL_DATE
+
+    for y in range(xsheet.nrows):
+        types, values = xsheet.row_types(y), xsheet.row_values(y)
+        xfindexes = [ xsheet.cell_xf_index(y, x)  for x in range(len(types)) ]  if styles  else None
+        for x, (ctype, value) in enumerate(zip(types, values)):
+            style = styles[xfindexes[x]]  if styles  else GENERALSTYLE
+            notscript = None
+            if ctype == XL_CELL_DATE:
+                value = xldatevalue(value, book.datemode, name, x, y)
+            elif ctype == XL_CELL_TEXT and (y, x) in runlists:
+                runlist = runlists[(y, x)]
+                if runlist:
+                    notscript = notscripttext(book, value, book.xf_list[xfindexes[x]].font_index, runlist)
+            table.add(XYCell(value, x, y, table, XLSXProperties(sheet, y, x, style, value, notscript)))
+    return table
+
+
+def loadxlstables(inputfile, sheetids="*"):
+    """Yield the xypath tables of the selected sheets of an xls file, where sheetids
+       is as for xypath.loader.get_sheets (name, index, callable, "*" or a list of these).
+       Sheets only selected by name or index are not read unless they match."""
+    if isinstance(sheetids, (int, str)) or callable(sheetids):
+        sheetids = (sheetids, )
+    try:
+        book = xlrd.open_workbook(inputfile, formatting_info=True, on_demand=True)
+    except NotImplementedError:   # no formatting information for this kind of file, as in messytables
+        book = xlrd.open_workbook(inputfile, on_demand=True)
+    try:
+        styles = bookstyles(book)  if book.formatting_info  else None
+        for sheetindex, name in enumerate(book.sheet_names()):
+            table = None
+            for identifier in sheetids:
+                if identifier == "*" or (isinstance(identifier, int) and identifier == sheetindex) or \
+                   (isinstance(identifier, str) and identifier.strip() == name.strip()):
+                    yield readsheet(book, sheetindex, styles)
+                elif callable(identifier):
+                    table = table or readsheet(book, sheetindex, styles)
+                    if identifier(table):
+                        yield table
+                elif not isinstance(identifier, (int, str)):
+                    raise NotImplementedError("Don't know what to do with a {!r}".format(type(identifier)))
+            if book.sheet_loaded(sheetindex):
+                book.unload_sheet(sheetindex)
+    finally:
+        book.release_resources()
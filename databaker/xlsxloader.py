@@ -0,0 +1,322 @@
+"""
+Read-only streaming loader for .xlsx workbooks, used by loadxlstabs(..., backend="xlsx").
+
+The sheet XML is parsed incrementally (ElementTree.iterparse, dropping each row
+once it has been read) and the xypath table is built straight from it, so memory
+goes with the number of cells rather than with an XML DOM or an xlrd Book plus a
+messytables cell and properties object per cell.  The tables come out like the
+xlrd ones: dense up to the last used row and column, blanks as '', numbers as
+floats and date formatted numbers as datetimes.
+"""
+
+import re, gc, zipfile, datetime, posixpath, collections.abc
+import xml.etree.ElementTree as ET
+import xlrd, xlrd.biffh, xlrd.formatting
+import xypath
+from messytables.error import NoSuchPropertyError
+from databaker.overrides import sheetspanindex
+
+RELTYPE_WORKSHEET = "/worksheet"   # ending of the relationship type of worksheets (as opposed to chartsheets)
+SCRIPTALIGNMENTS = { "superscript", "subscript" }
+errorcodes = { v:k  for k, v in xlrd.biffh.error_text_from_code.items() }
+
+
+def localname(tag):
+    return tag.rpartition("}")[2]
+
+def colindex(ref):
+    "Column number (from 0) of a cell reference like 'AB12'"
+    col = 0
+    for ch in ref:
+        if ch <= "9":
+            break
+        col = col*26 + ord(ch) - 64
+    return col - 1
+
+def refrowcol(ref):
+    "(row, col) numbered from 0 of a cell reference like 'AB12'"
+    col = colindex(ref)
+    return int(ref[re.search(r"\d", ref).start():]) - 1, col
+
+
+class _DateFormatBook:
+    verbosity = 0   # just enough of an xlrd Book for is_date_format_string()
+    logfile = None
+
+
+class XLSXStyle:
+    "The parts of a cellXfs record that databaker looks at"
+    __slots__ = [ "formatting_string", "a_date", "bold", "italic" ]
+    def __init__(self, formatting_string, a_date, bold, italic):
+        self.formatting_string = formatting_string
+        self.a_date = a_date
+        self.bold = bold
+        self.italic = italic
+
+
+class XLSXProperties(collections.abc.Mapping):
+    """Cell properties in the manner of messytables.excel.XLSProperties, kept small
+       (slots rather than the CoreProperties __dict__) as there is one per cell"""
+    KEYS = [ 'bold', 'italic', 'richtext', 'blank', 'a_date', 'formatting_string' ]
+    __slots__ = [ "sheet", "row", "col", "style", "value", "notscript" ]
+    def __init__(self, sheet, row, col, style, value, notscript=None):
+        self.sheet = sheet
+        self.row = row
+        self.col = col
+        self.style = style
+        self.value = value
+        self.notscript = notscript   # text without superscript/subscript runs if this is rich text
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            return getattr(self, 'get_' + key)()
+        raise NoSuchPropertyError("%r" % key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def raw_span(self, always=False):
+        box = sheetspanindex(self.sheet)[0].get((self.row, self.col))
+        if box is None and always:
+            return (self.row, self.row, self.col, self.col)
+        return box
+
+    def get_bold(self):               return self.style.bold
+    def get_italic(self):             return self.style.italic
+    def get_richtext(self):           return self.notscript is not None
+    def get_blank(self):              return self.value == ''
+    def get_a_date(self):             return self.style.a_date
+    def get_formatting_string(self):  return self.style.formatting_string
+
+
+class XLSXSheet:
+    "Stands in for the xlrd sheet as table.sheet (merged_cells is what overrides.sheetspanindex needs)"
+    def __init__(self, book, name, index):
+        self.book = book
+        self.name = name
+        self.index = index
+        self.merged_cells = [ ]   # (rlo, rhi, clo, chi) with the high ends not inclusive, as in xlrd
+        self.nrows = 0
+        self.ncols = 0
+
+
+class XLSXBook:
+    "The workbook level parts of an xlsx file: sheet list, date mode, styles and shared strings"
+    def __init__(self, zfile):
+        self.zfile = zfile
+        self.datemode = 0
+        self.sheetparts = [ ]   # (name, part filename)
+        self._readworkbook()
+        self.styles = self._readstyles()
+        self.sharedstrings = self._readsharedstrings()
+
+    def _readworkbook(self):
+        rels = { }
+        relspart = "xl/_rels/workbook.xml.rels"
+        for rel in ET.fromstring(self.zfile.read(relspart)):
+            target = rel.get("Target")
+            target = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            rels[rel.get("Id")] = (rel.get("Type", ""), target)
+        for elem in ET.fromstring(self.zfile.read("xl/workbook.xml")).iter():
+            tag = localname(elem.tag)
+            if tag == "workbookPr":
+                self.datemode = 1 if elem.get("date1904") in ("1", "true") else 0
+            elif tag == "sheet":
+                rid = [ v  for k, v in elem.attrib.items()  if localname(k) == "id" ][0]
+                reltype, target = rels[rid]
+                if reltype.endswith(RELTYPE_WORKSHEET):
+                    self.sheetparts.append((elem.get("name"), target))
+
+    def _readstyles(self):
+        if "xl/styles.xml" not in self.zfile.namelist():
+            return [ XLSXStyle("General", False, False, False) ]
+        root = ET.fromstring(self.zfile.read("xl/styles.xml"))
+        children = { localname(child.tag):child  for child in root }
+        numfmts = { }
+        for numfmt in children.get("numFmts", ()):
+            numfmts[int(numfmt.get("numFmtId"))] = numfmt.get("formatCode")
+        fonts = [ ]
+        for font in children.get("fonts", ()):
+            flags = { localname(f.tag):f.get("val", "1")  for f in font }
+            fonts.append((flags.get("b", "0") not in ("0", "false"), flags.get("i", "0") not in ("0", "false")))
+
+        dateformatbook = _DateFormatBook()
+        styles = [ ]
+        for xf in children.get("cellXfs", ()):
+            numfmtid = int(xf.get("numFmtId", 0))
+            bold, italic = fonts[int(xf.get("fontId", 0))]  if fonts  else (False, False)
+            if numfmtid in numfmts:
+                formatting_string = numfmts[numfmtid]
+                a_date = xlrd.formatting.is_date_format_string(dateformatbook, formatting_string)
+            else:
+                formatting_string = xlrd.formatting.std_format_strings.get(numfmtid, "General")
+                a_date = xlrd.formatting.std_format_code_types.get(numfmtid) == xlrd.formatting.FDT
+            styles.append(XLSXStyle(formatting_string, a_date, bold, italic))
+        return styles or [ XLSXStyle("General", False, False, False) ]
+
+    def _readsharedstrings(self):
+        "list of (text, notscript) where notscript is None unless the string is rich text"
+        res = [ ]
+        if "xl/sharedStrings.xml" not in self.zfile.namelist():
+            return res
+        with self.zfile.open("xl/sharedStrings.xml") as fin:
+            for event, elem in ET.iterparse(fin):
+                if localname(elem.tag) == "si":
+                    res.append(stringitem(elem))
+                    elem.clear()
+        return res
+
+
+def stringitem(elem):
+    "(text, notscript) of an <si> or <is> element; phonetic runs are left out as xlrd does"
+    text, notscript = [ ], [ ]
+    rich = False
+    for child in elem:
+        tag = localname(child.tag)
+        if tag == "t":
+            text.append(child.text or "")
+            notscript.append(child.text or "")
+        elif tag == "r":
+            rich = True
+            runtext, script = "", False
+            for part in child:
+                ptag = localname(part.tag)
+                if ptag == "t":
+                    runtext = part.text or ""
+                elif ptag == "rPr":
+                    script = any(localname(p.tag) == "vertAlign" and p.get("val") in SCRIPTALIGNMENTS  for p in part)
+            text.append(runtext)
+            if not script:
+                notscript.append(runtext)
+    return "".join(text), ("".join(notscript) if rich else None)
+
+
+def readsheet(book, sheetindex):
+    "Stream one worksheet into a new xypath Table"
+    # the collector would otherwise keep rescanning the ever growing table while finding
+    # nothing to free, which costs about a third of the load time on big sheets
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _readsheet(book, sheetindex)
+    finally:
+        if gcenabled:
+            gc.enable()
+
+def _readsheet(book, sheetindex):
+    name, part = book.sheetparts[sheetindex]
+    sheet = XLSXSheet(book, name, sheetindex)
+    table = xypath.Table(name=name)
+    table.sheet = sheet
+    table.index = sheetindex
+    styles, sharedstrings, datemode = book.styles, book.sharedstrings, book.datemode
+    XYCell = xypath.xypath._XYCell
+
+    def addcell(value, x, y, style, notscript=None):
+        table.add(XYCell(value, x, y, table, XLSXProperties(sheet, y, x, style, value, notscript)))
+
+    rowlengths = { }   # row -> number of cells added to it so far
+    y, x = -1, -1
+    sheetdata = None
+    with book.zfile.open(part) as fin:
+        context = ET.iterparse(fin, events=("start", "end"))
+        event, root = next(context)
+        ns = root.tag[:root.tag.index("}") + 1]  if root.tag.startswith("{")  else ""   # transitional or strict ooxml
+        C, V, IS, ROW, SHEETDATA, MERGECELL = [ ns + tag  for tag in ("c", "v", "is", "row", "sheetData", "mergeCell") ]
+        for event, elem in context:
+            tag = elem.tag
+            if event == "start":
+                if tag == ROW:
+                    r = elem.get("r")
+                    y = int(r) - 1  if r  else y + 1
+                    x = -1
+                elif tag == SHEETDATA:
+                    sheetdata = elem
+                continue
+
+            if tag == C:
+                ref = elem.get("r")
+                col = colindex(ref)  if ref  else x + 1
+                for gx in range(x + 1, col):   # fill the gaps in the row with blanks, as xlrd does
+                    addcell('', gx, y, styles[0])
+                x = col
+
+                style = styles[int(elem.get("s", 0))]
+                ctype = elem.get("t", "n")
+                notscript = None
+                value = ''
+                if ctype == "inlineStr":
+                    child = elem.find(IS)
+                    if child is not None:
+                        value, notscript = stringitem(child)
+                else:
+                    v = elem.findtext(V)
+                    if v:
+                        if ctype == "n":
+                            value = float(v)
+                            if style.a_date:
+                                value = xldatevalue(value, datemode, name, x, y)
+                        elif ctype == "s":
+                            value, notscript = sharedstrings[int(v)]
+                        elif ctype == "b":
+                            value = int(v)
+                        elif ctype == "e":
+                            value = errorcodes.get(v, v)
+                        elif ctype == "d":
+                            value = datetime.datetime.fromisoformat(v.rstrip("Z"))
+                        else:   # "str", a formula result
+                            value = v
+                addcell(value, x, y, style, notscript)
+                elem.clear()
+
+            elif tag == ROW:
+                rowlengths[y] = x + 1
+                sheetdata.clear()   # the row has been read into the table
+            elif tag == MERGECELL:
+                lo, _, hi = elem.get("ref").partition(":")
+                (rlo, clo), (rhi, chi) = refrowcol(lo), refrowcol(hi or lo)
+                sheet.merged_cells.append((rlo, rhi + 1, clo, chi + 1))
+
+    # pad out to a rectangle like xlrd, ignoring rows that are present but empty at the end
+    nrows = max([ ry + 1  for ry, rlen in rowlengths.items()  if rlen ] or [ 0 ])
+    ncols = max(list(rowlengths.values()) or [ 0 ])
+    for py in range(nrows):
+        for px in range(rowlengths.get(py, 0), ncols):
+            addcell('', px, py, styles[0])
+    sheet.nrows, sheet.ncols = nrows, ncols
+    return table
+
+
+def xldatevalue(value, datemode, sheetname, x, y):
+    "The datetime (or time) of a date formatted number, converted as messytables does"
+    if value == 0:
+        raise ValueError("Invalid date at '%s':%d,%d" % (sheetname, x + 1, y + 1))
+    year, month, day, hour, minute, second = xlrd.xldate_as_tuple(value, datemode)
+    if (year, month, day) == (0, 0, 0):
+        return datetime.time(hour, minute, second)
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+def loadxlsxtables(inputfile, sheetids="*"):
+    """Yield the xypath tables of the selected sheets of an xlsx file, where sheetids
+       is as for xypath.loader.get_sheets (name, index, callable, "*" or a list of these).
+       Sheets only selected by name or index are not read unless they match."""
+    if isinstance(sheetids, (int, str)) or callable(sheetids):
+        sheetids = (sheetids, )
+    with zipfile.ZipFile(inputfile) as zfile:
+        book = XLSXBook(zfile)
+        for sheetindex, (name, part) in enumerate(book.sheetparts):
+            table = None
+            for identifier in sheetids:
+                if identifier == "*" or (isinstance(identifier, int) and identifier == sheetindex) or \
+                   (isinstance(identifier, str) and identifier.strip() == name.strip()):
+                    yield readsheet(book, sheetindex)
+                elif callable(identifier):
+                    table = table or readsheet(book, sheetindex)
+                    if identifier(table):
+                        yield table
+                elif not isinstance(identifier, (int, str)):
+                    raise NotImplementedError("Don't know what to do with a {!r}".format(type(identifier)))
@@ -33,6 +33,8 @@ conf = dict(
     entry_points={
         'console_scripts': [
             'databaker_nbconvert = databaker.databaker_nbconvert:main',
+            'databaker_bake = databaker.databaker_bake:main',
+            'databaker_serve = databaker.bakeservice:main',
             ]
         },
     )